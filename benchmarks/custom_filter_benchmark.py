@@ -0,0 +1,111 @@
+# benchmarks/custom_filter_benchmark.py
+
+"""
+Compare the per-record cost of the original custom filter evaluation (token
+substitution and `eval()` for every record) with compiled filter predicates.
+
+Run from the repository root:
+
+    python benchmarks/custom_filter_benchmark.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jogging.logic import compile_custom_filter  # noqa: E402
+
+RECORD_COUNT = 10000
+REPEAT = 5
+
+FILTERS = [
+    "role eq 'jogger'",
+    "(role eq 'staff' or role eq 'superuser') and username ne 'admin'",
+]
+
+
+# == Original implementation ==
+
+
+LEGACY_OPERATORS = {
+    "eq": "==",
+    "ne": "!=",
+    "lt": "<",
+    "lte": "<=",
+    "gt": ">",
+    "gte": ">=",
+    "(": "(",
+    ")": ")",
+}
+
+
+def legacy_evaluate(filter_string, replacement_map):
+
+    raw_string = filter_string.replace("(", " ( ").replace(")", " ) ").strip()
+    while "  " in raw_string:
+        raw_string = raw_string.replace("  ", " ")
+
+    tokens = [replacement_map.get(token, token) for token in raw_string.split()]
+
+    try:
+        return eval(" ".join(tokens))
+    except BaseException:
+        return False
+
+
+def legacy_tokens(record):
+
+    tokens = LEGACY_OPERATORS.copy()
+    tokens["username"] = "'" + record["username"] + "'"
+    tokens["role"] = "'" + record["role"] + "'"
+    return tokens
+
+
+# == Benchmark ==
+
+
+def generate_records():
+
+    roles = ["jogger"] * 8 + ["staff", "superuser"]
+    return [
+        {"username": "user%d" % index, "role": roles[index % len(roles)]}
+        for index in range(RECORD_COUNT)
+    ]
+
+
+def run_legacy(filter_string, records):
+    return [
+        record
+        for record in records
+        if legacy_evaluate(filter_string, legacy_tokens(record))
+    ]
+
+
+def run_compiled(filter_string, records):
+    matches = compile_custom_filter(filter_string, ("role", "username"))
+    return [record for record in records if matches(record)]
+
+
+def main():
+
+    records = generate_records()
+
+    for filter_string in FILTERS:
+        assert run_legacy(filter_string, records) == run_compiled(
+            filter_string, records
+        )
+
+        print(filter_string)
+        for name, function in [("eval", run_legacy), ("compiled", run_compiled)]:
+            best = min(
+                timeit.repeat(
+                    lambda: function(filter_string, records), number=1, repeat=REPEAT
+                )
+            )
+            print("  %-8s %8.2f us/record" % (name, best / len(records) * 1000000))
+
+
+if __name__ == "__main__":
+    main()
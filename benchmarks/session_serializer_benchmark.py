@@ -0,0 +1,118 @@
+# benchmarks/session_serializer_benchmark.py
+
+"""
+Compare session list serialization (query, serialization and JSON rendering)
+with `JoggingSessionSerializer` and the `JoggingSessionListSerializer` fast
+path, using an in-memory database.
+
+Run from the repository root:
+
+    python benchmarks/session_serializer_benchmark.py
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "joglog.settings")
+os.environ.setdefault("SECRET", "benchmark")
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.DATABASES["default"]["NAME"] = ":memory:"
+settings.ALLOWED_HOSTS = ["testserver"]
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+from rest_framework.request import Request  # noqa: E402
+from rest_framework.test import APIRequestFactory  # noqa: E402
+
+from jogging.models import JoggingSession  # noqa: E402
+from jogging.serializers import (  # noqa: E402
+    JoggingSessionListSerializer,
+    JoggingSessionSerializer,
+)
+
+ROW_COUNTS = [10000, 100000]
+DAYS_PER_USER = 1000
+
+
+def populate(row_count):
+
+    JoggingSession.objects.all().delete()
+    get_user_model().objects.all().delete()
+
+    first_day = datetime(2015, 1, 5, 7, 30, tzinfo=timezone.utc)
+    sessions = []
+
+    for index in range(row_count):
+        if index % DAYS_PER_USER == 0:
+            user = get_user_model().objects.create(username="user%d" % index)
+
+        start = first_day + timedelta(days=index % DAYS_PER_USER)
+        sessions.append(
+            JoggingSession(
+                user=user,
+                start=start,
+                dn_week=201502,
+                dn_date=start.date(),
+                local_timezone="Europe/London",
+                distance=5000 + index % 3000,
+                duration=30 + index % 30,
+                dn_speed="9.5",
+                lu_weather_location="London,UK",
+                lu_weather="CLEAR",
+            )
+        )
+
+    JoggingSession.objects.bulk_create(sessions)
+
+
+def render_serializer(request):
+
+    sessions = JoggingSession.objects.all()
+    serializer = JoggingSessionSerializer(
+        sessions, many=True, context={"request": request}
+    )
+    return JSONRenderer().render(serializer.data)
+
+
+def render_list_serializer(request):
+
+    rows = JoggingSession.objects.values(*JoggingSessionListSerializer.columns)
+    serializer = JoggingSessionListSerializer(rows, context={"request": request})
+    return JSONRenderer().render(serializer.data)
+
+
+def main():
+
+    call_command("migrate", verbosity=0)
+    request = Request(APIRequestFactory().get("/api/v1/sessions/"))
+
+    for row_count in ROW_COUNTS:
+        populate(row_count)
+        outputs = {}
+
+        print("%d sessions" % row_count)
+        for name, function in [
+            ("serializer", render_serializer),
+            ("fast path", render_list_serializer),
+        ]:
+            started = time.perf_counter()
+            outputs[name] = function(request)
+            elapsed = time.perf_counter() - started
+            print(
+                "  %-10s %7.3f s  %6.2f us/row"
+                % (name, elapsed, elapsed / row_count * 1000000)
+            )
+
+        assert outputs["serializer"] == outputs["fast path"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# benchmarks/weather_enrichment_benchmark.py
+
+"""
+Load-test background weather enrichment against the local weather stub server,
+with per-query latency and errors, for different enrichment batch sizes. Uses a
+temporary database, and no network.
+
+Run from the repository root:
+
+    python benchmarks/weather_enrichment_benchmark.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "joglog.settings")
+os.environ.setdefault("SECRET", "benchmark")
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+database = tempfile.NamedTemporaryFile(suffix=".sqlite3")
+settings.DATABASES["default"]["NAME"] = database.name
+settings.DATABASES["default"]["OPTIONS"] = {"timeout": 60}
+django.setup()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+
+from jogging import logic  # noqa: E402
+from jogging.enrichment import weather_enrichment  # noqa: E402
+from jogging.models import CachedWeather, JoggingSession  # noqa: E402
+from jogging.weather_stub import WeatherStubServer  # noqa: E402
+
+SESSION_COUNT = 2000
+USER_COUNT = 20
+LOCATIONS = ["London,UK", "Paris,FR", "Berlin,DE", "Madrid,ES", "Rome,IT"]
+BATCH_SIZES = [1, 100]
+LATENCY = 0.05  # seconds per query
+ERROR_RATE = 0.05
+
+
+def populate():
+
+    JoggingSession.objects.all().delete()
+    CachedWeather.objects.all().delete()
+    get_user_model().objects.all().delete()
+
+    users = [
+        get_user_model().objects.create(username="user%d" % index)
+        for index in range(USER_COUNT)
+    ]
+    first_day = datetime(2019, 1, 7, 7, 30, tzinfo=timezone.utc)
+    sessions = []
+
+    for index in range(SESSION_COUNT):
+        start = first_day + timedelta(days=index // USER_COUNT)
+        sessions.append(
+            JoggingSession(
+                user=users[index % USER_COUNT],
+                start=start,
+                dn_week=201902,
+                dn_date=start.date(),
+                distance=5000,
+                duration=30,
+                dn_speed="10.0",
+                lu_weather_location=LOCATIONS[index % len(LOCATIONS)],
+                lu_weather_pending=True,
+            )
+        )
+
+    JoggingSession.objects.bulk_create(sessions)
+    return list(JoggingSession.objects.values_list("id", flat=True))
+
+
+def main():
+
+    call_command("migrate", verbosity=0)
+
+    server = WeatherStubServer(latency=LATENCY, error_rate=ERROR_RATE, seed=1)
+    server.start()
+
+    settings.WEATHER_API_URL = server.url
+    settings.WEATHER_LOOKUP_RETRY_DELAY = 0.1
+    settings.WEATHER_BREAKER_THRESHOLD = 1000  # measure retries, not the breaker
+
+    print(
+        "%d sessions, %.0f ms latency, %d%% errors"
+        % (SESSION_COUNT, LATENCY * 1000, ERROR_RATE * 100)
+    )
+
+    for batch_size in BATCH_SIZES:
+        session_ids = populate()
+        settings.WEATHER_LOOKUP_BATCH_SIZE = batch_size
+        logic.reset_weather_cache_counts()
+        server.query_count = 0
+
+        started = time.perf_counter()
+        weather_enrichment.enqueue(session_ids)
+        weather_enrichment.wait()
+        elapsed = time.perf_counter() - started
+
+        pending = JoggingSession.objects.filter(lu_weather_pending=True).count()
+        print(
+            "  batch size %-4d %7.2f s  %7.1f sessions/s  %5d queries  %d pending"
+            % (
+                batch_size,
+                elapsed,
+                SESSION_COUNT / elapsed,
+                server.query_count,
+                pending,
+            )
+        )
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
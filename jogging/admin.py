@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import JoggingSession
+from .models import CachedWeather, JoggingSession, WeeklySummary
 
 
 class JoggingSessionAdmin(admin.ModelAdmin):
@@ -8,14 +8,45 @@ class JoggingSessionAdmin(admin.ModelAdmin):
         "user",
         "start",
         "local_timezone",
+        "dn_date",
         "dn_week",
         "distance",
         "duration",
         "dn_speed",
         "lu_weather_location",
         "lu_weather",
+        "lu_weather_pending",
+    )
+    readonly_fields = (
+        "dn_date",
+        "dn_week",
+        "dn_speed",
+        "lu_weather",
+        "lu_weather_pending",
     )
-    readonly_fields = ("dn_week", "dn_speed", "lu_weather")
 
 
 admin.site.register(JoggingSession, JoggingSessionAdmin)
+
+
+class WeeklySummaryAdmin(admin.ModelAdmin):
+    fields = (
+        "user",
+        "dn_week",
+        "total_distance",
+        "total_duration",
+        "session_count",
+        "avg_speed",
+    )
+    readonly_fields = fields  # maintained from sessions
+
+
+admin.site.register(WeeklySummary, WeeklySummaryAdmin)
+
+
+class CachedWeatherAdmin(admin.ModelAdmin):
+    fields = ("location", "date", "weather", "fetched")
+    readonly_fields = fields  # maintained by weather lookups
+
+
+admin.site.register(CachedWeather, CachedWeatherAdmin)
@@ -0,0 +1,157 @@
+# jogging/caching.py
+
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.response import Response
+
+
+# == Responses ==
+
+
+# Cache scope for responses about all users' sessions
+ALL_USERS = "all"
+
+
+def _version_key(scope):
+
+    return "jogging:data-version:%s" % scope
+
+
+def _modified_key(scope):
+
+    return "jogging:data-modified:%s" % scope
+
+
+def get_data_version(scope):
+    """
+    The data version of a scope (a user id, or `ALL_USERS`). Versions are random,
+    so a version evicted from the cache is not reused.
+    """
+
+    version = cache.get(_version_key(scope))
+    if version is None:
+        cache.add(_version_key(scope), uuid.uuid4().hex, timeout=None)
+        version = cache.get(_version_key(scope))
+
+    return version
+
+
+def get_data_modified(scope):
+    """
+    The time (a timestamp in whole seconds) of the last change to a scope's data,
+    or the time it was first asked for.
+    """
+
+    modified = cache.get(_modified_key(scope))
+    if modified is None:
+        cache.add(_modified_key(scope), int(time.time()), timeout=None)
+        modified = cache.get(_modified_key(scope))
+
+    return modified
+
+
+def bump_data_version(scope):
+
+    # A new random version rather than an increment: not all cache backends can
+    # increment atomically, and concurrent changes must not share a version
+    cache.set(_version_key(scope), uuid.uuid4().hex, timeout=None)
+
+    # Changes within the same second share a Last-Modified date (never a future
+    # one), and are told apart by the ETag
+    cache.set(_modified_key(scope), int(time.time()), timeout=None)
+
+
+def data_changed(user_ids):
+    """
+    Invalidate cached responses about these users' sessions, and about all users.
+    Cached responses are not deleted; they are keyed by data version, and are no
+    longer found after a new version.
+
+    Versions are changed now, so that the changes are seen in this transaction,
+    and again once it is committed, in case other requests cached the old data
+    in the meantime.
+    """
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def bump():
+        for user_id in user_ids:
+            bump_data_version(user_id)
+        bump_data_version(ALL_USERS)
+
+    bump()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(bump)
+
+
+def get_etag(request, scope):
+    """
+    A strong ETag for the response to a request about a scope's data. It is
+    derived from the data version, URL and format, so no response is needed.
+    """
+
+    renderer = getattr(request, "accepted_renderer", None)
+    representation = "%s|%s|%s|%s" % (
+        scope,
+        get_data_version(scope),
+        request.build_absolute_uri(),
+        renderer.format if renderer is not None else "",
+    )
+
+    return '"%s"' % hashlib.sha256(representation.encode()).hexdigest()
+
+
+def cached_response(request, scope, get_response):
+    """
+    The response to a GET request about a scope's data. Conditional requests
+    (If-None-Match, If-Modified-Since) get 304 Not Modified if the data has not
+    changed. Otherwise the response is from the cache if the data has not changed
+    since it was cached, else from `get_response`. Successful responses are
+    cached for `RESPONSE_CACHE_TIMEOUT` seconds, and have ETag and Last-Modified
+    headers. The request must already be authorised for the scope.
+    """
+
+    # The version is read first, so data read during a change is cached under
+    # the version before the change
+    etag = get_etag(request, scope)
+    modified = get_data_modified(scope)
+
+    response = get_conditional_response(request, etag=etag, last_modified=modified)
+
+    if response is None:
+        key = "jogging:response:%s" % etag.strip('"')
+        data = cache.get(key)
+
+        if data is not None:
+            response = Response(data)
+        else:
+            response = get_response()
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(key, response.data, settings.RESPONSE_CACHE_TIMEOUT)
+
+    if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(modified)
+
+    return response
+
+
+def check_preconditions(request, scope):
+    """
+    Check the If-Match and If-Unmodified-Since headers of a write to a scope's
+    data. Returns a 412 Precondition Failed response if they fail, else None.
+    """
+
+    return get_conditional_response(
+        request, etag=get_etag(request, scope), last_modified=get_data_modified(scope)
+    )
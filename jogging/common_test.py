@@ -5,6 +5,7 @@ from datetime import datetime, timedelta
 import pytest
 from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
 from django.conf import settings
+from django.core.cache import cache
 
 from .models import JoggingSession
 
@@ -16,6 +17,22 @@ STAFF_NAME = "staff"
 SUPERUSER_NAME = "superuser"
 
 
+@pytest.fixture(autouse=True)
+def clear_cache(settings):
+    """
+    Tests use their own cache, cleared for each test: cached responses and data
+    versions would outlive each test's database.
+    """
+
+    settings.CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "joglog-test",
+        }
+    }
+    cache.clear()
+
+
 def test_debug_state():
     assert settings.DEBUG is not None  # ensure that settings have loaded
 
@@ -0,0 +1,168 @@
+# jogging/enrichment.py
+
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_for_futures
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .caching import data_changed
+from .logic import get_fallback_weather, get_weather_batch
+
+
+# == Weather ==
+
+
+class WeatherEnrichment:
+    """
+    Background weather lookups for saved sessions, so that saving a session does
+    not wait for the weather provider. Sessions are marked as pending when saved
+    and queued once the save is committed; a local pool of worker threads then
+    fills in the weather.
+
+    The pending flag is stored with the session, so sessions queued by a process
+    that stops before the lookup completes can be found and queued again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = {}  # future -> session ids
+
+    def enqueue(self, session_ids):
+        """Queue weather lookups for these sessions, in batches."""
+
+        session_ids = list(session_ids)
+        batch_size = settings.WEATHER_LOOKUP_BATCH_SIZE
+        futures = []
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.WEATHER_LOOKUP_WORKERS,
+                    thread_name_prefix="weather",
+                )
+
+            for i in range(0, len(session_ids), batch_size):
+                batch = session_ids[i : i + batch_size]
+                future = self._executor.submit(self._run, batch)
+                self._futures[future] = batch
+                futures.append(future)
+
+        # Outside the lock: the callback runs at once if the lookup has finished
+        for future in futures:
+            future.add_done_callback(self._forget)
+
+    def pending(self):
+        """Ids of sessions with queued or running lookups."""
+
+        with self._lock:
+            return {id for batch in self._futures.values() for id in batch}
+
+    def wait(self, timeout=None):
+        """
+        Wait for queued lookups (including any queued while waiting) to finish.
+        Return True if all lookups finished before the timeout.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+
+            if not futures:
+                return True
+
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+
+            done, not_done = wait_for_futures(futures, timeout=remaining)
+            if not_done:
+                return False
+
+    def _forget(self, future):
+
+        with self._lock:
+            self._futures.pop(future, None)
+
+    def _run(self, session_ids):
+
+        try:
+            enrich_sessions(session_ids)
+        except Exception:
+            # Otherwise the future keeps the exception unseen. The sessions stay pending.
+            print("Weather enrichment failed for sessions %s:" % session_ids)
+            traceback.print_exc()
+        finally:
+            connections.close_all()  # worker threads have their own connections
+
+
+weather_enrichment = WeatherEnrichment()
+
+
+def get_weather_batch_with_retries(lookups):
+    """
+    Get the weather for many (location, UTC date) pairs, retrying failed lookups
+    with exponential backoff. If every attempt fails, use the fallback weather.
+    """
+
+    lookups = set(lookups)
+    results = {}
+    delay = settings.WEATHER_LOOKUP_RETRY_DELAY
+
+    for attempt in range(1, settings.WEATHER_LOOKUP_ATTEMPTS + 1):
+        results.update(get_weather_batch(lookups - results.keys()))
+        missing = lookups - results.keys()
+
+        if not missing:
+            return results
+
+        print("Weather lookup attempt %d failed for %d dates" % (attempt, len(missing)))
+
+        if attempt < settings.WEATHER_LOOKUP_ATTEMPTS:
+            time.sleep(delay)
+            delay *= 2
+
+    for location, day in missing:
+        results[(location, day)] = get_fallback_weather(location, day.isoformat())
+
+    return results
+
+
+def enrich_sessions(session_ids):
+    """
+    Fill in the weather for pending sessions, looking up each (location, date)
+    once. The weather is only stored if the session's location and date have not
+    changed during the lookup.
+    """
+
+    from .models import JoggingSession  # models queue lookups from this module
+
+    pending = JoggingSession.objects.filter(id__in=session_ids, lu_weather_pending=True)
+
+    ids_by_lookup = {}
+    user_ids = set()
+    for session in pending.values("id", "user_id", "lu_weather_location", "dn_date"):
+        lookup = (session["lu_weather_location"], session["dn_date"])
+        ids_by_lookup.setdefault(lookup, []).append(session["id"])
+        user_ids.add(session["user_id"])
+
+    if not ids_by_lookup:
+        return  # deleted, or already enriched
+
+    weather_by_lookup = get_weather_batch_with_retries(ids_by_lookup.keys())
+
+    with transaction.atomic():
+        for (location, day), ids in ids_by_lookup.items():
+            pending.filter(
+                id__in=ids, lu_weather_location=location, dn_date=day
+            ).update(
+                lu_weather=weather_by_lookup[(location, day)], lu_weather_pending=False
+            )
+
+        data_changed(user_ids)
@@ -1,10 +1,29 @@
 # jogging/jogging_test.py
 
+import io
+import time
+from datetime import date, datetime
 from decimal import Decimal
 
 from django.core.exceptions import ValidationError
-
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test.utils import CaptureQueriesContext
+
+from . import enrichment
+from .caching import ALL_USERS, get_data_version
 from .common_test import *
+from .enrichment import enrich_sessions, weather_enrichment
+from .logic import (
+    DeterministicWeatherProvider,
+    UnknownLocationError,
+    normalise_location,
+)
+from .management.commands import backfill_weather
+from .management.commands.backfill_weather import RateLimiter
+from .models import WeeklySummary
 
 VALID_START = "2020-02-19T11:01:20+00:00"
 VALID_WEEK = 202008  # 19 February 2020 falls in calendar week 8 of 2020
@@ -102,7 +121,9 @@ def test_session_with_zero_duration_returns_zero_speed(create_session):
 
 
 @pytest.mark.django_db
-def test_session_with_unknown_location_returns_empty_weather(create_session):
+def test_session_with_unknown_location_returns_empty_weather(create_session, settings):
+
+    settings.WEATHER_LOOKUP_RETRY_DELAY = 0
 
     session = create_session(
         username="alice",
@@ -111,7 +132,11 @@ def test_session_with_unknown_location_returns_empty_weather(create_session):
         start_string=VALID_START,
         lu_weather_location="uqqygfdgdfgiuyeiruydfjfgeff",  # does not exist
     )
+    enrich_sessions([session.id])
+    session.refresh_from_db()
+
     assert session.lu_weather == ""
+    assert not session.lu_weather_pending
 
 
 @pytest.mark.django_db
@@ -147,3 +172,513 @@ def test_two_records_on_the_same_day_are_not_allowed(
 
     # Confirm that matching session is the only session stored
     get_existing_session("alice", stamp1)
+
+
+@pytest.mark.django_db
+def test_concurrent_records_on_the_same_day_are_not_allowed(
+    create_session, monkeypatch
+):
+
+    session = create_session(
+        username="alice",
+        duration=60,
+        distance=1000,
+        start_string=VALID_START,
+        lu_weather_location="",
+    )
+    assert session.dn_date == session.start.date()
+
+    # Simulate a concurrent save that passed validation before the first commit
+    monkeypatch.setattr(JoggingSession, "validate_unique", lambda self, exclude: None)
+
+    with pytest.raises(ValidationError):
+        create_session(
+            username="alice",
+            duration=30,
+            distance=500,
+            start_string="2020-02-19T18:30:00+00:00",
+            lu_weather_location="",
+        )
+
+    assert JoggingSession.objects.filter(user__username="alice").count() == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_migration_lists_sessions_on_the_same_day():
+
+    before = [("jogging", "0008_weeklysummary")]
+    after = [("jogging", "0009_joggingsession_dn_date")]
+    executor = MigrationExecutor(connection)
+    executor.migrate(before)
+
+    try:
+        apps = executor.loader.project_state(before).apps
+        user = apps.get_model("auth", "User").objects.create(username="alice")
+        sessions = apps.get_model("jogging", "JoggingSession").objects
+        for start in [VALID_START, "2020-02-19T18:30:00+00:00"]:
+            sessions.create(
+                user=user, start=datetime.fromisoformat(start), distance=1, duration=1
+            )
+
+        # Sessions stored before one session per day was enforced
+        executor.loader.build_graph()
+        with pytest.raises(RuntimeError, match="user %d on 2020-02-19" % user.id):
+            executor.migrate(after)
+
+    finally:
+        sessions.all().delete()
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes("jogging"))
+
+
+# == Weather enrichment ==
+
+
+def flaky_weather(failures):
+    """A batch weather lookup that fails a number of times before succeeding."""
+
+    attempts = []
+
+    def _flaky_weather(lookups):
+        attempts.append(sorted(lookups))
+        if len(attempts) <= failures:
+            return {}  # weather provider unavailable
+        return {lookup: "CLEAR" for lookup in lookups}
+
+    return _flaky_weather, attempts
+
+
+@pytest.mark.django_db
+def test_weather_is_pending_until_enriched(create_session, monkeypatch, settings):
+
+    settings.WEATHER_LOOKUP_RETRY_DELAY = 0
+    lookup, attempts = flaky_weather(failures=2)
+    monkeypatch.setattr(enrichment, "get_weather_batch", lookup)
+
+    session = create_session(
+        username="alice",
+        duration=60,
+        distance=1000,
+        start_string=VALID_START,
+        lu_weather_location="London,UK",
+    )
+
+    # Saving does not wait for the weather
+    assert attempts == []
+    assert session.lu_weather == ""
+    assert session.lu_weather_pending
+
+    # Failed lookups are retried
+    enrich_sessions([session.id])
+    session.refresh_from_db()
+
+    assert len(attempts) == 3
+    assert session.lu_weather == "CLEAR"
+    assert not session.lu_weather_pending
+
+
+@pytest.mark.django_db
+def test_weather_enrichment_batches_lookups(create_session, monkeypatch):
+
+    lookup, attempts = flaky_weather(failures=0)
+    monkeypatch.setattr(enrichment, "get_weather_batch", lookup)
+
+    sessions = [
+        create_session(
+            username=username,
+            duration=60,
+            distance=1000,
+            start_string=start_string,
+            lu_weather_location="London,UK",
+        )
+        for username, start_string in [
+            ("alice", VALID_START),
+            ("bob", "2020-02-19T18:30:00+00:00"),
+            ("bob", "2020-02-20T18:30:00+00:00"),
+        ]
+    ]
+    enrich_sessions([session.id for session in sessions])
+
+    # One lookup per location and date, for all sessions
+    assert attempts == [
+        [("London,UK", date(2020, 2, 19)), ("London,UK", date(2020, 2, 20))]
+    ]
+    assert set(
+        JoggingSession.objects.values_list("lu_weather", "lu_weather_pending")
+    ) == {("CLEAR", False)}
+
+
+@pytest.mark.django_db
+def test_weather_enrichment_gives_up(create_session, monkeypatch, settings):
+
+    settings.WEATHER_LOOKUP_RETRY_DELAY = 0
+    lookup, attempts = flaky_weather(failures=settings.WEATHER_LOOKUP_ATTEMPTS)
+    monkeypatch.setattr(enrichment, "get_weather_batch", lookup)
+
+    session = create_session(
+        username="alice",
+        duration=60,
+        distance=1000,
+        start_string=VALID_START,
+        lu_weather_location="London,UK",
+    )
+    enrich_sessions([session.id])
+    session.refresh_from_db()
+
+    assert len(attempts) == settings.WEATHER_LOOKUP_ATTEMPTS
+    assert session.lu_weather == ""
+    assert not session.lu_weather_pending
+
+
+@pytest.mark.django_db(transaction=True)
+def test_weather_enrichment_after_commit(create_session, monkeypatch):
+
+    lookup, attempts = flaky_weather(failures=0)
+    monkeypatch.setattr(enrichment, "get_weather_batch", lookup)
+
+    session = create_session(
+        username="alice",
+        duration=60,
+        distance=1000,
+        start_string=VALID_START,
+        lu_weather_location="London,UK",
+    )
+
+    assert weather_enrichment.wait(timeout=10)
+    assert weather_enrichment.pending() == set()
+
+    session.refresh_from_db()
+    assert session.lu_weather == "CLEAR"
+    assert not session.lu_weather_pending
+
+
+def test_weather_enrichment_reports_errors(monkeypatch, capsys):
+    def broken_enrichment(session_ids):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(enrichment, "enrich_sessions", broken_enrichment)
+
+    background = enrichment.WeatherEnrichment()
+    background.enqueue([1, 2])
+    assert background.wait(timeout=10)
+
+    output = capsys.readouterr()
+    assert "Weather enrichment failed for sessions [1, 2]" in output.out
+    assert "RuntimeError: database unavailable" in output.err
+
+
+class UnreliableWeatherProvider(DeterministicWeatherProvider):
+    """Deterministic weather that can fail for some locations, recording queries."""
+
+    failing = set()
+    unknown = set()
+    queries = []
+
+    def get_weather_range(self, query):
+
+        self.queries.append(query)
+        if self.failing.intersection(query.locations):
+            raise ValueError("Weather provider unavailable")
+        elif self.unknown.intersection(query.locations):
+            raise UnknownLocationError("Location could not be found")
+
+        return super().get_weather_range(query)
+
+
+@pytest.mark.django_db
+def test_backfill_weather(create_session, settings, monkeypatch):
+
+    settings.WEATHER_PROVIDER = "jogging.jogging_test.UnreliableWeatherProvider"
+    monkeypatch.setattr(UnreliableWeatherProvider, "failing", {"Paris,FR"})
+    monkeypatch.setattr(UnreliableWeatherProvider, "unknown", {"Atlantis"})
+    monkeypatch.setattr(UnreliableWeatherProvider, "queries", [])
+
+    # Queries for different start dates are separate
+    for username, location, first_day in [
+        ("alice", "London,UK", 18),
+        ("bob", "Paris,FR", 24),
+        ("carol", "Atlantis", 18),
+        ("dave", "", 18),
+    ]:
+        for day in range(first_day, first_day + 3):
+            create_session(
+                username=username,
+                duration=60,
+                distance=1000,
+                start_string="2020-02-%dT07:30:00+00:00" % day,
+                lu_weather_location=location,
+            )
+
+    def weather_by_location():
+        """Weather ("expected", empty or unexpected) and pending flags by location."""
+
+        provider = UnreliableWeatherProvider()
+        results = {}
+
+        for location, day, weather, pending in JoggingSession.objects.values_list(
+            "lu_weather_location", "dn_date", "lu_weather", "lu_weather_pending"
+        ):
+            if weather != "" and weather == provider.weather_for(
+                normalise_location(location), day
+            ):
+                weather = "expected"
+            results.setdefault(location, set()).add((weather, pending))
+
+        return results
+
+    # Lookups fail for one location
+    call_command(
+        "backfill_weather", workers=2, rate=0, chunk_size=4, stdout=io.StringIO()
+    )
+
+    assert weather_by_location() == {
+        "London,UK": {("expected", False)},
+        "Paris,FR": {("", True)},
+        "Atlantis": {("", False)},
+        "": {("", False)},
+    }
+
+    # Running again only looks up the missing weather
+    UnreliableWeatherProvider.failing = set()
+    UnreliableWeatherProvider.queries.clear()
+
+    call_command(
+        "backfill_weather", workers=2, rate=0, chunk_size=4, stdout=io.StringIO()
+    )
+
+    assert {query.locations for query in UnreliableWeatherProvider.queries} == {
+        ("Paris,FR",)
+    }
+    assert weather_by_location()["Paris,FR"] == {("expected", False)}
+
+
+@pytest.mark.django_db
+def test_backfill_weather_split_queries(create_session, settings, monkeypatch):
+
+    settings.WEATHER_PROVIDER = "jogging.jogging_test.UnreliableWeatherProvider"
+    monkeypatch.setattr(UnreliableWeatherProvider, "failing", set())
+    monkeypatch.setattr(UnreliableWeatherProvider, "unknown", {"Atlantis"})
+    monkeypatch.setattr(UnreliableWeatherProvider, "queries", [])
+
+    for username, location in [("alice", "London,UK"), ("carol", "Atlantis")]:
+        create_session(
+            username=username,
+            duration=60,
+            distance=1000,
+            start_string=VALID_START,
+            lu_weather_location=location,
+        )
+
+    output = io.StringIO()
+    call_command("backfill_weather", rate=0, stdout=output)
+
+    # The query for both locations is split to find the unknown location, and the
+    # split queries are rate limited and counted like any other
+    assert sorted(query.locations for query in UnreliableWeatherProvider.queries) == [
+        ("Atlantis",),
+        ("Atlantis", "London,UK"),
+        ("London,UK",),
+    ]
+    assert "with 3 weather queries" in output.getvalue()
+
+
+@pytest.mark.django_db
+def test_backfill_weather_location_changed(create_session, settings, monkeypatch):
+
+    settings.WEATHER_PROVIDER = "jogging.logic.DeterministicWeatherProvider"
+    session = create_session(
+        username=JOGGER_NAME,
+        duration=60,
+        distance=1000,
+        start_string=VALID_START,
+        lu_weather_location="London,UK",
+    )
+    get_weather_batch = backfill_weather.get_weather_batch
+
+    def change_location(*args, **kwargs):
+        """The location changes while weather is looked up."""
+
+        JoggingSession.objects.filter(id=session.id).update(
+            lu_weather_location="Paris,FR"
+        )
+        return get_weather_batch(*args, **kwargs)
+
+    monkeypatch.setattr(backfill_weather, "get_weather_batch", change_location)
+    call_command("backfill_weather", rate=0, stdout=io.StringIO())
+
+    session.refresh_from_db()
+    assert (session.lu_weather_location, session.lu_weather) == ("Paris,FR", "")
+
+
+def test_backfill_rate_limit():
+
+    limiter = RateLimiter(rate=50)
+    started = time.monotonic()
+
+    for i in range(6):
+        limiter.wait()
+
+    assert time.monotonic() - started >= 5 / 50
+    assert limiter.calls == 6
+
+
+# == Weekly summaries ==
+
+
+def summary_values(username):
+    return list(
+        WeeklySummary.objects.filter(user__username=username).values_list(
+            "dn_week", "total_distance", "total_duration", "session_count", "avg_speed"
+        )
+    )
+
+
+@pytest.mark.django_db
+def test_weekly_summary_follows_sessions(create_session, create_or_get_user):
+
+    first = create_session(
+        username="alice",
+        duration=60,
+        distance=1000,
+        start_string=VALID_START,
+        lu_weather_location="",
+    )
+    second = create_session(
+        username="alice",
+        duration=30,
+        distance=2000,
+        start_string="2020-02-20T11:00:00+00:00",
+        lu_weather_location="",
+    )
+    assert summary_values("alice") == [(VALID_WEEK, 3000, 90, 2, Decimal("2.0"))]
+
+    # Move a session to the following week
+    second.start = datetime.fromisoformat("2020-02-24T11:00:00+00:00")
+    second.save()
+    assert summary_values("alice") == [
+        (VALID_WEEK + 1, 2000, 30, 1, Decimal("4.0")),
+        (VALID_WEEK, 1000, 60, 1, Decimal("1.0")),
+    ]
+
+    # Move a session to another user
+    first.user = create_or_get_user("bob")
+    first.save()
+    assert summary_values("alice") == [(VALID_WEEK + 1, 2000, 30, 1, Decimal("4.0"))]
+    assert summary_values("bob") == [(VALID_WEEK, 1000, 60, 1, Decimal("1.0"))]
+
+    # Delete sessions, directly and by queryset
+    second.delete()
+    assert summary_values("alice") == []
+
+    JoggingSession.objects.filter(user__username="bob").delete()
+    assert WeeklySummary.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_weekly_summary_removed_with_user(populate_samples, delete_user_sessions):
+
+    populate_samples
+    assert summary_values(SAMPLE_NAME) == [(VALID_WEEK, 3000, 180, 3, Decimal("1.0"))]
+
+    # Summaries are deleted with the user, not refreshed for each session
+    with CaptureQueriesContext(connection) as queries:
+        delete_user_sessions(SAMPLE_NAME)
+
+    assert not any("SUM(" in query["sql"] for query in queries)
+    assert summary_values(SAMPLE_NAME) == []
+    assert len(summary_values(JOGGER_NAME)) == 1
+
+
+@pytest.mark.django_db
+def test_rebuild_weekly_summaries(populate_samples):
+
+    populate_samples
+    call_command("rebuild_weekly_summaries", check=True)
+
+    # Corrupt one summary and remove another
+    WeeklySummary.objects.filter(user__username=SAMPLE_NAME).update(total_distance=1)
+    WeeklySummary.objects.filter(user__username=JOGGER_NAME).delete()
+
+    with pytest.raises(CommandError):
+        call_command("rebuild_weekly_summaries", check=True)
+
+    # Cached reports are invalidated by the rebuild
+    version = get_data_version(ALL_USERS)
+    call_command("rebuild_weekly_summaries")
+    assert get_data_version(ALL_USERS) != version
+
+    assert summary_values(SAMPLE_NAME) == [(VALID_WEEK, 3000, 180, 3, Decimal("1.0"))]
+    assert summary_values(JOGGER_NAME) == [(VALID_WEEK, 3000, 180, 3, Decimal("1.0"))]
+
+
+@pytest.mark.django_db
+def test_recompute_session_fields(populate_samples, tmp_path):
+
+    populate_samples
+    sessions = JoggingSession.objects.order_by("id")
+    expected = list(sessions.values_list("dn_speed", "dn_week"))
+    ids = list(sessions.values_list("id", flat=True))
+
+    # Corrupt derived values (and summaries) with queryset updates
+    sessions.filter(id__in=ids[:2]).update(dn_speed=0)
+    sessions.filter(id__in=ids[-2:]).update(dn_week=190001)
+    call_command("rebuild_weekly_summaries")
+
+    # Resume after the first session
+    checkpoint = tmp_path / "checkpoint"
+    checkpoint.write_text(str(ids[0]))
+    output = io.StringIO()
+    call_command(
+        "recompute_session_fields",
+        chunk_size=2,
+        checkpoint=str(checkpoint),
+        stdout=output,
+    )
+
+    assert "Checked %d sessions" % (len(ids) - 1) in output.getvalue()
+    assert "3 changed." in output.getvalue()
+    assert checkpoint.read_text() == str(ids[-1])
+    assert sessions.first().dn_speed == 0
+    assert list(sessions.values_list("dn_speed", "dn_week"))[1:] == expected[1:]
+    call_command("rebuild_weekly_summaries", check=True)
+
+    # Only changed sessions are updated
+    output = io.StringIO()
+    call_command("recompute_session_fields", stdout=output)
+
+    assert "Checked %d sessions" % len(ids) in output.getvalue()
+    assert "1 changed." in output.getvalue()
+    assert list(sessions.values_list("dn_speed", "dn_week")) == expected
+
+
+@pytest.mark.django_db
+def test_generate_sessions(monkeypatch):
+    def no_network(*args):
+        raise AssertionError("Weather was looked up.")
+
+    monkeypatch.setattr(weather_enrichment, "enqueue", no_network)
+
+    call_command(
+        "generate_sessions",
+        users=3,
+        sessions=50,
+        seed=1,
+        end=date(2020, 5, 31),
+        batch_size=100,
+        stdout=io.StringIO(),
+    )
+
+    sessions = JoggingSession.objects.filter(user__username__startswith="synthetic")
+    assert sessions.count() == 150
+    assert sessions.filter(dn_date__gt=date(2020, 5, 31)).count() == 0
+    assert sessions.exclude(lu_weather_location="").filter(lu_weather="").count() == 0
+    assert sessions.filter(lu_weather_pending=True).count() == 0
+
+    # Derived values and summaries are consistent
+    output = io.StringIO()
+    call_command("recompute_session_fields", stdout=output)
+    assert "0 changed." in output.getvalue()
+    call_command("rebuild_weekly_summaries", check=True)
+
+    with pytest.raises(CommandError):
+        call_command("generate_sessions", users=1, stdout=io.StringIO())
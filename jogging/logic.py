@@ -1,142 +1,633 @@
 # jogging/logic.py
 
+import functools
+import hashlib
+import json
+import math
+import operator
 import random
+import re
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
 
 import requests
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
 
 
 # == Custom filters ==
 
 
-CUSTOM_FILTER_OPERATORS = {
-    "eq": "==",
-    "ne": "!=",
-    "lt": "<",
-    "lte": "<=",
-    "gt": ">",
-    "gte": ">=",
-    "(": "(",
-    ")": ")",
+class FilterError(ValueError):
+    """A custom filter could not be parsed or applied to the available fields."""
+
+
+# Parsed filter nodes. `Name` is an unresolved identifier (usually a field name),
+# `Literal` is a quoted string or a number.
+Name = namedtuple("Name", "name")
+Literal = namedtuple("Literal", "value")
+Comparison = namedtuple("Comparison", "operator left right")
+BooleanOperation = namedtuple("BooleanOperation", "operator operands")
+
+COMPARISON_OPERATORS = ("eq", "ne", "lt", "lte", "gt", "gte")
+
+_TOKEN_PATTERN = re.compile(r"""\s*(?:([()])|('[^']*'|"[^"]*")|([^\s()'"]+))""")
+
+_MIRRORED_OPERATORS = {
+    "eq": "eq",
+    "ne": "ne",
+    "lt": "gt",
+    "lte": "gte",
+    "gt": "lt",
+    "gte": "lte",
 }
 
+_PYTHON_OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+}
+
+_LOOKUP_SUFFIXES = {
+    "eq": "exact",
+    "ne": "exact",  # negated
+    "lt": "lt",
+    "lte": "lte",
+    "gt": "gt",
+    "gte": "gte",
+}
 
-def _minimal_token_whitespace(raw_string):
+
+def _tokenize_custom_filter(filter_string):
     """
-    Buffer tokens with minimal whitespace. This makes splitting easy.
+    Split a filter into brackets, quoted strings and words. Quoted strings are
+    kept intact, including whitespace and brackets.
     """
 
-    # Add buffer around brackets
-    raw_string = raw_string.replace("(", " ( ").replace(")", " ) ").strip()
+    tokens = []
+    position = 0
+    filter_string = filter_string.rstrip()
 
-    # Reduce extraneous whitespace
-    while "  " in raw_string:
-        raw_string = raw_string.replace("  ", " ")
+    while position < len(filter_string):
+        match = _TOKEN_PATTERN.match(filter_string, position)
+        if match is None:
+            raise FilterError("Unterminated string in filter.")
 
-    return raw_string
+        bracket, quoted, word = match.groups()
+        if bracket is not None:
+            tokens.append(bracket)
+        elif quoted is not None:
+            tokens.append(Literal(quoted[1:-1]))
+        else:
+            tokens.append(word)
 
+        position = match.end()
 
-def _replace_tokens(token_list, replacement_map):
-    """Replace tokens with values from the replacement map, if they exist."""
+    return tokens
 
-    new_statement = []
-    for token in token_list:
-        new_statement.append(
-            replacement_map.get(token, str(token))
-        )  # if token is not recognised, use it as a value
 
-    return new_statement
+def _parse_operand(token):
+    """Interpret a single token as a literal, number or name."""
 
+    if isinstance(token, Literal):
+        return token
 
-def _populate_tokens(unpopulated_string, replacement_map):
-    """Populate a string with tokens from the replacement map."""
+    if token in ("(", ")", "and", "or") or token in COMPARISON_OPERATORS:
+        raise FilterError("Expected a field or value, found '%s'." % token)
+
+    try:
+        number = Decimal(token)
+    except InvalidOperation:
+        return Name(token)
+
+    if not number.is_finite():
+        return Name(token)
+    if number == number.to_integral_value() and "." not in token:
+        return Literal(int(number))
+
+    return Literal(number)
+
+
+class _FilterParser:
+    """
+    Recursive descent parser for the filter grammar:
+
+        expression := conjunction ("or" conjunction)*
+        conjunction := term ("and" term)*
+        term := "(" expression ")" | operand OPERATOR operand
+    """
 
-    unpopulated_tokens = _minimal_token_whitespace(unpopulated_string).split()
-    new_tokens = _replace_tokens(unpopulated_tokens, replacement_map)
-    return " ".join(new_tokens)
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
 
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
 
-def evaluate_custom_filter(filter_string, replacement_map):
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise FilterError("Unexpected end of filter.")
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise FilterError("Filter is empty.")
+
+        node = self._expression()
+        if self._peek() is not None:
+            raise FilterError("Unexpected token '%s'." % (self._peek(),))
+
+        return node
+
+    def _boolean(self, keyword, parse_operand):
+        operands = [parse_operand()]
+        while self._peek() == keyword:
+            self._next()
+            operands.append(parse_operand())
+
+        if len(operands) == 1:
+            return operands[0]
+
+        return BooleanOperation(keyword, tuple(operands))
+
+    def _expression(self):
+        return self._boolean("or", self._conjunction)
+
+    def _conjunction(self):
+        return self._boolean("and", self._term)
+
+    def _term(self):
+        if self._peek() == "(":
+            self._next()
+            node = self._expression()
+            if self._next() != ")":
+                raise FilterError("Missing closing bracket.")
+            return node
+
+        left = _parse_operand(self._next())
+        comparison = self._next()
+        if comparison not in COMPARISON_OPERATORS:
+            raise FilterError("Expected an operator, found '%s'." % (comparison,))
+        right = _parse_operand(self._next())
+
+        return Comparison(comparison, left, right)
+
+
+def parse_custom_filter(filter_string):
+    """
+    Parse a filter string into a tree of `BooleanOperation`, `Comparison`,
+    `Name` and `Literal` nodes. Raises `FilterError` if the filter is invalid.
+    """
+
+    return _FilterParser(_tokenize_custom_filter(filter_string)).parse()
+
+
+def _coerce_literal(value, kind):
+    """
+    Convert a literal to the Python type of a field kind ("integer", "decimal",
+    "text" or "datetime"). Returns `None` if the types are incomparable.
+    """
+
+    is_number = isinstance(value, (int, Decimal))
+
+    if kind in ("integer", "decimal"):
+        return value if is_number else None
+
+    if kind == "text":
+        return None if is_number else value
+
+    if kind == "datetime":
+        if is_number:
+            return None
+        try:
+            timestamp = datetime.fromisoformat(value)
+        except ValueError:
+            raise FilterError("Invalid date or time '%s'." % value)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp
+
+    raise FilterError("Unknown field kind '%s'." % kind)
+
+
+_ALWAYS = Q(pk__isnull=False)
+_NEVER = Q(pk__isnull=True)
+
+# A year, month, day or hour, without the rest of a timestamp
+_PARTIAL_TIMESTAMP_PATTERN = re.compile(
+    r"^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}))?)?)?$"
+)
+
+
+def _partial_timestamp(value):
+    """
+    The start of the period in a partial timestamp ("2020", "2020-02",
+    "2020-02-19" or "2020-02-19T11"), or `None` for other values.
+    """
+
+    match = _PARTIAL_TIMESTAMP_PATTERN.match(value)
+    if match is None:
+        return None
+
+    year, month, day, hour = (
+        int(part or default) for part, default in zip(match.groups(), ("", 1, 1, 0))
+    )
 
-    new_statement = _populate_tokens(filter_string, replacement_map)
-    # evaluate final statement
     try:
-        return eval(new_statement)
-    except BaseException:
+        return datetime(year, month, day, hour, tzinfo=timezone.utc)
+    except ValueError:
+        raise FilterError("Invalid date or time '%s'." % value)
+
+
+def _q_for_partial_timestamp(comparison, lookup, start):
+    """
+    Compare a datetime field with a partial timestamp as the timestamps were once
+    compared, as strings ("yyyy-mm-ddThh:mm"): a partial timestamp is never equal
+    to a timestamp, and sorts before every timestamp in its period (from `start`).
+    """
+
+    if comparison == "eq":
+        return _NEVER
+    elif comparison == "ne":
+        return _ALWAYS
+    elif comparison in ("gt", "gte"):
+        return Q(**{"%s__gte" % lookup: start})
+    else:
+        return Q(**{"%s__lt" % lookup: start})
+
+
+def _q_for_mismatch(comparison):
+    """
+    Incomparable types are never equal, always unequal, and cannot be ordered.
+    """
+
+    if comparison == "eq":
+        return _NEVER
+    elif comparison == "ne":
+        return _ALWAYS
+
+    raise FilterError("Values cannot be ordered.")
+
+
+def _q_for_field(comparison, lookup, value):
+
+    if callable(lookup):
+        return lookup(comparison, value)
+
+    q = Q(**{"%s__%s" % (lookup, _LOOKUP_SUFFIXES[comparison]): value})
+    return ~q if comparison == "ne" else q
+
+
+def _q_for_integer(comparison, lookup, value):
+    """Compare an integer field with a number that may have a fractional part."""
+
+    if value == int(value):
+        return _q_for_field(comparison, lookup, int(value))
+
+    if comparison in ("eq", "ne"):
+        return _q_for_mismatch(comparison)
+
+    # An integer is below 1.5 if it is at most 1, and above 1.5 if it is above 1
+    if comparison in ("lt", "lte"):
+        return _q_for_field("lte", lookup, math.floor(value))
+    else:
+        return _q_for_field("gt", lookup, math.floor(value))
+
+
+def _q_for_comparison(node, fields):
+
+    comparison, left, right = node
+
+    for operand in (left, right):
+        if isinstance(operand, Name) and operand.name not in fields:
+            raise FilterError("Unknown field '%s'." % operand.name)
+
+    # Compare two constants
+    if isinstance(left, Literal) and isinstance(right, Literal):
+        try:
+            matches = _PYTHON_OPERATORS[comparison](left.value, right.value)
+        except TypeError:
+            return _q_for_mismatch(comparison)
+        return _ALWAYS if matches else _NEVER
+
+    # Ensure the field is on the left
+    if isinstance(left, Literal):
+        comparison = _MIRRORED_OPERATORS[comparison]
+        left, right = right, left
+
+    lookup, kind = fields[left.name]
+
+    # Compare two fields
+    if isinstance(right, Name):
+        right_lookup, right_kind = fields[right.name]
+        if callable(lookup) or callable(right_lookup):
+            raise FilterError("Only values can be compared with '%s'." % left.name)
+        if kind != right_kind and {kind, right_kind} != {"integer", "decimal"}:
+            return _q_for_mismatch(comparison)
+        return _q_for_field(comparison, lookup, F(right_lookup))
+
+    # Compare a field and a constant
+    if kind == "datetime" and isinstance(right.value, str):
+        start = _partial_timestamp(right.value)
+        if start is not None:
+            return _q_for_partial_timestamp(comparison, lookup, start)
+
+    value = _coerce_literal(right.value, kind)
+
+    if value is None:
+        return _q_for_mismatch(comparison)
+    elif kind == "integer":
+        return _q_for_integer(comparison, lookup, value)
+    else:
+        return _q_for_field(comparison, lookup, value)
+
+
+def _q_for_node(node, fields):
+
+    if isinstance(node, Comparison):
+        return _q_for_comparison(node, fields)
+
+    if isinstance(node, BooleanOperation):
+        combined = None
+        for operand in node.operands:
+            q = _q_for_node(operand, fields)
+            if combined is None:
+                combined = q
+            elif node.operator == "and":
+                combined &= q
+            else:
+                combined |= q
+        return combined
+
+    raise FilterError("A filter must contain at least one comparison.")
+
+
+def compile_custom_filter_q(filter_string, fields):
+    """
+    Compile a filter string into a `Q` object, so that filtering is performed
+    by the database. `fields` maps each filter field to a `(lookup, kind)`
+    pair, e.g. `{"speed": ("dn_speed", "decimal")}`. Raises `FilterError` if
+    the filter is invalid.
+
+    For derived values, the lookup may instead be a function of `(comparison,
+    value)` that returns a `Q`. It is only called for comparisons with values,
+    e.g. `role eq 'staff'` calls `lookup("eq", "staff")`.
+    """
+
+    return _q_for_node(parse_custom_filter(filter_string), fields)
+
+
+CUSTOM_FILTER_CACHE_SIZE = 256
+
+
+def _compile_comparison(node, fields):
+
+    compare = _PYTHON_OPERATORS[node.operator]
+    left, right = node.left, node.right
+
+    for operand in (left, right):
+        if isinstance(operand, Name) and operand.name not in fields:
+            raise FilterError("Unknown field '%s'." % operand.name)
+
+    if isinstance(left, Name) and isinstance(right, Literal):
+        name, value = left.name, right.value
+        return lambda record: compare(record[name], value)
+
+    if isinstance(left, Literal) and isinstance(right, Name):
+        value, name = left.value, right.name
+        return lambda record: compare(value, record[name])
+
+    if isinstance(left, Name) and isinstance(right, Name):
+        left_name, right_name = left.name, right.name
+        return lambda record: compare(record[left_name], record[right_name])
+
+    try:
+        matches = compare(left.value, right.value)
+    except TypeError:
+        raise FilterError("Values cannot be ordered.")
+    return lambda record: matches
+
+
+def _compile_node(node, fields):
+
+    if isinstance(node, Comparison):
+        return _compile_comparison(node, fields)
+
+    operands = tuple(_compile_node(operand, fields) for operand in node.operands)
+
+    if node.operator == "and":
+        return lambda record: all(operand(record) for operand in operands)
+    else:
+        return lambda record: any(operand(record) for operand in operands)
+
+
+@functools.lru_cache(maxsize=CUSTOM_FILTER_CACHE_SIZE)
+def compile_custom_filter(filter_string, fields):
+    """
+    Compile a filter string into a predicate over a record (a mapping of field
+    names to values), for filters that cannot be performed by the database.
+    `fields` is a tuple of the available field names. Raises `FilterError` once,
+    at compile time, if the filter is invalid.
+
+    Compiled filters are cached by filter string and fields. A record whose
+    values cannot be ordered as the filter requires does not match.
+    """
+
+    program = _compile_node(parse_custom_filter(filter_string), frozenset(fields))
+
+    def predicate(record):
+        try:
+            return program(record)
+        except TypeError:
+            return False
+
+    return predicate
+
+
+def evaluate_custom_filter(filter_string, record):
+    """
+    Evaluate a filter against a single record. An invalid filter matches nothing.
+    When filtering many records, use `compile_custom_filter` instead.
+    """
+
+    try:
+        predicate = compile_custom_filter(filter_string, tuple(sorted(record)))
+    except FilterError:
         return False
 
+    return predicate(record)
+
 
 # == Weather ==
 
 
-def get_weather(location, iso_timestamp):
+def get_fallback_weather(location, iso_timestamp):
     """
-    Get the recorded weather for this location and timestamp. If the value
-    cannot be retrieved for any reason, return an empty string.
+    The weather to record when it cannot be retrieved: an empty string, or random
+    weather in the debug environment.
     """
 
-    if location is None or location == "":
+    # in the debug environment, work around weather failures so we get nice results
+    if settings.DEBUG:
+        print("Generating random weather.")
+        random.seed(location + iso_timestamp)  # input-based seed for stable results
+        return random.choice(["CLEAR", "CLEAR", "CLOUDY", "PRECIPITATION"])
+    else:
         return ""
 
-    try:
-        return _get_weather_unsafe(location, iso_timestamp)
-    except BaseException as e:
-        print("Weather results failed: %s" % e)
 
-        # in the debug environment, work around weather failures so we get nice results
-        if settings.DEBUG:
-            print("Generating random weather." % e)
-            random.seed(location + iso_timestamp)  # input-based seed for stable results
-            return random.choice(["CLEAR", "CLEAR", "CLOUDY", "PRECIPITATION"])
-        else:
-            return ""
+# == Weather cache ==
+
+
+def normalise_location(location):
+    """Normalise case and whitespace, so "London, UK" matches "london,uk"."""
+
+    return re.sub(r"\s*,\s*", ",", " ".join(location.lower().split()))
+
+
+_weather_cache_lock = threading.Lock()
+_weather_cache_counts = {"hits": 0, "misses": 0}
+
 
+def get_weather_cache_counts():
+    """Weather cache hits and misses since startup (or the last reset)."""
 
-def _get_weather_unsafe(location, iso_timestamp):
+    with _weather_cache_lock:
+        return dict(_weather_cache_counts)
+
+
+def reset_weather_cache_counts():
+
+    with _weather_cache_lock:
+        for outcome in _weather_cache_counts:
+            _weather_cache_counts[outcome] = 0
+
+
+def _count_weather_cache(outcome):
+
+    with _weather_cache_lock:
+        _weather_cache_counts[outcome] += 1
+
+
+def _get_cached_weather_batch(keys):
     """
-    Query the weather.visualcrossing.com API for the recorded weather
-    for this location and timestamp. Exceptions are not caught.
+    Cached weather for many keys. Returns a dict of key -> weather for fresh
+    entries, and a dict of key -> id for expired entries.
     """
 
-    # Construct query for weather.visualcrossing.com API
+    from .models import CachedWeather  # models import this module
+
+    keys = set(keys)
+    if not keys:
+        return {}, {}
 
-    timestamp = iso_timestamp[:-6]  # remove +00:00 (6 characters) from the end
+    now = datetime.now(timezone.utc)
+    candidates = CachedWeather.objects.filter(
+        location__in={location for location, day in keys},
+        date__in={day for location, day in keys},
+    )
+
+    weather_by_key = {}
+    stale_ids = {}
+
+    for cached in candidates:
+        key = (cached.location, cached.date)
+        if key not in keys:
+            continue
+        elif cached.is_fresh(now):
+            weather_by_key[key] = cached.weather
+        else:
+            stale_ids[key] = cached.id
+
+    with _weather_cache_lock:
+        _weather_cache_counts["hits"] += len(weather_by_key)
+        _weather_cache_counts["misses"] += len(keys) - len(weather_by_key)
+
+    return weather_by_key, stale_ids
+
+
+def _cache_weather_batch(weather_by_key, stale_ids):
+    """Cache weather for many keys, replacing expired entries."""
+
+    from .models import CachedWeather  # models import this module
+
+    fetched = datetime.now(timezone.utc)
+    entries = [
+        CachedWeather(location=location, date=day, weather=weather, fetched=fetched)
+        for (location, day), weather in weather_by_key.items()
+    ]
+    replaced_ids = [stale_ids[key] for key in weather_by_key if key in stale_ids]
+
+    with transaction.atomic():
+        CachedWeather.objects.filter(id__in=replaced_ids).delete()
+        CachedWeather.objects.bulk_create(
+            entries, ignore_conflicts=True  # entries cached by concurrent lookups
+        )
+
+
+def _weather_query_url(locations, start, end):
+    """URL for a history query (locations are separated by "|")."""
 
     path_parts = [
-        "http://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/weatherdata/history?goal=history",
+        settings.WEATHER_API_URL + "?goal=history",
         "aggregateHours=24",
-        "startDateTime={timestamp}",
-        "endDateTime={timestamp}",
+        "startDateTime={start}",
+        "endDateTime={end}",
         "contentType=json",
         "unitGroup=metric",
-        "locations={location}",
+        "locations={locations}",
         "key={key}",
     ]
 
     value_parts = {
-        "timestamp": timestamp,
-        "location": location,
+        "start": start,
+        "end": end,
+        "locations": locations,
         "key": settings.WEATHER_API_KEY,
     }
 
-    # Perform query and extract conditions
+    return "&".join(path_parts).format(**value_parts)
+
+
+def _raise_weather_error(result, exception):
+    """
+    Raise a `ValueError` describing a failed query, unless the failure was an
+    unknown location.
+    """
+
+    known_error = (
+        isinstance(result, dict)
+        and result.get("errorCode") is not None
+        and result.get("message") is not None
+    )
+
+    if known_error and result["message"].endswith("could not be found"):
+        return
+    elif known_error:
+        message = result["message"]
+    else:
+        message = str(exception)  # raise any other problems
+
+    raise ValueError(message)
 
-    try:
-        query_url = "&".join(path_parts).format(**value_parts)
-        result = requests.get(query_url).json()
-        conditions = result["locations"][location]["values"][0]["conditions"].lower()
-    except BaseException as e:
-        known_error = result["errorCode"] is not None and result["message"] is not None
-        if known_error and result["message"].endswith("could not be found"):
-            return ""  # return blank for unknown locations
-        elif known_error:
-            message = result["message"]
-        else:
-            message = str(e)  # raise any other problems
 
-        raise ValueError(message)
+def _summarise_conditions(conditions):
+    """Return simplified condition summary."""
 
-    # Return simplified condition summary
+    conditions = conditions.lower()
 
     summary = "OTHER"
     summary_options = {
@@ -151,3 +642,375 @@ def _get_weather_unsafe(location, iso_timestamp):
                 summary = key
 
     return summary
+
+
+# == Weather API client ==
+
+
+class WeatherUnavailableError(ValueError):
+    """The weather API is failing, or did not respond in time."""
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing service. After `threshold` consecutive failures the
+    breaker opens, and calls are refused. After `reset_after` seconds, a single
+    probe call is allowed (the breaker is half open): the breaker closes if the
+    probe succeeds, and opens again if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold, reset_after, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened = None
+
+    def allow(self):
+        """Return True if a call may be made now."""
+
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            elif self._state == self.OPEN:
+                if self.clock() - self._opened >= self.reset_after:
+                    self._state = self.HALF_OPEN
+                    return True  # this call is the probe
+            return False
+
+    def record_success(self):
+
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._opened = None
+
+    def record_failure(self):
+
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.threshold:
+                self._state = self.OPEN
+                self._opened = self.clock()
+
+    def state(self):
+        """The breaker state, for monitoring."""
+
+        with self._lock:
+            retry_in = None
+            if self._state == self.OPEN:
+                retry_in = max(0, self._opened + self.reset_after - self.clock())
+
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "retry_in": retry_in,
+            }
+
+
+_weather_client_lock = threading.Lock()
+_weather_http_session = None
+_weather_circuit_breaker = None
+
+
+def get_weather_http_session():
+    """The shared HTTP session for weather queries, which pools connections."""
+
+    global _weather_http_session
+
+    with _weather_client_lock:
+        if _weather_http_session is None:
+            adapter = HTTPAdapter(pool_maxsize=settings.WEATHER_HTTP_POOL_SIZE)
+            _weather_http_session = requests.Session()
+            _weather_http_session.mount("http://", adapter)
+            _weather_http_session.mount("https://", adapter)
+
+        return _weather_http_session
+
+
+def get_weather_circuit_breaker():
+    """The circuit breaker for weather queries."""
+
+    global _weather_circuit_breaker
+
+    with _weather_client_lock:
+        if _weather_circuit_breaker is None:
+            _weather_circuit_breaker = CircuitBreaker(
+                settings.WEATHER_BREAKER_THRESHOLD, settings.WEATHER_BREAKER_RESET
+            )
+
+        return _weather_circuit_breaker
+
+
+def _query_weather_api(url):
+    """
+    Perform a weather API query, returning the decoded JSON result. The query is
+    refused while the circuit breaker is open, and fails if it takes longer than
+    the lookup budget. Exceptions are not caught.
+    """
+
+    breaker = get_weather_circuit_breaker()
+    if not breaker.allow():
+        raise WeatherUnavailableError("Weather provider unavailable")
+
+    try:
+        result = _get_json_within_budget(url)
+    except BaseException:
+        breaker.record_failure()
+        raise
+
+    breaker.record_success()
+    return result
+
+
+def _get_json_within_budget(url):
+
+    budget = settings.WEATHER_LOOKUP_BUDGET
+    deadline = time.monotonic() + budget
+    timeout = (
+        min(settings.WEATHER_CONNECT_TIMEOUT, budget),
+        min(settings.WEATHER_READ_TIMEOUT, budget),
+    )
+
+    with get_weather_http_session().get(url, timeout=timeout, stream=True) as response:
+
+        # Error responses (e.g. unknown locations) are JSON, except server errors
+        if response.status_code >= 500:
+            raise WeatherUnavailableError(
+                "Weather provider error (HTTP %d)" % response.status_code
+            )
+
+        content = []
+        for chunk in response.iter_content(chunk_size=65536):
+            content.append(chunk)
+            if time.monotonic() > deadline:
+                raise WeatherUnavailableError("Weather query exceeded time budget")
+
+    return json.loads(b"".join(content))
+
+
+# == Batched weather ==
+
+
+WEATHER_RANGE_MAX_DAYS = 31  # days per range query
+WEATHER_RANGE_MAX_LOCATIONS = 10  # locations per range query
+
+WeatherQuery = namedtuple("WeatherQuery", "locations start end")
+
+
+def get_weather_batch(lookups, map_queries=map):
+    """
+    Get the recorded weather for many (location, UTC date) pairs, using the weather
+    cache and as few range queries to the weather API as possible. Returns a dict
+    of pair -> weather. Pairs that could not be looked up are left out, so that
+    they can be retried.
+
+    Queries are performed with `map_queries(function, queries)`, which may run
+    them concurrently (e.g. `ThreadPoolExecutor.map`).
+    """
+
+    results = {}
+    pairs_by_key = {}
+
+    for location, day in set(lookups):
+        if location is None or location == "":
+            results[(location, day)] = ""
+        else:
+            key = (normalise_location(location), day)
+            pairs_by_key.setdefault(key, []).append((location, day))
+
+    # Use cached weather where possible
+    weather_by_key, stale_ids = _get_cached_weather_batch(pairs_by_key.keys())
+
+    # Query the rest, using one of the original spellings of each location
+    query_locations = {}
+    dates_by_location = {}
+
+    for key in sorted(pairs_by_key.keys() - weather_by_key.keys()):
+        location, day = min(pairs_by_key[key])
+        query_locations.setdefault(key[0], location)
+        dates_by_location.setdefault(query_locations[key[0]], set()).add(day)
+
+    fetched = {}
+    queries = plan_weather_queries(dates_by_location)
+    while queries:
+        retry_queries = []
+        for query_results, split_queries in map_queries(_fetch_weather_range, queries):
+            for (location, day), weather in query_results.items():
+                fetched[(normalise_location(location), day)] = weather
+            retry_queries.extend(split_queries)
+        queries = retry_queries
+
+    _cache_weather_batch(fetched, stale_ids)
+    weather_by_key.update(fetched)
+
+    # Fan results back out to the original pairs
+    for key, weather in weather_by_key.items():
+        for pair in pairs_by_key.get(key, []):
+            results[pair] = weather
+
+    return results
+
+
+def plan_weather_queries(dates_by_location):
+    """
+    Group the dates needed for each location into the fewest range queries. The
+    dates for each location are covered by ranges of at most
+    `WEATHER_RANGE_MAX_DAYS` days (greedily, from the earliest date). Locations
+    with ranges starting on the same date share a query, which ends on the last
+    date needed by any of them.
+    """
+
+    last_dates = {}  # (range start, location) -> last date needed
+
+    for location, dates in dates_by_location.items():
+        start = None
+        for day in sorted(dates):
+            if start is None or (day - start).days >= WEATHER_RANGE_MAX_DAYS:
+                start = day
+            last_dates[(start, location)] = day
+
+    locations_by_start = {}
+    for (start, location), end in sorted(last_dates.items()):
+        locations_by_start.setdefault(start, []).append((location, end))
+
+    queries = []
+    for start, locations in locations_by_start.items():
+        for i in range(0, len(locations), WEATHER_RANGE_MAX_LOCATIONS):
+            chunk = locations[i : i + WEATHER_RANGE_MAX_LOCATIONS]
+            queries.append(
+                WeatherQuery(
+                    tuple(location for location, end in chunk),
+                    start,
+                    max(end for location, end in chunk),
+                )
+            )
+
+    return queries
+
+
+class UnknownLocationError(ValueError):
+    """The weather API could not find a location."""
+
+
+def _fetch_weather_range(query):
+    """
+    Perform a range query. Returns a dict of (location, date) -> weather, and a
+    list of queries to perform instead if the query has to be split. An unknown
+    location is reported as empty weather for every date; other failures are
+    printed and the query's pairs are left out.
+    """
+
+    try:
+        return get_weather_provider().get_weather_range(query), []
+    except UnknownLocationError:
+        if len(query.locations) == 1:
+            results = {
+                (query.locations[0], query.start + timedelta(days=days)): ""
+                for days in range((query.end - query.start).days + 1)
+            }
+            return results, []
+    except BaseException as e:
+        print("Weather results failed: %s" % e)
+        return {}, []
+
+    # Find the unknown location(s) by querying each location separately (through
+    # `map_queries`, so the queries are limited like any other)
+    return {}, [query._replace(locations=(location,)) for location in query.locations]
+
+
+def _get_weather_range_unsafe(query):
+    """
+    Query the weather.visualcrossing.com API for the recorded weather for one or
+    more locations over a range of dates. Exceptions are not caught.
+    """
+
+    start = query.start.isoformat() + "T00:00:00"
+    end = query.end.isoformat() + "T00:00:00"
+
+    result = None
+
+    try:
+        query_url = _weather_query_url("|".join(query.locations), start, end)
+        result = _query_weather_api(query_url)
+        values_by_location = {
+            location: result["locations"][location]["values"]
+            for location in query.locations
+        }
+    except BaseException as e:
+        _raise_weather_error(result, e)
+        raise UnknownLocationError(result["message"])
+
+    # One value per day; days missing from the response are left out
+    results = {}
+    for location, values in values_by_location.items():
+        for value in values:
+            day = date.fromisoformat(value["datetimeStr"][:10])
+            if query.start <= day <= query.end:
+                results[(location, day)] = _summarise_conditions(value["conditions"])
+
+    return results
+
+
+# == Weather providers ==
+
+
+class VisualCrossingWeatherProvider:
+    """
+    Weather from the weather.visualcrossing.com history API, or a compatible
+    server (see `WEATHER_API_URL` and `weather_stub.py`).
+
+    Providers look up weather for a range query (`get_weather_range`), returning
+    a dict of (location, date) -> weather. They raise `UnknownLocationError` for
+    unknown locations, and another exception for any other failure.
+    """
+
+    def get_weather_range(self, query):
+        return _get_weather_range_unsafe(query)
+
+
+class DeterministicWeatherProvider:
+    """
+    Weather generated in-process, for development, tests and benchmarks without a
+    network: a stable choice for each location and date, which does not vary
+    between processes or runs.
+    """
+
+    summaries = ["CLEAR", "CLEAR", "CLOUDY", "PRECIPITATION", "OTHER"]
+
+    def get_weather_range(self, query):
+
+        days = [
+            query.start + timedelta(days=days)
+            for days in range((query.end - query.start).days + 1)
+        ]
+
+        return {
+            (location, day): self.weather_for(normalise_location(location), day)
+            for location in query.locations
+            for day in days
+        }
+
+    def weather_for(self, location, day):
+        """The weather for a normalised location and date."""
+
+        seed = "%s|%s" % (location, day.isoformat())
+        digest = hashlib.sha256(seed.encode()).digest()
+        return self.summaries[digest[0] % len(self.summaries)]
+
+
+def get_weather_provider():
+    """The weather provider selected by the `WEATHER_PROVIDER` setting."""
+
+    return _load_weather_provider(settings.WEATHER_PROVIDER)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_weather_provider(path):
+    return import_string(path)()
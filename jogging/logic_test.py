@@ -1,55 +1,484 @@
+import json
+import time
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from urllib.parse import parse_qs, urlsplit
+
 import pytest
+from . import logic
 from .logic import (
-    _minimal_token_whitespace,
-    _replace_tokens,
+    BooleanOperation,
+    Comparison,
+    FilterError,
+    Literal,
+    Name,
+    CircuitBreaker,
+    DeterministicWeatherProvider,
+    VisualCrossingWeatherProvider,
+    WeatherQuery,
+    compile_custom_filter,
     evaluate_custom_filter,
-    get_weather,
+    get_weather_batch,
+    get_weather_cache_counts,
+    get_weather_circuit_breaker,
+    normalise_location,
+    parse_custom_filter,
+    plan_weather_queries,
+    reset_weather_cache_counts,
 )
+from .models import CachedWeather
+from .weather_stub import WeatherStubServer
 
 
 @pytest.mark.parametrize(
-    "input_string",
-    ["(test)", "( test )", " ( test ) ", "(  test  )", "  (       test     )   "],
+    "filter_string,target",
+    [
+        ("speed eq 1", Comparison("eq", Name("speed"), Literal(1))),
+        (
+            "(lu_weather_location ne 'New York,  US')",
+            Comparison("ne", Name("lu_weather_location"), Literal("New York,  US")),
+        ),
+        (
+            "a lt 1.5 or b gte 'x' and c eq d",
+            BooleanOperation(
+                "or",
+                (
+                    Comparison("lt", Name("a"), Literal(Decimal("1.5"))),
+                    BooleanOperation(
+                        "and",
+                        (
+                            Comparison("gte", Name("b"), Literal("x")),
+                            Comparison("eq", Name("c"), Name("d")),
+                        ),
+                    ),
+                ),
+            ),
+        ),
+    ],
 )
-def test_whitespace_management(input_string):
-
-    assert _minimal_token_whitespace(input_string) == "( test )"
+def test_parse_custom_filter(filter_string, target):
 
-
-TEST_REPLACEMENTS = {"eq": "==", "ne": "!="}
+    assert parse_custom_filter(filter_string) == target
 
 
 @pytest.mark.parametrize(
-    "raw_string,replacements,target", [("2 ne 3", TEST_REPLACEMENTS, "2 != 3")]
+    "filter_string",
+    ["", "speed", "speed eq", "speed eq 1 and", "(speed eq 1", "speed eq 'x", "a b c"],
 )
-def test_token_population(raw_string, replacements, target):
+def test_parse_invalid_custom_filter(filter_string):
+
+    with pytest.raises(FilterError):
+        parse_custom_filter(filter_string)
+
 
-    raw_list = raw_string.split()
-    result = " ".join(_replace_tokens(raw_list, replacements))
-    assert result == target
+TEST_RECORD = {"name": "alice", "speed": Decimal("1.5"), "week": 202008}
 
 
 @pytest.mark.parametrize(
-    "raw_string,replacements,target", [("2 ne 3", TEST_REPLACEMENTS, True)]
+    "filter_string,target",
+    [
+        ("name eq 'alice' and speed gt 1", True),
+        ("name eq 'bob' or (speed lte 1.5 and week eq 202008)", True),
+        ("1 lt speed and speed lt week", True),
+        ("2 ne 3", True),
+        ("2 eq 3", False),
+        ("name ne 3", True),  # incomparable values are never equal
+        ("name gt 3", False),  # incomparable values cannot be ordered
+        ("unknown eq 1", False),
+        ("name eq", False),
+    ],
 )
-def test_token_evaluation(raw_string, replacements, target):
+def test_record_evaluation(filter_string, target):
+
+    assert evaluate_custom_filter(filter_string, TEST_RECORD) is target
+
+
+def test_compiled_filter_is_cached():
+
+    fields = ("name", "speed")
+    predicate = compile_custom_filter("speed gte 1.5", fields)
+
+    assert compile_custom_filter("speed gte 1.5", fields) is predicate
+    assert predicate({"name": "bob", "speed": 2}) is True
+    assert predicate({"name": "bob", "speed": 1}) is False
 
-    assert evaluate_custom_filter(raw_string, replacements) is target
+    with pytest.raises(FilterError):
+        compile_custom_filter("week eq 1", fields)
 
 
 @pytest.mark.parametrize(
-    "location,iso_timestamp,target",
+    "location,target",
     [
-        (None, "2010-10-10T10:10:10+00:00", ""),
-        ("", "2010-10-10T10:10:10+00:00", ""),
-        ("sdfhsdfhsdkfjhdskfhd", "2010-10-10T10:10:10+00:00", ""),
-        ("London,UK", "sdfjkhsdkfhdkf", ""),
-        ("London,UK", "2010-10-10T10:10:10+00:00", "NOTBLANK"),
+        ("London,UK", "london,uk"),
+        ("  London ,  United   Kingdom ", "london,united kingdom"),
+        ("NEW YORK, US", "new york,us"),
     ],
 )
-def test_get_weather(location, iso_timestamp, target):
+def test_normalise_location(location, target):
+    assert normalise_location(location) == target
+
+
+def test_plan_weather_queries(monkeypatch):
+
+    monkeypatch.setattr(logic, "WEATHER_RANGE_MAX_DAYS", 7)
+    monkeypatch.setattr(logic, "WEATHER_RANGE_MAX_LOCATIONS", 2)
+
+    def days(*numbers):
+        return {date(2020, 2, number) for number in numbers}
+
+    queries = plan_weather_queries(
+        {
+            "London,UK": days(1, 3, 7, 8, 20),
+            "Paris,FR": days(1, 2, 7),
+            "Oslo,NO": days(5, 1),
+            "Rome,IT": days(20),
+        }
+    )
+
+    assert queries == [
+        WeatherQuery(("London,UK", "Oslo,NO"), date(2020, 2, 1), date(2020, 2, 7)),
+        WeatherQuery(("Paris,FR",), date(2020, 2, 1), date(2020, 2, 7)),
+        WeatherQuery(("London,UK",), date(2020, 2, 8), date(2020, 2, 8)),
+        WeatherQuery(("London,UK", "Rome,IT"), date(2020, 2, 20), date(2020, 2, 20)),
+    ]
+
+
+class FakeWeatherResponse:
+    def __init__(self, result, status_code=200, delay=0):
+        self.content = json.dumps(result).encode()
+        self.status_code = status_code
+        self.delay = delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), 10):
+            time.sleep(self.delay)
+            yield self.content[i : i + 10]
+
+
+class FakeWeatherSession:
+    """Stands in for the weather HTTP session, answering queries with `respond`."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = 0
+
+    def get(self, url, timeout, stream):
+        self.calls += 1
+        return self.respond(url)
+
+
+@pytest.fixture
+def weather_session(monkeypatch, settings):
+    """Install a weather HTTP session and a fresh circuit breaker."""
+
+    def _weather_session(respond):
+        session = FakeWeatherSession(respond)
+        breaker = CircuitBreaker(
+            settings.WEATHER_BREAKER_THRESHOLD, settings.WEATHER_BREAKER_RESET
+        )
+        monkeypatch.setattr(logic, "_weather_http_session", session)
+        monkeypatch.setattr(logic, "_weather_circuit_breaker", breaker)
+        return session
+
+    return _weather_session
+
+
+@pytest.fixture
+def fake_weather_api(weather_session):
+    """
+    Replace the weather API with a stand-in that returns overcast weather for every
+    day of a range, and cannot find "Atlantis". Returns the queries made.
+    """
+
+    queries = []
+
+    def get(url):
+        query = {
+            name: values[0] for name, values in parse_qs(urlsplit(url).query).items()
+        }
+        locations = query["locations"].split("|")
+        start = date.fromisoformat(query["startDateTime"][:10])
+        end = date.fromisoformat(query["endDateTime"][:10])
+        queries.append((locations, start, end))
+
+        if "Atlantis" in locations:
+            return FakeWeatherResponse(
+                {"errorCode": 999, "message": "Atlantis could not be found"}
+            )
+
+        values = [
+            {
+                "datetimeStr": (start + timedelta(days=days)).isoformat()
+                + "T00:00:00+01:00",
+                "conditions": "Overcast",
+            }
+            for days in range((end - start).days + 1)
+        ]
+        return FakeWeatherResponse(
+            {"locations": {location: {"values": values} for location in locations}}
+        )
+
+    weather_session(get)
+    reset_weather_cache_counts()
+    return queries
+
+
+@pytest.mark.django_db
+def test_get_weather_batch(fake_weather_api):
+
+    lookups = [
+        ("London,UK", date(2020, 2, 19)),
+        ("London,UK", date(2020, 2, 21)),
+        ("london, uk", date(2020, 2, 21)),
+        ("Paris,FR", date(2020, 2, 19)),
+        ("Paris,FR", date(2020, 2, 21)),
+        ("Atlantis", date(2020, 2, 19)),
+        ("", date(2020, 2, 19)),
+    ]
+    expected = {lookup: "CLOUDY" for lookup in lookups}
+    expected.update({("Atlantis", date(2020, 2, 19)): "", ("", date(2020, 2, 19)): ""})
+
+    assert get_weather_batch(lookups) == expected
+
+    # One range query for all locations. It fails because of the unknown location,
+    # so it is repeated for each location to find the unknown location.
+    assert fake_weather_api == [
+        (["Atlantis", "London,UK", "Paris,FR"], date(2020, 2, 19), date(2020, 2, 21)),
+        (["Atlantis"], date(2020, 2, 19), date(2020, 2, 21)),
+        (["London,UK"], date(2020, 2, 19), date(2020, 2, 21)),
+        (["Paris,FR"], date(2020, 2, 19), date(2020, 2, 21)),
+    ]
+
+    # Results are cached, including the dates between those requested
+    fake_weather_api.clear()
+    lookups.append(("Paris,FR", date(2020, 2, 20)))
+    expected[("Paris,FR", date(2020, 2, 20))] = "CLOUDY"
+
+    assert get_weather_batch(lookups) == expected
+    assert fake_weather_api == []
+
+
+@pytest.mark.django_db
+def test_weather_cache(fake_weather_api):
+    def lookup(location, day):
+        return get_weather_batch([(location, day)])[(location, day)]
+
+    # Historical weather is looked up once per location and date
+    assert lookup("London,UK", date(2010, 10, 10)) == "CLOUDY"
+    assert lookup("london, uk", date(2010, 10, 10)) == "CLOUDY"
+    assert lookup("London,UK", date(2010, 10, 11)) == "CLOUDY"
+
+    # Unknown locations are cached too
+    assert lookup("Atlantis", date(2010, 10, 10)) == ""
+    assert lookup("Atlantis", date(2010, 10, 10)) == ""
+
+    assert len(fake_weather_api) == 3
+    assert get_weather_cache_counts() == {"hits": 2, "misses": 3}
+    assert CachedWeather.objects.get(location="atlantis").weather == ""
+
+
+@pytest.mark.django_db
+def test_weather_cache_expiry(fake_weather_api):
+
+    now = datetime.now(timezone.utc)
+    long_ago = now - timedelta(days=365)
+
+    def cache(location, day, weather, fetched):
+        CachedWeather.objects.create(
+            location=location, date=day, weather=weather, fetched=fetched
+        )
+
+    def lookup(location, day):
+        return get_weather_batch([(location, day)])[(location, day)]
+
+    # Weather for days that had ended when fetched is kept permanently
+    cache("london,uk", date(2010, 10, 10), "CLEAR", long_ago)
+    assert lookup("London,UK", date(2010, 10, 10)) == "CLEAR"
+
+    # Weather for days that had not ended expires
+    cache("paris,fr", now.date(), "CLEAR", now - timedelta(hours=2))
+    assert lookup("Paris,FR", now.date()) == "CLOUDY"
+
+    # Unknown locations expire
+    cache("atlantis", date(2010, 10, 10), "", long_ago)
+    assert lookup("Atlantis", date(2010, 10, 10)) == ""
+
+    assert len(fake_weather_api) == 2
+    assert get_weather_cache_counts() == {"hits": 1, "misses": 2}
+    assert CachedWeather.objects.get(location="paris,fr").weather == "CLOUDY"
+
+
+def test_circuit_breaker():
+
+    now = [0]
+    breaker = CircuitBreaker(threshold=2, reset_after=30, clock=lambda: now[0])
+
+    # Opens after consecutive failures
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert not breaker.allow()
+    assert breaker.state() == {
+        "state": "open",
+        "consecutive_failures": 2,
+        "retry_in": 30,
+    }
+
+    # Allows one probe after the reset time, and opens again if it fails
+    now[0] = 30
+    assert breaker.allow()
+    assert not breaker.allow()
+    assert breaker.state()["state"] == "half-open"
+
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    # Closes if the probe succeeds
+    now[0] = 60
+    assert breaker.allow()
+    breaker.record_success()
+
+    assert breaker.allow()
+    assert breaker.state() == {
+        "state": "closed",
+        "consecutive_failures": 0,
+        "retry_in": None,
+    }
+
+
+@pytest.mark.django_db
+def test_weather_queries_stop_while_provider_fails(weather_session, settings):
+
+    settings.WEATHER_BREAKER_THRESHOLD = 3
+
+    def respond(url):
+        return FakeWeatherResponse({}, status_code=503)
+
+    session = weather_session(respond)
+
+    # Failed lookups are left out of the results, so they can be retried later
+    for day in range(1, 10):
+        assert get_weather_batch([("London,UK", date(2010, 10, day))]) == {}
+
+    assert session.calls == 3
+    assert get_weather_circuit_breaker().state()["state"] == "open"
+
+
+@pytest.mark.django_db
+def test_weather_query_budget(weather_session, settings):
+
+    settings.WEATHER_LOOKUP_BUDGET = 0.05
+
+    def respond(url):
+        value = {"datetimeStr": "2010-10-10T00:00:00+01:00", "conditions": "Clear"}
+        result = {"locations": {"London,UK": {"values": [value]}}}
+        return FakeWeatherResponse(result, delay=0.01)
+
+    weather_session(respond)
+    provider = VisualCrossingWeatherProvider()
+    query = WeatherQuery(("London,UK",), date(2010, 10, 10), date(2010, 10, 10))
+
+    with pytest.raises(ValueError, match="time budget"):
+        provider.get_weather_range(query)
+
+    settings.WEATHER_LOOKUP_BUDGET = 10
+    assert provider.get_weather_range(query) == {
+        ("London,UK", date(2010, 10, 10)): "CLEAR"
+    }
+
+
+def test_deterministic_weather_provider():
+
+    provider = DeterministicWeatherProvider()
+    query = WeatherQuery(("London,UK", "Paris,FR"), date(2020, 2, 1), date(2020, 2, 28))
+    results = provider.get_weather_range(query)
+
+    assert len(results) == 2 * 28
+    assert set(results.values()) <= {"CLEAR", "CLOUDY", "PRECIPITATION", "OTHER"}
+    assert len(set(results.values())) > 1
+
+    # The weather is the same for any spelling of the location
+    for (location, day), weather in results.items():
+        assert (
+            provider.weather_for(normalise_location(location.upper()), day) == weather
+        )
+
+
+@pytest.mark.django_db
+def test_weather_provider_setting(settings, monkeypatch):
+
+    settings.WEATHER_PROVIDER = "jogging.logic.DeterministicWeatherProvider"
+    monkeypatch.setattr(logic, "_get_weather_range_unsafe", None)  # no network
+
+    weather = DeterministicWeatherProvider().weather_for(
+        "london,uk", date(2010, 10, 10)
+    )
+    assert get_weather_batch([("London,UK", date(2010, 10, 10))]) == {
+        ("London,UK", date(2010, 10, 10)): weather
+    }
+
+
+@pytest.fixture
+def weather_stub(monkeypatch, settings):
+    """
+    Start a weather stub server, and use it with a new HTTP session and circuit
+    breaker.
+    """
+
+    server = WeatherStubServer(unknown_locations=["Atlantis"], seed=1)
+    server.start()
+
+    settings.WEATHER_API_URL = server.url
+    monkeypatch.setattr(logic, "_weather_http_session", None)
+    monkeypatch.setattr(logic, "_weather_circuit_breaker", None)
+    reset_weather_cache_counts()
+
+    yield server
+    server.stop()
+
+
+@pytest.mark.django_db
+def test_weather_stub_server(weather_stub):
+
+    provider = DeterministicWeatherProvider()
+    lookups = [
+        ("London,UK", date(2020, 2, 19)),
+        ("London,UK", date(2020, 3, 1)),
+        ("Paris,FR", date(2020, 2, 20)),
+        ("Atlantis", date(2020, 2, 20)),
+    ]
+    expected = {
+        (location, day): provider.weather_for(normalise_location(location), day)
+        for location, day in lookups
+    }
+    expected[("Atlantis", date(2020, 2, 20))] = ""
+
+    assert get_weather_batch(lookups) == expected
+
+    # Unknown locations are found when queried alongside known ones
+    lookups = [("Paris,FR", date(2020, 2, 21)), ("Atlantis", date(2020, 2, 21))]
+    assert get_weather_batch(lookups) == {
+        lookups[0]: provider.weather_for("paris,fr", date(2020, 2, 21)),
+        lookups[1]: "",
+    }
+
+
+@pytest.mark.django_db
+def test_weather_stub_server_errors(weather_stub):
+
+    weather_stub.error_rate = 1
+
+    query = WeatherQuery(("London,UK",), date(2020, 2, 19), date(2020, 2, 19))
+    with pytest.raises(ValueError, match="503"):
+        VisualCrossingWeatherProvider().get_weather_range(query)
 
-    if target == "":
-        assert get_weather(location, iso_timestamp) == ""
-    else:
-        assert get_weather(location, iso_timestamp) != ""
+    assert get_weather_batch([("London,UK", date(2020, 2, 19))]) == {}
@@ -0,0 +1,191 @@
+# jogging/management/commands/backfill_weather.py
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from jogging.caching import data_changed
+from jogging.logic import get_weather_batch
+from jogging.models import JoggingSession
+
+
+class RateLimiter:
+    """Space out calls, across threads, to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = time.monotonic()
+        self.calls = 0
+
+    def wait(self):
+
+        with self.lock:
+            now = time.monotonic()
+            call = max(now, self.next_call)
+            self.next_call = call + self.interval
+            self.calls += 1
+
+        time.sleep(call - now)
+
+    def limit(self, function):
+        """Wrap a function so that calls to it are limited."""
+
+        def limited(*args):
+            self.wait()
+            return function(*args)
+
+        return limited
+
+
+def sessions_without_weather(after=0):
+    """Sessions with a location but no weather, in primary key order."""
+
+    return (
+        JoggingSession.objects.filter(lu_weather="", id__gt=after)
+        .exclude(lu_weather_location="")
+        .order_by("id")
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Look up missing weather for sessions with a location, in chunks. Lookups "
+        "are cached, so an interrupted backfill can simply be run again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of concurrent weather queries.",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=5,
+            help="Maximum weather queries per second (0 for no limit).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of sessions to look up and update at a time.",
+        )
+        parser.add_argument(
+            "--after",
+            type=int,
+            default=0,
+            metavar="ID",
+            help="Only backfill sessions after this id (to resume from a chunk).",
+        )
+
+    def handle(self, *args, **options):
+
+        limiter = RateLimiter(options["rate"])
+        counts = {"sessions": 0, "updated": 0, "not_found": 0, "failed": 0}
+        started = time.perf_counter()
+        last_id = options["after"]
+
+        # Weather queries run in worker threads; the database is only used here
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+
+            def map_queries(fetch, queries):
+                return executor.map(limiter.limit(fetch), queries)
+
+            while True:
+                sessions = list(
+                    sessions_without_weather(last_id).only(
+                        "id", "user_id", "lu_weather_location", "dn_date",
+                    )[: options["chunk_size"]]
+                )
+
+                if not sessions:
+                    break
+
+                chunk_counts = self.backfill_chunk(sessions, map_queries)
+                last_id = sessions[-1].id
+
+                counts["sessions"] += len(sessions)
+                for outcome, count in chunk_counts.items():
+                    counts[outcome] += count
+
+                self.stdout.write(
+                    "Sessions up to id %d: %d updated, %d not found, %d failed."
+                    % (
+                        last_id,
+                        chunk_counts["updated"],
+                        chunk_counts["not_found"],
+                        chunk_counts["failed"],
+                    )
+                )
+
+        elapsed = time.perf_counter() - started
+        counts["queries"] = limiter.calls
+        counts["rate"] = counts["sessions"] / max(elapsed, 1e-6)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Checked %(sessions)d sessions with %(queries)d weather queries "
+                "(%(rate).1f sessions/s): %(updated)d updated, %(not_found)d not "
+                "found, %(failed)d failed." % counts
+            )
+        )
+
+    def backfill_chunk(self, sessions, map_queries):
+        """
+        Look up the weather for each distinct (location, date) in a chunk, and
+        store it. Returns the number of sessions updated, not found and failed.
+        Failed lookups are left empty, to be retried by a later backfill. The
+        weather is only stored if the session's location and date have not
+        changed during the lookup (as in `enrich_sessions`).
+        """
+
+        sessions_by_lookup = {}
+        for session in sessions:
+            lookup = (session.lu_weather_location, session.dn_date)
+            sessions_by_lookup.setdefault(lookup, []).append(session)
+
+        weather_by_lookup = get_weather_batch(
+            sessions_by_lookup.keys(), map_queries=map_queries
+        )
+
+        counts = {"updated": 0, "not_found": 0, "failed": 0}
+        user_ids = set()
+
+        with transaction.atomic():
+            for (location, day), lookup_sessions in sessions_by_lookup.items():
+                weather = weather_by_lookup.get((location, day))
+
+                if weather is None:
+                    counts["failed"] += len(lookup_sessions)
+                    continue
+
+                unchanged = JoggingSession.objects.filter(
+                    id__in=[session.id for session in lookup_sessions],
+                    lu_weather="",
+                    lu_weather_location=location,
+                    dn_date=day,
+                )
+
+                if weather == "":
+                    counts["not_found"] += len(lookup_sessions)
+                    updated = unchanged.filter(lu_weather_pending=True).update(
+                        lu_weather_pending=False
+                    )
+                else:
+                    updated = unchanged.update(
+                        lu_weather=weather, lu_weather_pending=False
+                    )
+                    counts["updated"] += updated
+
+                if updated:
+                    user_ids.update(session.user_id for session in lookup_sessions)
+
+            data_changed(user_ids)
+
+        return counts
@@ -0,0 +1,188 @@
+# jogging/management/commands/generate_sessions.py
+
+import math
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from jogging.caching import data_changed
+from jogging.logic import DeterministicWeatherProvider, normalise_location
+from jogging.models import JoggingSession, WeeklySummary, average_speed, calendar_week
+
+# Locations, with their timezone and (standard time) UTC offset in hours
+LOCATIONS = [
+    ("London,UK", "Europe/London", 0),
+    ("Paris,FR", "Europe/Paris", 1),
+    ("Berlin,DE", "Europe/Berlin", 1),
+    ("Madrid,ES", "Europe/Madrid", 1),
+    ("New York,US", "America/New_York", -5),
+    ("Sao Paulo,BR", "America/Sao_Paulo", -3),
+    ("Cape Town,ZA", "Africa/Johannesburg", 2),
+    ("Tokyo,JP", "Asia/Tokyo", 9),
+    ("Sydney,AU", "Australia/Sydney", 10),
+]
+
+SESSIONS_PER_WEEK = 3.5
+TRAVEL_RATE = 0.1  # sessions away from the user's home location
+NO_LOCATION_RATE = 0.1  # sessions without a location (and weather)
+
+
+class SessionGenerator:
+    """
+    Generate realistic, unsaved sessions without network access. Distances are
+    log-normal around 5 km, paces normal around 6 min/km, and sessions start in
+    the local morning or evening, on random days (at most one per day) up to the
+    end date. Weather comes from `DeterministicWeatherProvider`.
+    """
+
+    def __init__(self, seed=None, end=None):
+        self.random = random.Random(seed)
+        self.end = end or date.today()
+        self.weather = DeterministicWeatherProvider()
+
+    def user_sessions(self, user_id, count):
+
+        home = self.random.choice(LOCATIONS)
+        span = max(count, math.ceil(count * 7 / SESSIONS_PER_WEEK))
+        days = self.random.sample(range(span), count)
+
+        return [
+            self.session(user_id, self.end - timedelta(days=day), home) for day in days
+        ]
+
+    def session(self, user_id, day, home):
+
+        rng = self.random
+
+        distance = int(min(max(rng.lognormvariate(math.log(5000), 0.5), 500), 42195))
+        distance -= distance % 10
+        pace = min(max(rng.gauss(6, 1), 3.5), 12)  # minutes per km
+        duration = max(round(distance / 1000 * pace), 1)
+
+        location, local_timezone, offset = (
+            home if rng.random() >= TRAVEL_RATE else rng.choice(LOCATIONS)
+        )
+        if rng.random() < NO_LOCATION_RATE:
+            location = ""
+
+        # Local morning or evening, kept on the same UTC day
+        hour = rng.gauss(7, 1) if rng.random() < 0.6 else rng.gauss(18.5, 1.5)
+        minutes = (round(hour * 60) - offset * 60) % (24 * 60)
+        start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(
+            minutes=minutes
+        )
+
+        weather = ""
+        if location:
+            weather = self.weather.weather_for(normalise_location(location), day)
+
+        return JoggingSession(
+            user_id=user_id,
+            distance=distance,
+            duration=duration,
+            dn_speed=average_speed(distance, duration),
+            dn_week=calendar_week(start),
+            dn_date=day,
+            start=start,
+            local_timezone=local_timezone,
+            lu_weather=weather,
+            lu_weather_location=location,
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate synthetic users and sessions, with realistic values, for load "
+        "tests. Sessions are inserted in bulk, without weather lookups."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users", type=int, default=100, help="Number of users to create."
+        )
+        parser.add_argument(
+            "--sessions", type=int, default=100, help="Number of sessions per user.",
+        )
+        parser.add_argument(
+            "--prefix",
+            default="synthetic",
+            help="Username prefix (usernames are the prefix and a number).",
+        )
+        parser.add_argument(
+            "--end",
+            type=date.fromisoformat,
+            default=None,
+            metavar="YYYY-MM-DD",
+            help="Date of the latest sessions (default today).",
+        )
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=20000,
+            help="Approximate number of sessions to insert per transaction.",
+        )
+
+    def handle(self, *args, **options):
+
+        users = get_user_model().objects
+        prefix = options["prefix"]
+
+        if users.filter(username__startswith=prefix).exists():
+            raise CommandError("Users named %s... already exist." % prefix)
+
+        generator = SessionGenerator(options["seed"], options["end"])
+        per_user = options["sessions"]
+        users_per_batch = min(max(options["batch_size"] // max(per_user, 1), 1), 500)
+        password = make_password(None)
+        started = time.perf_counter()
+        created = 0
+
+        for first in range(0, options["users"], users_per_batch):
+            numbers = range(first, min(first + users_per_batch, options["users"]))
+            usernames = ["%s%d" % (prefix, number) for number in numbers]
+
+            with transaction.atomic():
+                users.bulk_create(
+                    [
+                        get_user_model()(username=username, password=password)
+                        for username in usernames
+                    ]
+                )
+                user_ids = list(
+                    users.filter(username__in=usernames).values_list("id", flat=True)
+                )
+
+                sessions = []
+                for user_id in user_ids:
+                    sessions.extend(generator.user_sessions(user_id, per_user))
+
+                JoggingSession.objects.bulk_create(sessions)
+                data_changed(user_ids)
+                WeeklySummary.objects.bulk_create(
+                    WeeklySummary.summarise(
+                        JoggingSession.objects.filter(user_id__in=user_ids)
+                    )
+                )
+
+            created += len(sessions)
+            self.stdout.write(
+                "%d users, %d sessions (%.0f sessions/s)."
+                % (
+                    numbers.stop,
+                    created,
+                    created / max(time.perf_counter() - started, 1e-6),
+                )
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Created %d users and %d sessions in %.1f s."
+                % (options["users"], created, time.perf_counter() - started)
+            )
+        )
@@ -0,0 +1,87 @@
+# jogging/management/commands/rebuild_weekly_summaries.py
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from jogging.caching import data_changed
+from jogging.models import JoggingSession, WeeklySummary
+
+SUMMARY_FIELDS = (
+    "total_distance",
+    "total_duration",
+    "session_count",
+    "avg_speed",
+)
+
+
+def _summary_values(summaries):
+    """Map (user, week) to the comparable values of each summary."""
+
+    return {
+        (summary.user_id, summary.dn_week): tuple(
+            getattr(summary, field) for field in SUMMARY_FIELDS
+        )
+        for summary in summaries
+    }
+
+
+def find_summary_differences(sessions=None):
+    """
+    Compare stored weekly summaries with totals calculated from raw sessions.
+    Returns a list of human-readable differences (empty if in sync).
+    """
+
+    if sessions is None:
+        sessions = JoggingSession.objects.all()
+
+    expected = _summary_values(WeeklySummary.summarise(sessions))
+    stored = _summary_values(WeeklySummary.objects.all())
+
+    differences = []
+    for key in sorted(expected.keys() | stored.keys()):
+        if key not in stored:
+            differences.append("missing summary for user %s week %s" % key)
+        elif key not in expected:
+            differences.append("unexpected summary for user %s week %s" % key)
+        elif stored[key] != expected[key]:
+            differences.append(
+                "user %s week %s: stored %s, expected %s"
+                % (key + (stored[key], expected[key]))
+            )
+
+    return differences
+
+
+class Command(BaseCommand):
+    help = "Rebuild weekly summaries from raw sessions and verify the result."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only verify the stored summaries, do not rebuild them.",
+        )
+
+    def handle(self, *args, **options):
+
+        if not options["check"]:
+            with transaction.atomic():
+                user_ids = set(WeeklySummary.objects.values_list("user_id", flat=True))
+                WeeklySummary.objects.all().delete()
+                summaries = WeeklySummary.summarise(JoggingSession.objects.all())
+                WeeklySummary.objects.bulk_create(summaries, batch_size=1000)
+                data_changed(user_ids.union(summary.user_id for summary in summaries))
+
+            self.stdout.write("Rebuilt %d weekly summaries." % len(summaries))
+
+        differences = find_summary_differences()
+
+        for difference in differences:
+            self.stderr.write(difference)
+
+        if differences:
+            raise CommandError(
+                "%d weekly summaries do not match sessions." % len(differences)
+            )
+
+        self.stdout.write(self.style.SUCCESS("Weekly summaries match sessions."))
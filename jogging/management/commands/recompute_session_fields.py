@@ -0,0 +1,127 @@
+# jogging/management/commands/recompute_session_fields.py
+
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from jogging.caching import data_changed
+from jogging.models import JoggingSession, WeeklySummary, average_speed, calendar_week
+
+
+def recompute_chunk(after, chunk_size):
+    """
+    Recalculate the speed and calendar week of the next chunk of sessions after
+    an id, and store the values that differ. Weekly summaries are refreshed for
+    sessions that moved week. Returns the number of sessions checked and changed,
+    and the last id checked (None if there were no sessions).
+    """
+
+    rows = list(
+        JoggingSession.objects.filter(id__gt=after)
+        .order_by("id")
+        .values_list(
+            "id", "user_id", "distance", "duration", "start", "dn_speed", "dn_week"
+        )[:chunk_size]
+    )
+
+    if not rows:
+        return 0, 0, None
+
+    changed = []
+    user_ids = set()
+    summary_keys = set()
+
+    for id, user_id, distance, duration, start, dn_speed, dn_week in rows:
+        speed = average_speed(distance, duration)
+        week = calendar_week(start)
+
+        if (speed, week) != (dn_speed, dn_week):
+            changed.append(JoggingSession(id=id, dn_speed=speed, dn_week=week))
+            user_ids.add(user_id)
+
+        if week != dn_week:
+            summary_keys |= {(user_id, dn_week), (user_id, week)}
+
+    with transaction.atomic():
+        JoggingSession.objects.bulk_update(changed, ["dn_speed", "dn_week"])
+        WeeklySummary.refresh_many(summary_keys)
+        data_changed(user_ids)
+
+    return len(rows), len(changed), rows[-1][0]
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalculate the stored speed and calendar week of sessions, in chunks, "
+        "and update the sessions where they differ."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=2000,
+            help="Number of sessions to check and update at a time.",
+        )
+        parser.add_argument(
+            "--after",
+            type=int,
+            default=0,
+            metavar="ID",
+            help="Only check sessions after this id (to resume from a chunk).",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            metavar="FILE",
+            help=(
+                "Record the last id checked in this file after each chunk, and "
+                "resume after it if the file exists."
+            ),
+        )
+
+    def handle(self, *args, **options):
+
+        checkpoint = options["checkpoint"]
+        last_id = options["after"]
+
+        if checkpoint is not None and os.path.exists(checkpoint):
+            try:
+                with open(checkpoint) as f:
+                    last_id = int(f.read())
+            except ValueError:
+                raise CommandError("Invalid checkpoint file: %s" % checkpoint)
+
+            self.stdout.write("Resuming after id %d." % last_id)
+
+        counts = {"sessions": 0, "changed": 0}
+        started = time.perf_counter()
+
+        while True:
+            checked, changed, chunk_last_id = recompute_chunk(
+                last_id, options["chunk_size"]
+            )
+
+            if chunk_last_id is None:
+                break
+
+            last_id = chunk_last_id
+            counts["sessions"] += checked
+            counts["changed"] += changed
+
+            if checkpoint is not None:
+                with open(checkpoint, "w") as f:
+                    f.write(str(last_id))
+
+            self.stdout.write("Sessions up to id %d: %d changed." % (last_id, changed))
+
+        elapsed = time.perf_counter() - started
+        counts["rate"] = counts["sessions"] / max(elapsed, 1e-6)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Checked %(sessions)d sessions (%(rate).1f sessions/s): "
+                "%(changed)d changed." % counts
+            )
+        )
@@ -0,0 +1,51 @@
+# jogging/management/commands/run_weather_stub.py
+
+from django.core.management.base import BaseCommand
+
+from jogging.weather_stub import WeatherStubServer
+
+
+class Command(BaseCommand):
+    help = "Run a local stand-in for the weather history API."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8089)
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            help="Seconds to wait before answering each query.",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0,
+            help="Fraction of queries that fail with HTTP 503 (0 to 1).",
+        )
+        parser.add_argument(
+            "--unknown",
+            action="append",
+            default=[],
+            metavar="LOCATION",
+            help="A location that cannot be found (may be repeated).",
+        )
+
+    def handle(self, *args, **options):
+
+        server = WeatherStubServer(
+            (options["host"], options["port"]),
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            unknown_locations=options["unknown"],
+        )
+
+        self.stdout.write("Serving weather history at %s" % server.url)
+        self.stdout.write("Set WEATHER_API_URL=%s to use it." % server.url)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
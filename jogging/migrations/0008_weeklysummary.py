@@ -0,0 +1,76 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:24
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_weekly_summaries(apps, schema_editor):
+    JoggingSession = apps.get_model('jogging', 'JoggingSession')
+    WeeklySummary = apps.get_model('jogging', 'WeeklySummary')
+
+    totals = (
+        JoggingSession.objects.order_by('user', 'dn_week')
+        .values('user', 'dn_week')
+        .annotate(
+            total_distance=models.Sum('distance'),
+            total_duration=models.Sum('duration'),
+            session_count=models.Count('id'),
+        )
+    )
+
+    summaries = []
+    for row in totals:
+        if row['total_duration'] == 0:
+            avg_speed = Decimal('0.0')
+        else:
+            avg_speed = (
+                Decimal(3 * row['total_distance']) / Decimal(50 * row['total_duration'])
+            ).quantize(Decimal('1.0'))
+
+        summaries.append(
+            WeeklySummary(
+                user_id=row['user'],
+                dn_week=row['dn_week'],
+                total_distance=row['total_distance'],
+                total_duration=row['total_duration'],
+                session_count=row['session_count'],
+                avg_speed=avg_speed,
+            )
+        )
+
+    WeeklySummary.objects.bulk_create(summaries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('jogging', '0007_auto_20200604_0349'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeeklySummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dn_week', models.IntegerField(verbose_name='calendar week (yyyyww)')),
+                ('total_distance', models.IntegerField(verbose_name='total distance (meters)')),
+                ('total_duration', models.IntegerField(verbose_name='total duration (minutes)')),
+                ('session_count', models.IntegerField(verbose_name='number of sessions')),
+                ('avg_speed', models.DecimalField(decimal_places=1, max_digits=6, verbose_name='average speed (km/h)')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='weekly_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'weekly summaries',
+                'ordering': ('-dn_week', 'user'),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='weeklysummary',
+            constraint=models.UniqueConstraint(fields=('user', 'dn_week'), name='unique_weekly_summary'),
+        ),
+        migrations.RunPython(populate_weekly_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:40
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDate
+
+
+def populate_dn_date(apps, schema_editor):
+    JoggingSession = apps.get_model('jogging', 'JoggingSession')
+    JoggingSession.objects.update(dn_date=TruncDate('start'))
+
+
+def check_one_session_per_day(apps, schema_editor):
+    """
+    Sessions on the same day for the same user cannot be merged safely, so list
+    them to be resolved by hand before one session per day is enforced.
+    """
+
+    JoggingSession = apps.get_model('jogging', 'JoggingSession')
+    duplicate_days = (
+        JoggingSession.objects.values('user_id', 'dn_date')
+        .annotate(count=Count('id'))
+        .filter(count__gt=1)
+        .order_by('user_id', 'dn_date')
+    )
+
+    lines = []
+    for day in duplicate_days:
+        ids = JoggingSession.objects.filter(
+            user_id=day['user_id'], dn_date=day['dn_date']
+        ).order_by('id').values_list('id', flat=True)
+        lines.append(
+            'user %s on %s: sessions %s'
+            % (day['user_id'], day['dn_date'], ', '.join(map(str, ids)))
+        )
+
+    if lines:
+        raise RuntimeError(
+            'Users have more than one session per day. Delete or move sessions '
+            'so that each user has at most one session per day, then migrate '
+            'again:\n' + '\n'.join(lines)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jogging', '0008_weeklysummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='joggingsession',
+            name='dn_date',
+            field=models.DateField(blank=True, editable=False, null=True, verbose_name='calendar date (UTC)'),
+        ),
+        migrations.RunPython(populate_dn_date, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='joggingsession',
+            name='dn_date',
+            field=models.DateField(blank=True, editable=False, verbose_name='calendar date (UTC)'),
+        ),
+        migrations.RunPython(check_one_session_per_day, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='joggingsession',
+            constraint=models.UniqueConstraint(fields=('user', 'dn_date'), name='unique_session_per_day'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jogging', '0009_joggingsession_dn_date'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='joggingsession',
+            index=models.Index(fields=['user', '-start', 'id'], name='session_user_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='joggingsession',
+            index=models.Index(fields=['-start', 'id'], name='session_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='joggingsession',
+            index=models.Index(fields=['user', 'dn_week'], name='session_user_week_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='weeklysummary',
+            index=models.Index(fields=['-dn_week', 'user'], name='summary_week_user_idx'),
+        ),
+    ]
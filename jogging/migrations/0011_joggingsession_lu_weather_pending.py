@@ -0,0 +1,18 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jogging', '0010_session_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='joggingsession',
+            name='lu_weather_pending',
+            field=models.BooleanField(default=False, editable=False, verbose_name='weather lookup pending'),
+        ),
+    ]
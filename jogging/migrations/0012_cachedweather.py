@@ -0,0 +1,30 @@
+# Generated by Django 3.0.6 on 2026-10-18 11:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jogging', '0011_joggingsession_lu_weather_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedWeather',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location', models.TextField(verbose_name='location (normalised)')),
+                ('date', models.DateField(verbose_name='calendar date (UTC)')),
+                ('weather', models.TextField(blank=True, verbose_name='weather')),
+                ('fetched', models.DateTimeField(verbose_name='fetched (UTC)')),
+            ],
+            options={
+                'verbose_name_plural': 'cached weather',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='cachedweather',
+            constraint=models.UniqueConstraint(fields=('location', 'date'), name='unique_cached_weather'),
+        ),
+    ]
@@ -1,24 +1,42 @@
 # jogging/models.py
 
+import threading
+from contextlib import contextmanager
 from datetime import timedelta
 from decimal import Decimal
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, Sum, Value, When
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
 
-from .logic import get_weather, evaluate_custom_filter, CUSTOM_FILTER_OPERATORS
+from .caching import data_changed
+from .enrichment import weather_enrichment
+from .logic import FilterError, compile_custom_filter_q
 
 
 # == Sessions ==
 
 
+DUPLICATE_SESSION_MESSAGE = "Another session already exists for this user+day."
+
+
+def calendar_week(start):
+    """The ISO 8601 calendar week of a start time, as an integer (yyyyww)."""
+
+    iso_year, iso_week, iso_day = start.isocalendar()
+    return (iso_year * 100) + iso_week
+
+
 class JoggingSession(models.Model):
     """
-    A jogging session is defined for a particular user on a particular day. Speed and
-    calendar week are calculated and stored for convenience. Local weather is recorded
-    if possible. Users may optionally declare the local timezone.
+    A jogging session is defined for a particular user on a particular day. Speed,
+    calendar week and calendar date are calculated and stored for convenience. Local
+    weather is looked up in the background after saving, and recorded if possible.
+    Users may optionally declare the local timezone.
     """
 
     distance = models.IntegerField("distance (meters)")
@@ -32,9 +50,15 @@ class JoggingSession(models.Model):
     dn_week = models.IntegerField(
         "calendar week (yyyyww)", editable=False, default=0
     )  # ISO 8601, YYYYWW format
+    dn_date = models.DateField(
+        "calendar date (UTC)", editable=False, blank=True
+    )  # set in clean(), one session per user per date
     duration = models.IntegerField("duration (minutes)")
     local_timezone = models.TextField("local timezone (tzdb)", blank=True)
     lu_weather = models.TextField("weather", editable=False, blank=True)
+    lu_weather_pending = models.BooleanField(
+        "weather lookup pending", editable=False, default=False
+    )
     lu_weather_location = models.TextField(
         "location (for weather)", default="", blank=True
     )
@@ -47,6 +71,20 @@ class JoggingSession(models.Model):
 
     class Meta:
         ordering = ("-start", "id")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "dn_date"], name="unique_session_per_day"
+            )
+        ]
+        indexes = [
+            # session list, for one user and for all users
+            models.Index(
+                fields=["user", "-start", "id"], name="session_user_start_idx"
+            ),
+            models.Index(fields=["-start", "id"], name="session_start_idx"),
+            # weekly summary refresh and rebuild
+            models.Index(fields=["user", "dn_week"], name="session_user_week_idx"),
+        ]
 
     def __str__(self):
         return "%s %s" % (self.user, self.start.isoformat()[:-9])
@@ -59,15 +97,15 @@ class JoggingSession(models.Model):
         if not hasattr(self, "user") or self.user is None:
             raise ValidationError("User not defined.")
 
-        existing_sessions = JoggingSession.objects.exclude(id=self.id).filter(
-            start__year=self.start.year,
-            start__month=self.start.month,
-            start__day=self.start.day,
-            user=self.user,
-        )  # NB this is a chained .exclude().filter()
+        if self._same_day_sessions().exists():
+            raise ValidationError(DUPLICATE_SESSION_MESSAGE)
 
-        if len(existing_sessions) != 0:
-            raise ValidationError("Another session already exists for this user+day.")
+    def _same_day_sessions(self):
+        """Other sessions for this user on the same UTC calendar day."""
+
+        return JoggingSession.objects.exclude(id=self.id).filter(
+            user_id=self.user_id, dn_date=self.start.date()
+        )  # NB this is a chained .exclude().filter()
 
     def clean(self):
         """
@@ -89,102 +127,553 @@ class JoggingSession(models.Model):
             raise ValidationError("Timezone offset is not zero.")
 
         # Set speed
-        if self.duration == 0:
-            self.dn_speed = 0
-        else:
-            km = self.distance / 1000.0
-            hr = self.duration / 60.0
-            self.dn_speed = Decimal(km / hr).quantize(Decimal("1.0"))
+        self.dn_speed = average_speed(self.distance, self.duration)
 
         # Clean start time
         self.start = self.start.replace(second=0, microsecond=0)
 
-        # Set calendar week
-        iso_year, iso_week, iso_day = self.start.isocalendar()
-        self.dn_week = (iso_year * 100) + iso_week
+        # Set calendar week and date
+        self.dn_week = calendar_week(self.start)
+        self.dn_date = self.start.date()
 
-        # Look up weather
-        if self.lu_weather == "" and self.lu_weather_location != "":
-            self.lu_weather = get_weather(
-                self.lu_weather_location, self.start.isoformat()
-            )
+        # Look up weather after saving (see enrichment.py)
+        self.lu_weather_pending = (
+            self.lu_weather == "" and self.lu_weather_location != ""
+        )
 
     def save(self, *args, **kwargs):
         """
         Clean the object before saving. This is atypical in Django, but we perform
-        lots of code-based, rather than form-based, manipulations.
+        lots of code-based, rather than form-based, manipulations. The weekly
+        summaries for the session's previous and current week are kept in sync.
+
+        The database enforces one session per user per day. If a concurrent save
+        wins the race, the integrity error is reported as a `ValidationError`.
         """
 
         self.full_clean()
-        super().save(*args, **kwargs)
+
+        try:
+            self._save_and_summarise(*args, **kwargs)
+        except IntegrityError:
+            if self._same_day_sessions().exists():
+                raise ValidationError(DUPLICATE_SESSION_MESSAGE)
+            raise
+
+    def _save_and_summarise(self, *args, **kwargs):
+
+        with transaction.atomic():
+            previous_key = None
+            if self.pk is not None:
+                previous_key = (
+                    JoggingSession.objects.filter(pk=self.pk)
+                    .values_list("user_id", "dn_week")
+                    .first()
+                )
+
+            super().save(*args, **kwargs)
+
+            if self.lu_weather_pending:
+                session_ids = [self.id]
+                transaction.on_commit(lambda: weather_enrichment.enqueue(session_ids))
+
+            WeeklySummary.refresh(self.user_id, self.dn_week)
+            data_changed({self.user_id})
+            if previous_key is not None and previous_key != (
+                self.user_id,
+                self.dn_week,
+            ):
+                WeeklySummary.refresh(*previous_key)
+                data_changed({previous_key[0]})
+
+    @classmethod
+    def bulk_insert(cls, sessions):
+        """
+        Insert many new sessions, which must already be cleaned. Sessions that would
+        break the one session per user per day rule, with stored sessions or with
+        earlier sessions in the list, are skipped. Inserted sessions are given ids.
+        Weekly summaries are refreshed, and weather lookups are queued once the
+        insert is committed. Returns the inserted sessions.
+
+        The number of queries does not depend on the number of sessions (apart from
+        insert batches), and `save()` is not called.
+        """
+
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    return cls._bulk_insert(sessions)
+            except IntegrityError:
+                if attempt > 0:
+                    raise  # retry once, if a concurrent insert won the race
+
+    @classmethod
+    def _bulk_insert(cls, sessions):
+
+        days = {(session.user_id, session.dn_date) for session in sessions}
+        stored_days = cls._stored_days(days)
+
+        inserted = []
+        for session in sessions:
+            session.pk = None
+            day = (session.user_id, session.dn_date)
+            if day not in stored_days:
+                stored_days[day] = None
+                inserted.append(session)
+
+        cls.objects.bulk_create(inserted)
+
+        # Not all databases return ids from bulk inserts, so find them by day
+        stored_days = cls._stored_days(days)
+        for session in inserted:
+            session.pk = stored_days[(session.user_id, session.dn_date)]
+
+        WeeklySummary.refresh_many(
+            {(session.user_id, session.dn_week) for session in inserted}
+        )
+        data_changed({session.user_id for session in inserted})
+
+        session_ids = [session.pk for session in inserted if session.lu_weather_pending]
+        if session_ids:
+            transaction.on_commit(lambda: weather_enrichment.enqueue(session_ids))
+
+        return inserted
+
+    @classmethod
+    def bulk_change(cls, sessions, changes):
+        """
+        Change the distance, duration, local timezone and/or weather location of
+        all sessions in a queryset, with one set-based update. Speeds and weekly
+        summaries are recalculated, and weather is looked up again for a new
+        location. Returns the number of sessions changed.
+
+        Changing the distance or duration alone sets each speed with a CASE over
+        the distinct values of the other, so that speeds are rounded exactly as
+        `average_speed` rounds them.
+        """
+
+        changes = dict(changes)
+        session_ids = []
+
+        with transaction.atomic():
+            summary_keys = set(
+                sessions.order_by().values_list("user_id", "dn_week").distinct()
+            )
+
+            if "lu_weather_location" in changes:
+                changes["lu_weather"] = ""
+                changes["lu_weather_pending"] = changes["lu_weather_location"] != ""
+                if changes["lu_weather_pending"]:
+                    session_ids = list(sessions.values_list("id", flat=True))
+
+            if "distance" in changes and "duration" in changes:
+                changes["dn_speed"] = average_speed(
+                    changes["distance"], changes["duration"]
+                )
+            elif "distance" in changes or "duration" in changes:
+                changes["dn_speed"] = cls._speed_case(sessions, changes)
+
+            count = sessions.update(**changes)
+
+            if "distance" in changes or "duration" in changes:
+                WeeklySummary.refresh_many(summary_keys)
+
+            data_changed({user_id for user_id, dn_week in summary_keys})
+
+            if session_ids:
+                transaction.on_commit(lambda: weather_enrichment.enqueue(session_ids))
+
+        return count
+
+    @classmethod
+    def _speed_case(cls, sessions, changes):
+        """
+        An expression for the speed of sessions after changing only their distance
+        or only their duration, with a branch per resulting speed.
+        """
+
+        other = "duration" if "distance" in changes else "distance"
+        values_by_speed = {}
+
+        for value in sessions.order_by().values_list(other, flat=True).distinct():
+            speed = average_speed(
+                changes.get("distance", value), changes.get("duration", value)
+            )
+            values_by_speed.setdefault(speed, []).append(value)
+
+        return Case(
+            *[
+                When(**{other + "__in": values}, then=Value(speed))
+                for speed, values in sorted(values_by_speed.items())
+            ],
+            default=F("dn_speed"),
+            output_field=cls._meta.get_field("dn_speed"),
+        )
+
+    @classmethod
+    def bulk_delete(cls, sessions):
+        """
+        Delete all sessions in a queryset with one DELETE, and refresh the affected
+        weekly summaries together. Sessions are not loaded, so no signals are
+        sent. Returns the number of sessions deleted.
+        """
+
+        with transaction.atomic():
+            summary_keys = set(
+                sessions.order_by().values_list("user_id", "dn_week").distinct()
+            )
+            count = sessions.order_by()._raw_delete(sessions.db)
+
+            WeeklySummary.refresh_many(summary_keys)
+            data_changed({user_id for user_id, dn_week in summary_keys})
+
+        return count
+
+    @classmethod
+    def _stored_days(cls, days):
+        """Map each of these (user id, date) pairs with a stored session to its id."""
+
+        if not days:
+            return {}
+
+        dates = [date for user_id, date in days]
+        stored = cls.objects.filter(
+            user_id__in={user_id for user_id, date in days},
+            dn_date__range=(min(dates), max(dates)),
+        ).values_list("user_id", "dn_date", "id")
+
+        return {
+            (user_id, date): id
+            for user_id, date, id in stored
+            if (user_id, date) in days
+        }
 
     @classmethod
     def generate_user_report(cls, user_id=None, custom_filter=None):
+        """
+        Report total distance, total duration and average speed by week and user.
+        Totals are read from `WeeklySummary`, and the custom filter is applied by
+        the database.
+        """
 
         # Filter by user if required
         kwargs = {}
 
         if user_id is not None:
-            kwargs["user"] = get_user_model().objects.get(id=user_id)
-
-        sessions = cls.objects.filter(**kwargs).order_by("-dn_week", "user", "-start")
-
-        partial = {}
-
-        # Collate items by user and week
-        for item in sessions:
-            dn_week = item.dn_week
-            user_id = item.user.id
-            collation_key = (dn_week, user_id)
-            if collation_key not in partial.keys():
-                partial[collation_key] = []
-
-            partial[collation_key].append((item.distance, item.duration))
-
-        # Calculate average user speed by week.
-        # Note that this is total distance over total duration for recorded sessions,
-        # so missing/skipped days do not reduce the average.
-        calculation_result = {}
-        record_id = 0
-        for collation_key in partial.keys():
-            dn_week, user_id = collation_key
-            total_distance = 0
-            total_duration = 0
-            for distance, duration in partial[collation_key]:
-                total_distance += distance
-                total_duration += duration
-
-            km = total_distance / 1000.0
-            h = total_duration / 60.0
-            speed = Decimal(km / h).quantize(Decimal("1.0"))
-
-            record_id += 1
-            calculation_result[record_id] = {
+            kwargs["user_id"] = user_id
+
+        summaries = WeeklySummary.objects.filter(**kwargs)
+        weeks = summaries
+
+        # Records are numbered before filtering, so numbering is stable
+        record_ids = None
+
+        if custom_filter is not None:
+            try:
+                report_filter = compile_custom_filter_q(
+                    custom_filter, REPORT_FILTER_FIELDS
+                )
+            except FilterError:
+                return {}
+
+            weeks = weeks.filter(report_filter)
+            keys = summaries.values_list("dn_week", "user")
+            record_ids = {key: record_id for record_id, key in enumerate(keys, 1)}
+
+        result = {}
+        for record_id, week in enumerate(weeks, 1):
+
+            if record_ids is not None:
+                record_id = record_ids[(week.dn_week, week.user_id)]
+
+            result[record_id] = {
                 "record": record_id,
-                "user": user_id,
-                "week": dn_week,
-                "distance": total_distance,
-                "duration": total_duration,
-                "avg_speed": speed,
+                "user": week.user_id,
+                "week": week.dn_week,
+                "distance": week.total_distance,
+                "duration": week.total_duration,
+                "avg_speed": week.avg_speed,
             }
 
-        # If there is no custom filter, skip final pass
-        if custom_filter is None:
-            return calculation_result
+        return result
+
+
+# Summary keys collected by `WeeklySummary.refresh_deferred`, per thread
+_deferred_summaries = threading.local()
+
+# Users being deleted (with their sessions and summaries), per thread
+_deleting_users = threading.local()
 
-        # Perform final pass
-        final_result = {}
-        for key, item in calculation_result.items():
 
-            tokens = CUSTOM_FILTER_OPERATORS.copy()
+@receiver(post_delete, sender=JoggingSession)
+def _refresh_summary_after_delete(sender, instance, **kwargs):
+    """
+    Keep weekly summaries in sync when sessions are deleted, including queryset
+    and cascade deletes, which do not call `JoggingSession.delete`. There is
+    nothing to refresh when the user is being deleted too.
+    """
+
+    if instance.user_id in getattr(_deleting_users, "ids", ()):
+        return
+
+    keys = getattr(_deferred_summaries, "keys", None)
+    if keys is not None:
+        keys.add((instance.user_id, instance.dn_week))
+    else:
+        WeeklySummary.refresh(instance.user_id, instance.dn_week)
+        data_changed({instance.user_id})
+
+
+# == Users ==
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def _note_user_deleting(sender, instance, **kwargs):
+    """Sessions are deleted (in cascade) before the user, see above."""
+
+    if not hasattr(_deleting_users, "ids"):
+        _deleting_users.ids = set()
+
+    _deleting_users.ids.add(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def _invalidate_responses_after_user_change(sender, instance, **kwargs):
+    """Users are listed with their sessions, see `data_changed`."""
+
+    if kwargs["signal"] is post_delete:
+        _deleting_users.ids.discard(instance.pk)
+
+    data_changed({instance.pk})
+
+
+# == Reports ==
+
+
+def average_speed(distance, duration):
+    """
+    Average speed (km/h) for a distance (meters) and duration (minutes), rounded
+    half to even to one decimal place. The speed is zero if there is no duration.
+    """
+
+    if duration == 0:
+        return Decimal("0.0")
+
+    # (distance / 1000) / (duration / 60) == (3 * distance) / (50 * duration)
+    return (Decimal(3 * distance) / Decimal(50 * duration)).quantize(Decimal("1.0"))
+
+
+class WeeklySummary(models.Model):
+    """
+    Session totals for a particular user in a particular calendar week. This is a
+    denormalised table: it is updated whenever sessions are saved or deleted, and
+    can be rebuilt at any time with the `rebuild_weekly_summaries` command.
 
-            tokens["user"] = str(item["user"])
-            tokens["week"] = str(item["week"])
-            tokens["distance"] = str(item["distance"])
-            tokens["duration"] = str(item["duration"])
-            tokens["avg_speed"] = str(item["avg_speed"])
+    Note that the average speed is total distance over total duration for recorded
+    sessions, so missing/skipped days do not reduce the average.
+    """
 
-            if evaluate_custom_filter(custom_filter, tokens):
-                final_result[key] = item.copy()
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name="weekly_summaries",
+        on_delete=models.CASCADE,
+    )
+    dn_week = models.IntegerField("calendar week (yyyyww)")
+    total_distance = models.IntegerField("total distance (meters)")
+    total_duration = models.IntegerField("total duration (minutes)")
+    session_count = models.IntegerField("number of sessions")
+    avg_speed = models.DecimalField(
+        "average speed (km/h)", decimal_places=1, max_digits=6
+    )  # zero-duration sessions can push the average above any session speed
+
+    class Meta:
+        ordering = ("-dn_week", "user")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "dn_week"], name="unique_weekly_summary"
+            )
+        ]
+        indexes = [
+            # report for all users
+            models.Index(fields=["-dn_week", "user"], name="summary_week_user_idx")
+        ]
+        verbose_name_plural = "weekly summaries"
+
+    def __str__(self):
+        return "%s %s" % (self.user, self.dn_week)
+
+    @classmethod
+    def summarise(cls, sessions):
+        """
+        Aggregate sessions by user and week. Returns unsaved summaries, ordered by
+        user and week.
+        """
+
+        totals = (
+            sessions.order_by("user", "dn_week")
+            .values("user", "dn_week")
+            .annotate(
+                total_distance=Sum("distance"),
+                total_duration=Sum("duration"),
+                session_count=Count("id"),
+            )
+        )
+
+        return [
+            cls(
+                user_id=row["user"],
+                dn_week=row["dn_week"],
+                total_distance=row["total_distance"],
+                total_duration=row["total_duration"],
+                session_count=row["session_count"],
+                avg_speed=average_speed(row["total_distance"], row["total_duration"]),
+            )
+            for row in totals
+        ]
+
+    @classmethod
+    def refresh(cls, user_id, dn_week):
+        """
+        Recalculate the summary for one user and week from their sessions (at most
+        one per day). The summary is removed if there are no sessions.
+        """
+
+        with transaction.atomic():
+            # Serialise summary updates per user (ignored where unsupported)
+            get_user_model().objects.select_for_update().filter(pk=user_id).exists()
+
+            sessions = JoggingSession.objects.filter(user_id=user_id, dn_week=dn_week)
+            summaries = cls.summarise(sessions)
+
+            if not summaries:
+                cls.objects.filter(user_id=user_id, dn_week=dn_week).delete()
+                return
+
+            summary = summaries[0]
+            cls.objects.update_or_create(
+                user_id=user_id,
+                dn_week=dn_week,
+                defaults={
+                    "total_distance": summary.total_distance,
+                    "total_duration": summary.total_duration,
+                    "session_count": summary.session_count,
+                    "avg_speed": summary.avg_speed,
+                },
+            )
+
+    @classmethod
+    @contextmanager
+    def refresh_deferred(cls):
+        """
+        Within this context, summaries for sessions deleted in this thread are
+        refreshed (and cached responses invalidated) together on exit, instead of
+        once per session.
+        """
+
+        if getattr(_deferred_summaries, "keys", None) is not None:
+            yield  # already deferred by an outer context
+            return
+
+        _deferred_summaries.keys = set()
+        try:
+            yield
+            keys = _deferred_summaries.keys
+        finally:
+            _deferred_summaries.keys = None
+
+        cls.refresh_many(keys)
+        data_changed({user_id for user_id, dn_week in keys})
+
+    @classmethod
+    def refresh_many(cls, keys):
+        """
+        Recalculate the summaries for many (user id, week) pairs, with a fixed number
+        of queries. Summaries without sessions are removed.
+        """
+
+        keys = set(keys)
+        if not keys:
+            return
+
+        user_ids = {user_id for user_id, dn_week in keys}
+        weeks = {dn_week for user_id, dn_week in keys}
+
+        with transaction.atomic():
+            # Serialise summary updates per user (ignored where unsupported)
+            list(
+                get_user_model()
+                .objects.select_for_update()
+                .filter(pk__in=user_ids)
+                .order_by("pk")
+                .values_list("pk")
+            )
+
+            sessions = JoggingSession.objects.filter(
+                user_id__in=user_ids, dn_week__in=weeks
+            )
+            summaries = [
+                summary
+                for summary in cls.summarise(sessions)
+                if (summary.user_id, summary.dn_week) in keys
+            ]
+
+            stored = cls.objects.filter(user_id__in=user_ids, dn_week__in=weeks)
+            cls.objects.filter(
+                id__in=[
+                    id
+                    for id, user_id, dn_week in stored.values_list(
+                        "id", "user_id", "dn_week"
+                    )
+                    if (user_id, dn_week) in keys
+                ]
+            ).delete()
+            cls.objects.bulk_create(summaries)
+
+
+REPORT_FILTER_FIELDS = {
+    "user": ("user", "integer"),
+    "week": ("dn_week", "integer"),
+    "distance": ("total_distance", "integer"),
+    "duration": ("total_duration", "integer"),
+    "avg_speed": ("avg_speed", "decimal"),
+}
+
+
+# == Weather ==
+
+
+class CachedWeather(models.Model):
+    """
+    Weather looked up for a location (normalised) on a calendar day (UTC). An empty
+    weather value records that the location could not be found.
+
+    Weather for a day that had ended when it was fetched does not change, and is
+    kept permanently. Other values expire (see `is_fresh`).
+    """
+
+    location = models.TextField("location (normalised)")
+    date = models.DateField("calendar date (UTC)")
+    weather = models.TextField("weather", blank=True)
+    fetched = models.DateTimeField("fetched (UTC)")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["location", "date"], name="unique_cached_weather"
+            )
+        ]
+        verbose_name_plural = "cached weather"
+
+    def __str__(self):
+        return "%s %s" % (self.location, self.date.isoformat())
+
+    def is_fresh(self, now):
+
+        if self.weather == "":
+            max_age = settings.WEATHER_CACHE_NOT_FOUND_TTL
+        elif self.date < self.fetched.date():
+            return True  # historical weather
+        else:
+            max_age = settings.WEATHER_CACHE_RECENT_TTL
 
-        return final_result
+        return now - self.fetched < max_age
@@ -0,0 +1,131 @@
+# jogging/pagination.py
+
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+# == Sessions ==
+
+
+class SessionCursorPagination(BasePagination):
+    """
+    Keyset pagination over the session ordering `("-start", "id")`. Each page is a
+    single range query starting from the position in the cursor, so deep pages
+    cost the same as the first page. No `COUNT(*)` is performed.
+
+    Cursors are opaque tokens holding the (start, id) position of the last (or,
+    for previous pages, the first) session on the current page.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+
+        if cursor is None:
+            is_reversed = False
+            queryset = queryset.order_by("-start", "id")
+        else:
+            is_reversed, start, id = cursor
+            if is_reversed:
+                queryset = queryset.filter(
+                    Q(start__gt=start) | Q(start=start, id__lt=id)
+                ).order_by("start", "-id")
+            else:
+                queryset = queryset.filter(
+                    Q(start__lt=start) | Q(start=start, id__gt=id)
+                ).order_by("-start", "id")
+
+        # Fetch one extra session to find out if there is another page
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+
+        if is_reversed:
+            results.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = cursor is not None
+
+        self.page = results
+        return results
+
+    def get_page_size(self, request):
+
+        max_page_size = settings.SESSION_MAX_PAGE_SIZE
+
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            page_size = api_settings.PAGE_SIZE
+
+        return max(1, min(page_size, max_page_size))
+
+    def decode_cursor(self, request):
+        """Return (is_reversed, start, id) from the request, or None."""
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            decoded = b64decode(encoded.encode("ascii"), altchars=b"-_").decode()
+            is_reversed, start, id = decoded.split("|")
+            return is_reversed == "r", datetime.fromisoformat(start), int(id)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, is_reversed, session):
+
+        if isinstance(session, dict):  # from QuerySet.values()
+            start, id = session["start"], session["id"]
+        else:
+            start, id = session.start, session.id
+
+        position = "%s|%s|%d" % ("r" if is_reversed else "f", start.isoformat(), id)
+        encoded = b64encode(position.encode(), altchars=b"-_").decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+
+        if not self.has_next or not self.page:
+            return None
+
+        return self.encode_cursor(False, self.page[-1])
+
+    def get_previous_link(self):
+
+        if not self.has_previous:
+            return None
+        elif not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+
+        return self.encode_cursor(True, self.page[0])
+
+    def get_paginated_response(self, data):
+
+        return Response(
+            OrderedDict(
+                [
+                    ("next", self.get_next_link()),
+                    ("previous", self.get_previous_link()),
+                    ("results", data),
+                ]
+            )
+        )
@@ -0,0 +1,37 @@
+# jogging/parsers.py
+
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+# == Sessions ==
+
+
+class NDJSONParser(BaseParser):
+    """Parse newline-delimited JSON into a list, with one item per non-blank line."""
+
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+
+        parser_context = parser_context or {}
+        encoding = parser_context.get("encoding", settings.DEFAULT_CHARSET)
+
+        if stream is None:
+            return []
+
+        items = []
+        for number, line in enumerate(stream, start=1):
+            line = line.decode(encoding).strip()
+            if not line:
+                continue
+
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                raise ParseError("NDJSON parse error on line %d - %s" % (number, e))
+
+        return items
@@ -0,0 +1,131 @@
+# jogging/query_plan_test.py
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .common_test import *
+from .models import JoggingSession, WeeklySummary
+
+# Query plans are specific to the database backend; these tests use SQLite's
+# EXPLAIN QUERY PLAN and are skipped elsewhere. The queries are captured from
+# the views and models, so the plans follow any change to them.
+
+pytestmark = [
+    pytest.mark.django_db,
+    pytest.mark.skipif(
+        connection.vendor != "sqlite", reason="query plans are checked on SQLite"
+    ),
+]
+
+SESSION_TABLE = JoggingSession._meta.db_table
+SUMMARY_TABLE = WeeklySummary._meta.db_table
+
+
+def query_plan(sql):
+    """The EXPLAIN QUERY PLAN details for a query, one string per step."""
+
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def captured_reads(queries, table):
+    """The SQL of the captured SELECT queries that read a table."""
+
+    reads = [
+        query["sql"]
+        for query in queries.captured_queries
+        if query["sql"].startswith("SELECT") and '"%s"' % table in query["sql"]
+    ]
+
+    assert reads, "no queries read %s" % table
+    return reads
+
+
+def assert_uses_indexes(sql, sorted=True):
+    """
+    Fail if any table is read without an index (a full table scan), or if rows
+    have to be sorted after reading when the index should provide the order.
+    """
+
+    plan = query_plan(sql)
+
+    for step in plan:
+        if step.startswith("SCAN"):
+            assert "INDEX" in step, "full table scan: %s\n%s" % (plan, sql)
+        if sorted:
+            assert "TEMP B-TREE" not in step, "sort after reading: %s\n%s" % (plan, sql)
+
+
+def test_session_list_plan(populate_samples, api_client):
+    """
+    Session list pages (for one user, or for all users) read the sessions in
+    order from an index.
+    """
+
+    populate_samples
+
+    for role in ["jogger", "superuser"]:
+        client = api_client(role)
+
+        with CaptureQueriesContext(connection) as queries:
+            first = client.get(reverse("session-list") + "?page_size=2").data
+            second = client.get(first["next"]).data
+            client.get(second["previous"])
+
+        for sql in captured_reads(queries, SESSION_TABLE):
+            assert_uses_indexes(sql)
+
+
+def test_session_detail_plan(populate_samples, api_client):
+    """
+    A single session is read by primary key.
+    """
+
+    populate_samples
+    session = JoggingSession.objects.filter(user__username=JOGGER_NAME).first()
+
+    with CaptureQueriesContext(connection) as queries:
+        api_client("jogger").get(reverse("session-detail", args=[session.id]))
+
+    for sql in captured_reads(queries, SESSION_TABLE):
+        assert_uses_indexes(sql)
+
+
+def test_session_save_plans(populate_samples):
+    """
+    Saving a session checks for another session on the same day with the
+    uniqueness index, and refreshes the weekly summary from an index over the
+    user's sessions for the week.
+    """
+
+    populate_samples
+    session = JoggingSession.objects.filter(user__username=JOGGER_NAME).first()
+    session.distance += 1
+
+    with CaptureQueriesContext(connection) as queries:
+        session.save()
+
+    for sql in captured_reads(queries, SESSION_TABLE):
+        assert_uses_indexes(sql)
+
+    for sql in captured_reads(queries, SUMMARY_TABLE):
+        assert_uses_indexes(sql)
+
+
+@pytest.mark.parametrize("report_filter", [None, "distance gt 0"])
+def test_report_plans(populate_samples, create_or_get_user, report_filter):
+    """
+    Reports, for one user or for all users, read the summaries in order from an
+    index.
+    """
+
+    populate_samples
+
+    for user_id in [create_or_get_user(JOGGER_NAME).id, None]:
+        with CaptureQueriesContext(connection) as queries:
+            JoggingSession.generate_user_report(user_id, report_filter)
+
+        for sql in captured_reads(queries, SUMMARY_TABLE):
+            assert_uses_indexes(sql)
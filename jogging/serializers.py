@@ -1,15 +1,70 @@
 # jogging/serializers.py
 
+from operator import itemgetter
+from urllib.parse import urlencode
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from rest_framework import serializers
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
 
 from .models import JoggingSession
 
 
+# == Fields ==
+
+
+def get_requested_fields(request, available, parameter="fields"):
+    """
+    The fields requested with `?fields=` (or another parameter, comma-separated),
+    in the order of `available`, or None if the parameter is not given or empty.
+    """
+
+    value = request.query_params.get(parameter)
+    requested = {name.strip() for name in (value or "").split(",") if name.strip()}
+    if not requested:
+        return None
+
+    unknown = requested.difference(available)
+
+    if unknown:
+        raise ValidationError(
+            {parameter: ["Unknown fields: %s." % ", ".join(sorted(unknown))]}
+        )
+
+    return tuple(name for name in available if name in requested)
+
+
+class SparseFieldsMixin:
+    """
+    Serialise only the `fields` given. If no fields are given, serialise all
+    fields except the `expandable_fields` that are not in `expand`.
+    """
+
+    expandable_fields = ()
+
+    def __init__(self, *args, fields=None, expand=(), **kwargs):
+
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            omitted = set(self.fields).difference(fields)
+        else:
+            omitted = set(self.expandable_fields).difference(expand)
+
+        for name in omitted:
+            self.fields.pop(name)
+
+
 # == Sessions ==
 
 
-class JoggingSessionSerializer(serializers.HyperlinkedModelSerializer):
+class JoggingSessionSerializer(
+    SparseFieldsMixin, serializers.HyperlinkedModelSerializer
+):
 
     url = serializers.HyperlinkedIdentityField(
         view_name="session-detail", lookup_field="id"
@@ -20,6 +75,7 @@ class JoggingSessionSerializer(serializers.HyperlinkedModelSerializer):
     dn_week = serializers.ReadOnlyField()
     dn_speed = serializers.ReadOnlyField()
     lu_weather = serializers.ReadOnlyField()
+    lu_weather_pending = serializers.ReadOnlyField()
 
     class Meta:
         model = JoggingSession
@@ -33,18 +89,169 @@ class JoggingSessionSerializer(serializers.HyperlinkedModelSerializer):
             "dn_speed",
             "lu_weather_location",
             "lu_weather",
+            "lu_weather_pending",
             "user",
         )
 
 
+def _url_parts(view_name, lookup_field, request):
+    """
+    Split the absolute URL of a detail view around its lookup value, so that
+    URLs can be built by concatenation instead of calling `reverse()` per row.
+    """
+
+    placeholder = "2147483647"
+    url = reverse(view_name, kwargs={lookup_field: int(placeholder)}, request=request)
+    prefix, _, suffix = url.rpartition(placeholder)
+    return prefix, suffix
+
+
+def _datetime_formatter():
+    """Return a function that formats datetimes like `serializers.DateTimeField`."""
+
+    output_format = api_settings.DATETIME_FORMAT
+
+    if not settings.USE_TZ or output_format is None or output_format == ISO_8601:
+        return serializers.DateTimeField().to_representation
+
+    current_timezone = timezone.get_current_timezone()
+    return lambda value: value.astimezone(current_timezone).strftime(output_format)
+
+
+def _link_builder(view_name, lookup_field, column, request):
+    """Return a function that builds the detail URL for a row's column value."""
+
+    prefix, suffix = _url_parts(view_name, lookup_field, request)
+    return lambda row: prefix + str(row[column]) + suffix
+
+
+def _start_formatter():
+    """Return a function that formats a row's start time."""
+
+    format_datetime = _datetime_formatter()
+    return lambda row: format_datetime(row["start"])
+
+
+class JoggingSessionListSerializer:
+    """
+    Read-only fast path for session lists. Produces the same representation as
+    `JoggingSessionSerializer`, but works on plain rows from `QuerySet.values()`
+    and builds hyperlinks from precomputed URL parts.
+    """
+
+    # The column read for each field
+    field_columns = {
+        "url": "id",
+        "start": "start",
+        "dn_week": "dn_week",
+        "local_timezone": "local_timezone",
+        "distance": "distance",
+        "duration": "duration",
+        "dn_speed": "dn_speed",
+        "lu_weather_location": "lu_weather_location",
+        "lu_weather": "lu_weather",
+        "lu_weather_pending": "lu_weather_pending",
+        "user": "user_id",
+    }
+
+    columns = tuple(field_columns.values())
+
+    def __init__(self, rows, context, fields=None):
+        self.rows = rows
+        self.request = context["request"]
+        self.fields = fields
+
+    @classmethod
+    def columns_for(cls, fields):
+        """
+        The columns to read for these fields (all fields if None). The id and start
+        are always read, for pagination.
+        """
+
+        if fields is None:
+            return cls.columns
+
+        columns = {"id", "start"}.union(cls.field_columns[name] for name in fields)
+        return tuple(column for column in cls.columns if column in columns)
+
+    def iterate(self):
+        """Generate the representation of each row, without holding all rows."""
+
+        if self.fields is not None:
+            yield from self._iterate_fields()
+            return
+
+        session_prefix, session_suffix = _url_parts(
+            "session-detail", "id", self.request
+        )
+        user_prefix, user_suffix = _url_parts("user-detail", "pk", self.request)
+        format_datetime = _datetime_formatter()
+
+        for row in self.rows:
+            yield {
+                "url": session_prefix + str(row["id"]) + session_suffix,
+                "start": format_datetime(row["start"]),
+                "dn_week": row["dn_week"],
+                "local_timezone": row["local_timezone"],
+                "distance": row["distance"],
+                "duration": row["duration"],
+                "dn_speed": row["dn_speed"],
+                "lu_weather_location": row["lu_weather_location"],
+                "lu_weather": row["lu_weather"],
+                "lu_weather_pending": row["lu_weather_pending"],
+                "user": user_prefix + str(row["user_id"]) + user_suffix,
+            }
+
+    def _iterate_fields(self):
+        """Generate only the requested fields, building hyperlinks only if needed."""
+
+        converters = []
+
+        for name in self.fields:
+            if name == "url":
+                convert = _link_builder("session-detail", "id", "id", self.request)
+            elif name == "user":
+                convert = _link_builder("user-detail", "pk", "user_id", self.request)
+            elif name == "start":
+                convert = _start_formatter()
+            else:
+                convert = itemgetter(self.field_columns[name])
+
+            converters.append((name, convert))
+
+        for row in self.rows:
+            yield {name: convert(row) for name, convert in converters}
+
+    @property
+    def data(self):
+        return list(self.iterate())
+
+
 # == Users ==
 
 
-class UserSerializer(serializers.HyperlinkedModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    session_count = serializers.SerializerMethodField()
+    sessions_url = serializers.SerializerMethodField()
     jogging_sessions = serializers.HyperlinkedRelatedField(
         many=True, view_name="session-detail", read_only=True, lookup_field="id"
     )
 
+    # Links to every session are only included on request (`?expand=`)
+    expandable_fields = ("jogging_sessions",)
+
+    # The column read for each field (sessions are counted or read separately)
+    field_columns = {
+        "url": "id",
+        "username": "username",
+        "password": "password",
+        "is_staff": "is_staff",
+        "is_superuser": "is_superuser",
+        "session_count": None,
+        "sessions_url": "id",
+        "jogging_sessions": None,
+    }
+
     class Meta:
         model = get_user_model()
         fields = (
@@ -53,9 +260,28 @@ class UserSerializer(serializers.HyperlinkedModelSerializer):
             "password",
             "is_staff",
             "is_superuser",
+            "session_count",
+            "sessions_url",
             "jogging_sessions",
         )
 
+    def get_session_count(self, user):
+        """The annotated session count (see the user views), or a count query."""
+
+        count = getattr(user, "session_count", None)
+        return user.jogging_sessions.count() if count is None else count
+
+    def get_sessions_url(self, user):
+        """The session list, filtered to the user's sessions."""
+
+        if not hasattr(self, "_session_list_url"):
+            self._session_list_url = reverse(
+                "session-list", request=self.context.get("request")
+            )
+
+        query = urlencode({"filter": "user eq %d" % user.pk})
+        return self._session_list_url + "?" + query
+
     def create(self, validated_data):
         instance = get_user_model().objects.create(**validated_data)
         instance.set_password(validated_data["password"])
@@ -7,6 +7,9 @@ from . import views
 urlpatterns = [
     path("", views.api_root, name="api_root"),
     path("api/v1/sessions/", views.get_post_sessions, name="session-list"),
+    path("api/v1/sessions/export", views.export_sessions, name="session-export"),
+    path("api/v1/sessions/import", views.import_sessions, name="session-import"),
+    path("api/v1/sessions/bulk", views.bulk_change_sessions, name="session-bulk"),
     path(
         "api/v1/sessions/<int:id>",
         views.get_delete_update_session,
@@ -15,4 +18,5 @@ urlpatterns = [
     path("api/v1/users/", views.UserList.as_view(), name="user-list"),
     path("api/v1/users/<int:pk>/", views.UserDetail.as_view(), name="user-detail"),
     path("api/v1/report/", views.ReportList.as_view(), name="report-list"),
+    path("api/v1/weather/status", views.weather_status, name="weather-status"),
 ]
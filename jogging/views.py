@@ -1,20 +1,41 @@
 # jogging/views.py
 
+import json
+import operator
 from datetime import datetime
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ValidationError
+from django.core.exceptions import NON_FIELD_ERRORS, ValidationError
+from django.db.models import Count, Prefetch, Q
+from django.http import StreamingHttpResponse
 from rest_framework import generics
 from rest_framework import status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, parser_classes
+from rest_framework.parsers import JSONParser
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from rest_framework.views import APIView
 
-from .logic import CUSTOM_FILTER_OPERATORS, evaluate_custom_filter
-from .models import JoggingSession
+from .caching import ALL_USERS, cached_response, check_preconditions, get_etag
+from .enrichment import weather_enrichment
+from .logic import (
+    FilterError,
+    compile_custom_filter_q,
+    get_weather_cache_counts,
+    get_weather_circuit_breaker,
+)
+from .models import DUPLICATE_SESSION_MESSAGE, JoggingSession
+from .pagination import SessionCursorPagination
+from .parsers import NDJSONParser
 from .permissions import UserRolePermissions, is_anonymous_or_simply_staff
-from .serializers import JoggingSessionSerializer, UserSerializer
+from .serializers import (
+    JoggingSessionListSerializer,
+    JoggingSessionSerializer,
+    UserSerializer,
+    get_requested_fields,
+)
 
 
 # == API root ==
@@ -40,24 +61,45 @@ def get_delete_update_session(request, id):
     if is_anonymous_or_simply_staff(request):
         return Response(status=status.HTTP_403_FORBIDDEN)
 
-    # Get session by ID
+    # Get session by ID (only the requested fields, if reading)
+    sessions = JoggingSession.objects.all()
+    fields = None
+
+    if request.method == "GET":
+        fields = get_requested_fields(request, JoggingSessionSerializer.Meta.fields)
+        if fields is not None:
+            columns = JoggingSessionListSerializer.columns_for(fields)
+            sessions = sessions.only("user_id", *columns)
+
     try:
-        session = JoggingSession.objects.get(id=id)
+        session = sessions.get(id=id)
     except JoggingSession.DoesNotExist:
         return Response(status=status.HTTP_404_NOT_FOUND)
 
     # Only owners and superusers can modify a record
-    is_owner = session.user.id == request.user.id
+    is_owner = session.user_id == request.user.id
     if not is_owner and not request.user.is_superuser:
         return Response(status=status.HTTP_403_FORBIDDEN)
 
     # Get single session
     if request.method == "GET":
-        serializer = JoggingSessionSerializer(session, context={"request": request})
-        return Response(serializer.data)
+
+        def get_session():
+
+            serializer = JoggingSessionSerializer(
+                session, context={"request": request}, fields=fields
+            )
+            return Response(serializer.data)
+
+        return cached_response(request, session.user_id, get_session)
+
+    # Reject writes based on a stale read (If-Match, If-Unmodified-Since)
+    response = check_preconditions(request, session.user_id)
+    if response is not None:
+        return response
 
     # Delete single session
-    elif request.method == "DELETE":
+    if request.method == "DELETE":
         session.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
@@ -71,7 +113,11 @@ def get_delete_update_session(request, id):
         try:
             if serializer.is_valid():
                 serializer.save()
-                return Response(serializer.data, status=status.HTTP_204_NO_CONTENT)
+                return Response(
+                    serializer.data,
+                    status=status.HTTP_204_NO_CONTENT,
+                    headers={"ETag": get_etag(request, session.user_id)},
+                )
         except ValidationError:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -89,32 +135,25 @@ def get_post_sessions(request):
     # Get all sessions
     if request.method == "GET":
 
-        # Get all sessions (apply user filter if required)
-        kwargs = {}
+        fields = get_requested_fields(request, JoggingSessionSerializer.Meta.fields)
+        columns = JoggingSessionListSerializer.columns_for(fields)
 
-        if not request.user.is_superuser:
-            kwargs["user"] = request.user
+        def get_page():
 
-        all_records_by_name = JoggingSession.objects.filter(**kwargs)
+            all_records_by_name = get_visible_sessions(request, filter_string)
 
-        # Apply custom filter
-        if filter_string is not None and filter_string != "":
-            ids = [
-                session.id
-                for session in all_records_by_name
-                if apply_custom_session_filter(session, filter_string)
-            ]
+            # Serialize and return a page of results (only the requested fields)
+            paginator = SessionCursorPagination()
+            page = paginator.paginate_queryset(
+                all_records_by_name.values(*columns), request
+            )
+            serializer = JoggingSessionListSerializer(
+                page, context={"request": request}, fields=fields
+            )
 
-            all_records_by_name = JoggingSession.objects.filter(
-                id__in=ids
-            )  # queryset with all sessions that matched the filter
+            return paginator.get_paginated_response(serializer.data)
 
-        # Serialize and return the results
-        serializer = JoggingSessionSerializer(
-            all_records_by_name, many=True, context={"request": request}
-        )
-
-        return Response(serializer.data)
+        return cached_response(request, get_cache_scope(request), get_page)
 
     # Insert new session
     elif request.method == "POST":
@@ -153,72 +192,500 @@ def get_post_sessions(request):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-def apply_custom_session_filter(session, custom_filter):
+@api_view(["POST"])
+@parser_classes([JSONParser, NDJSONParser])
+def import_sessions(request):
+    """
+    Create many sessions from a JSON array, or newline-delimited JSON
+    (`application/x-ndjson`), of new sessions. Items are validated together, and
+    valid items are created even if others fail. Returns a result for each item,
+    in order, with the status it would have had as a single POST.
+    """
 
-    session_tokens = CUSTOM_FILTER_OPERATORS.copy()
-    session_tokens["start"] = "'" + str(session.start.strftime("%Y-%m-%dT%H:%M")) + "'"
-    session_tokens["dn_week"] = str(session.dn_week)
-    session_tokens["local_timezone"] = "'" + str(session.local_timezone) + "'"
-    session_tokens["distance"] = str(session.distance)
-    session_tokens["duration"] = str(session.duration)
-    session_tokens["speed"] = str(session.dn_speed)
-    session_tokens["lu_weather_location"] = "'" + str(session.lu_weather_location) + "'"
-    session_tokens["lu_weather"] = "'" + str(session.lu_weather) + "'"
-    session_tokens["user"] = str(session.user.id)
+    if is_anonymous_or_simply_staff(request):
+        return Response(status=status.HTTP_403_FORBIDDEN)
 
-    return evaluate_custom_filter(custom_filter, session_tokens)
+    items = request.data
+    if not isinstance(items, list):
+        return Response(status=status.HTTP_400_BAD_REQUEST)
 
+    if len(items) > settings.SESSION_IMPORT_MAX_ITEMS:
+        return Response(status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
 
-# == Users ==
+    results = [None] * len(items)
+    parsed = []
 
+    # Parse items and validate permissions
+    for index, item in enumerate(items):
+        data, errors = _parse_session_item(item)
 
-class UserList(generics.ListCreateAPIView):
-    queryset = get_user_model().objects.all().order_by("username")
-    serializer_class = UserSerializer
-    permission_classes = (UserRolePermissions,)
-    filter = None
+        if errors:
+            results[index] = _import_error(errors)
+        elif not request.user.is_superuser and request.user.id != data["user_id"]:
+            results[index] = {"status": status.HTTP_401_UNAUTHORIZED}
+        else:
+            parsed.append((index, data))
 
-    @classmethod
-    def apply_custom_filter(cls, user, custom_filter):
-        user_tokens = CUSTOM_FILTER_OPERATORS.copy()
+    # Validate sessions (users are checked together, instead of per session)
+    user_ids = set(
+        get_user_model()
+        .objects.filter(id__in={data["user_id"] for index, data in parsed})
+        .values_list("id", flat=True)
+    )
+    candidates = []
 
-        user_tokens["username"] = "'" + user.username + "'"
+    for index, data in parsed:
+        if data["user_id"] not in user_ids:
+            results[index] = _import_error({"user": ["Unknown user."]})
+            continue
 
-        if user.is_superuser:
-            role = "superuser"
-        elif user.is_staff:
-            role = "staff"
+        session = JoggingSession(**data)
+        try:
+            session.full_clean(exclude=["user"], validate_unique=False)
+        except ValidationError as e:
+            errors = e.message_dict
+            if NON_FIELD_ERRORS in errors:  # reported like duplicates, below
+                errors["non_field_errors"] = errors.pop(NON_FIELD_ERRORS)
+            results[index] = _import_error(errors)
+            continue
+
+        candidates.append((index, session))
+
+    # Store sessions
+    JoggingSession.bulk_insert([session for index, session in candidates])
+
+    for index, session in candidates:
+        if session.pk is None:
+            results[index] = _import_error(
+                {"non_field_errors": [DUPLICATE_SESSION_MESSAGE]}
+            )
         else:
-            role = "jogger"
+            results[index] = {
+                "status": status.HTTP_201_CREATED,
+                "url": reverse("session-detail", args=[session.pk], request=request),
+            }
+
+    created = sum(result["status"] == status.HTTP_201_CREATED for result in results)
+    return Response(
+        {"created": created, "failed": len(results) - created, "results": results}
+    )
+
+
+def _parse_session_item(item):
+    """
+    Convert the fields of an imported session. Returns the model field values, and
+    any errors by field.
+    """
+
+    if not isinstance(item, dict):
+        return None, {"non_field_errors": ["Expected a session object."]}
+
+    data = {}
+    errors = {}
+    conversions = [
+        ("user", "user_id", _parse_integer),
+        ("duration", "duration", _parse_integer),
+        ("distance", "distance", _parse_integer),
+        ("start", "start", datetime.fromisoformat),
+    ]
+
+    for field, model_field, convert in conversions:
+        if item.get(field) is None:
+            errors[field] = ["This field is required."]
+            continue
+
+        try:
+            data[model_field] = convert(item[field])
+        except (TypeError, ValueError):
+            errors[field] = ["Invalid value."]
+
+    if data.get("start") is not None and data["start"].tzinfo is None:
+        errors["start"] = ["Timezone offset is not zero."]
+
+    for field in ["lu_weather_location", "local_timezone"]:
+        data[field] = str(item.get(field) or "")
+
+    return data, errors
+
+
+def _parse_integer(value):
+    """
+    Convert an integer, or a string of one. Booleans and fractions are invalid,
+    instead of becoming 0 or 1, or being truncated.
+    """
+
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError("Not an integer: %r" % value)
+
+    return int(value)
+
+
+def _import_error(errors):
+
+    return {"status": status.HTTP_400_BAD_REQUEST, "errors": errors}
+
+
+# Fields that may be changed for many sessions at once, and their types
+SESSION_BULK_CHANGE_FIELDS = {
+    "distance": int,
+    "duration": int,
+    "local_timezone": str,
+    "lu_weather_location": str,
+}
+
+
+@api_view(["PATCH", "DELETE"])
+def bulk_change_sessions(request):
+    """
+    Change (PATCH) or delete (DELETE) many sessions at once: the sessions listed
+    in `ids` in the request body, and/or those matching `?filter=`. Only sessions
+    the user may list are affected. PATCH sets the other fields in the request
+    body on every session. Returns the number of sessions changed or deleted.
+    """
+
+    if is_anonymous_or_simply_staff(request):
+        return Response(status=status.HTTP_403_FORBIDDEN)
+
+    data = request.data if isinstance(request.data, dict) else {}
+    filter_string = request.query_params.get("filter", None)
+    ids = data.get("ids", None)
+
+    # Select sessions (all sessions must be selected explicitly)
+    if ids is None and not filter_string:
+        return Response(
+            {"non_field_errors": ["Select sessions with ids and/or ?filter=."]},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    # An invalid filter would match no sessions, and look like success
+    if filter_string:
+        try:
+            compile_custom_filter_q(filter_string, SESSION_FILTER_FIELDS)
+        except FilterError as error:
+            return Response(
+                {"filter": [str(error)]}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+    sessions = get_visible_sessions(request, filter_string)
+
+    if ids is not None:
+        if not isinstance(ids, list) or not all(
+            isinstance(session_id, int) and not isinstance(session_id, bool)
+            for session_id in ids
+        ):
+            return Response(
+                {"ids": ["Expected a list of session ids."]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if len(ids) > settings.SESSION_IMPORT_MAX_ITEMS:
+            return Response(status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        sessions = sessions.filter(id__in=ids)
+
+    # Delete sessions
+    if request.method == "DELETE":
+        return Response({"deleted": JoggingSession.bulk_delete(sessions)})
+
+    # Change sessions
+    elif request.method == "PATCH":
+
+        changes, errors = _parse_session_changes(data)
+        if errors:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({"updated": JoggingSession.bulk_change(sessions, changes)})
+
+
+def _parse_session_changes(data):
+    """
+    Convert and validate the fields to change on many sessions. Returns the
+    changes, and any errors by field.
+    """
+
+    changes = {}
+    errors = {}
+
+    for field, value in data.items():
+        if field == "ids":
+            continue
+
+        convert = SESSION_BULK_CHANGE_FIELDS.get(field)
+        if convert is None:
+            errors[field] = ["This field cannot be changed for many sessions."]
+        elif not isinstance(value, convert) or isinstance(value, bool):
+            errors[field] = ["Invalid value."]
+        elif convert is int and value < 0:
+            errors[field] = ["Invalid %s value." % field]
+        else:
+            changes[field] = value
+
+    if not changes and not errors:
+        errors["non_field_errors"] = ["No fields to change."]
+
+    return changes, errors
+
+
+SESSION_FILTER_FIELDS = {
+    "start": ("start", "datetime"),
+    "dn_week": ("dn_week", "integer"),
+    "local_timezone": ("local_timezone", "text"),
+    "distance": ("distance", "integer"),
+    "duration": ("duration", "integer"),
+    "speed": ("dn_speed", "decimal"),
+    "lu_weather_location": ("lu_weather_location", "text"),
+    "lu_weather": ("lu_weather", "text"),
+    "user": ("user_id", "integer"),
+}
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+
+@api_view(["GET"])
+def export_sessions(request):
+    """
+    Stream all matching sessions, as newline-delimited JSON (`?output=ndjson`,
+    the default) or as a JSON array (`?output=json`). Rows are read from the
+    database in chunks and encoded one at a time, so memory use does not grow
+    with the number of sessions.
+    """
+
+    if is_anonymous_or_simply_staff(request):
+        return Response(status=status.HTTP_403_FORBIDDEN)
+
+    output = request.query_params.get("output", "ndjson")
+    if output not in EXPORT_CONTENT_TYPES:
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    filter_string = request.query_params.get("filter", None)
+    rows = (
+        get_visible_sessions(request, filter_string)
+        .order_by("-start", "id")
+        .values(*JoggingSessionListSerializer.columns)
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    serializer = JoggingSessionListSerializer(rows, context={"request": request})
+
+    if output == "ndjson":
+        content = _export_ndjson(serializer.iterate())
+    else:
+        content = _export_json_array(serializer.iterate())
+
+    return StreamingHttpResponse(content, content_type=EXPORT_CONTENT_TYPES[output])
+
+
+def _encode_json(item):
+    """Encode like DRF's `JSONRenderer` (compact, unicode, strict)."""
+
+    return json.dumps(
+        item,
+        cls=JSONEncoder,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    )
+
+
+def _export_ndjson(items):
+
+    for item in items:
+        yield _encode_json(item) + "\n"
+
 
-        user_tokens["role"] = "'" + role + "'"
+def _export_json_array(items):
 
-        return evaluate_custom_filter(custom_filter, user_tokens)
+    separator = "["
+    for item in items:
+        yield separator + _encode_json(item)
+        separator = ","
+
+    yield "[]" if separator == "[" else "]"
+
+
+def get_cache_scope(request):
+    """The response cache scope of the sessions the user may list."""
+
+    return ALL_USERS if request.user.is_superuser else request.user.id
+
+
+def get_visible_sessions(request, filter_string=None):
+    """
+    Sessions the user may list: their own, or all sessions for superusers. The
+    custom filter is applied if present.
+    """
+
+    # Get all sessions (apply user filter if required)
+    kwargs = {}
+
+    if not request.user.is_superuser:
+        kwargs["user"] = request.user
+
+    sessions = JoggingSession.objects.filter(**kwargs)
+
+    # Apply custom filter
+    if filter_string is not None and filter_string != "":
+        sessions = apply_custom_session_filter(sessions, filter_string)
+
+    return sessions
+
+
+def apply_custom_session_filter(sessions, custom_filter):
+    """
+    Restrict a session queryset to the sessions matching the custom filter. The
+    filter is compiled to SQL. An invalid filter matches no sessions.
+    """
+
+    try:
+        return sessions.filter(
+            compile_custom_filter_q(custom_filter, SESSION_FILTER_FIELDS)
+        )
+    except FilterError:
+        return sessions.none()
+
+
+# == Users ==
+
+
+class UserFieldsMixin:
+    """
+    Serialise the user fields requested with `?fields=` and `?expand=`, and read
+    only what they need: the requested columns, session counts as an annotation,
+    and (if expanded) all sessions in a single prefetch query.
+    """
+
+    def requested_fields(self):
+
+        if self.request.method != "GET":
+            return None
+
+        return get_requested_fields(self.request, UserSerializer.Meta.fields)
+
+    def requested_expansions(self):
+
+        if self.request.method != "GET":
+            return ()
+
+        available = UserSerializer.expandable_fields
+        return get_requested_fields(self.request, available, "expand") or ()
+
+    def is_requested(self, name):
+
+        fields = self.requested_fields()
+        if fields is not None:
+            return name in fields
+
+        return (
+            name not in UserSerializer.expandable_fields
+            or name in self.requested_expansions()
+        )
+
+    def prepare_users(self, users):
+
+        fields = self.requested_fields()
+        if fields is not None:
+            columns = [UserSerializer.field_columns[name] for name in fields]
+            users = users.only("id", *filter(None, columns))
+
+        if self.is_requested("session_count"):
+            users = users.annotate(session_count=Count("jogging_sessions"))
+
+        if self.is_requested("jogging_sessions"):
+            sessions = JoggingSession.objects.only("id", "user_id", "start")
+            users = users.prefetch_related(Prefetch("jogging_sessions", sessions))
+
+        return users
+
+    def get_serializer(self, *args, **kwargs):
+
+        return super().get_serializer(
+            *args,
+            fields=self.requested_fields(),
+            expand=self.requested_expansions(),
+            **kwargs,
+        )
+
+
+# The conditions for each role (there is no single "role" field)
+USER_ROLE_QS = {
+    "superuser": Q(is_superuser=True),
+    "staff": Q(is_staff=True, is_superuser=False),
+    "jogger": Q(is_staff=False, is_superuser=False),
+}
+
+
+def _role_q(comparison, value):
+    """
+    Compare the "role" pseudo-field with a string, by comparing each role name
+    and matching the users with the roles that pass.
+    """
+
+    compare = getattr(operator, {"lte": "le", "gte": "ge"}.get(comparison, comparison))
+    q = Q(pk__isnull=True)
+
+    for role, role_q in USER_ROLE_QS.items():
+        if compare(role, value):
+            q |= role_q
+
+    return q
+
+
+USER_FILTER_FIELDS = {
+    "username": ("username", "text"),
+    "role": (_role_q, "text"),
+}
+
+
+class UserList(UserFieldsMixin, generics.ListCreateAPIView):
+    queryset = get_user_model().objects.all().order_by("username")
+    serializer_class = UserSerializer
+    permission_classes = (UserRolePermissions,)
+    filter = None
 
     def get_queryset(self):
 
+        users = super(UserList, self).get_queryset()
         custom_filter = self.request.query_params.get("filter", None)
 
         if custom_filter is not None:
-            users = get_user_model().objects.all().order_by("username")
-            ids = [
-                user.id
-                for user in users
-                if self.apply_custom_filter(user, custom_filter)
-            ]
-
-            return users.filter(
-                id__in=ids
-            )  # queryset with all users that matched the filter
-        else:
-            return super(UserList, self).get_queryset()
+            try:
+                users = users.filter(
+                    compile_custom_filter_q(custom_filter, USER_FILTER_FIELDS)
+                )
+            except FilterError:
+                users = users.none()
 
+        return self.prepare_users(users)
 
-class UserDetail(generics.RetrieveUpdateDestroyAPIView):
+    def list(self, request, *args, **kwargs):
+
+        return cached_response(
+            request, ALL_USERS, lambda: super(UserList, self).list(request)
+        )
+
+
+class UserDetail(UserFieldsMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = get_user_model().objects.all().order_by("username")
     serializer_class = UserSerializer
     permission_classes = (UserRolePermissions,)
 
+    def get_queryset(self):
+
+        return self.prepare_users(super().get_queryset())
+
+    def retrieve(self, request, *args, **kwargs):
+
+        user = self.get_object()
+
+        return cached_response(
+            request, user.pk, lambda: Response(self.get_serializer(user).data)
+        )
+
 
 # == Reports ==
 
@@ -234,9 +701,34 @@ class ReportList(APIView):
         custom_filter = self.request.query_params.get("filter", None)
 
         if request.user.is_staff or request.user.is_superuser:
-            result = JoggingSession.generate_user_report(None, custom_filter)
+            user_id = None
+            scope = ALL_USERS
         else:
             user_id = request.user.id
+            scope = user_id
+
+        def get_report():
+
             result = JoggingSession.generate_user_report(user_id, custom_filter)
+            return Response(result, status=status.HTTP_200_OK)
+
+        return cached_response(request, scope, get_report)
+
 
-        return Response(result, status=status.HTTP_200_OK)
+# == Weather ==
+
+
+@api_view(["GET"])
+def weather_status(request):
+    """Weather provider health, cache and enrichment counters, for monitoring."""
+
+    if not request.user.is_staff and not request.user.is_superuser:
+        return Response(status=status.HTTP_403_FORBIDDEN)
+
+    return Response(
+        {
+            "circuit_breaker": get_weather_circuit_breaker().state(),
+            "cache": get_weather_cache_counts(),
+            "pending_sessions": len(weather_enrichment.pending()),
+        }
+    )
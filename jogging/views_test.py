@@ -1,12 +1,21 @@
 import json
+import time
+from decimal import Decimal
 
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.http import parse_http_date
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 
+from .caching import ALL_USERS, bump_data_version, get_data_version
 from .common_test import *
-from .models import JoggingSession
-from .serializers import JoggingSessionSerializer
-from .views import apply_custom_session_filter, UserList
+from .logic import compile_custom_filter_q, evaluate_custom_filter
+from .models import JoggingSession, WeeklySummary
+from .serializers import JoggingSessionListSerializer, JoggingSessionSerializer
+from .views import USER_FILTER_FIELDS, apply_custom_session_filter
 
 # Details used when inserting data via REST
 
@@ -79,7 +88,7 @@ def test_get_all_by_superuser(populate_samples, api_client, generate_request):
 
     # Validate results
     assert response.status_code == status.HTTP_200_OK
-    assert serializer.data == response.data
+    assert serializer.data == response.data["results"]
 
 
 @pytest.mark.parametrize(
@@ -125,7 +134,137 @@ def test_get_all_by_jogger(populate_samples, api_client, generate_request):
 
     # Validate results
     assert response.status_code == status.HTTP_200_OK
-    assert serializer.data == response.data
+    assert serializer.data == response.data["results"]
+
+
+@pytest.mark.django_db
+def test_list_serializer_matches_serializer(populate_samples, generate_request):
+
+    populate_samples
+    request = generate_request("superuser")
+    sessions = JoggingSession.objects.all()
+
+    expected = JoggingSessionSerializer(
+        sessions, many=True, context={"request": request}
+    ).data
+    fast = JoggingSessionListSerializer(
+        sessions.values(*JoggingSessionListSerializer.columns),
+        context={"request": request},
+    ).data
+
+    renderer = JSONRenderer()
+    assert renderer.render(fast) == renderer.render(expected)
+
+
+@pytest.mark.django_db
+def test_session_pages(populate_samples, api_client, generate_request):
+
+    populate_samples
+    client = api_client("superuser")
+    request = generate_request("superuser")
+
+    all_records = JoggingSession.objects.all()
+    serializer = JoggingSessionSerializer(
+        all_records, many=True, context={"request": request}
+    )
+
+    # Walk forwards through all pages, without counting sessions. Both users
+    # have sessions with the same start times, so pages split a tie.
+    pages = []
+    url = reverse("session-list") + "?page_size=3"
+    with CaptureQueriesContext(connection) as queries:
+        while url is not None:
+            response = client.get(url)
+            assert response.status_code == status.HTTP_200_OK
+            pages.append(response.data)
+            url = response.data["next"]
+
+    assert not any("COUNT(" in query["sql"] for query in queries.captured_queries)
+    assert [len(page["results"]) for page in pages] == [3, 3]
+    assert pages[0]["previous"] is None
+    assert pages[0]["results"] + pages[1]["results"] == serializer.data
+
+    # Walk backwards to the first page
+    response = client.get(pages[1]["previous"])
+    assert response.data["results"] == pages[0]["results"]
+    assert response.data["previous"] is None
+    assert response.data["next"] is not None
+
+
+@pytest.mark.parametrize(
+    "role,output,response_status",
+    [
+        ("superuser", "ndjson", status.HTTP_200_OK),
+        ("superuser", "json", status.HTTP_200_OK),
+        ("superuser", "xml", status.HTTP_400_BAD_REQUEST),
+        ("staff", "ndjson", status.HTTP_403_FORBIDDEN),
+        ("jogger", "ndjson", status.HTTP_200_OK),
+        ("jogger", "json", status.HTTP_200_OK),
+        ("anonymous", "ndjson", status.HTTP_403_FORBIDDEN),
+    ],
+)
+@pytest.mark.django_db
+def test_export_sessions(
+    populate_samples, api_client, generate_request, role, output, response_status
+):
+
+    populate_samples
+    request = generate_request(role)
+
+    response = api_client(role).get(
+        reverse("session-export") + "?output=" + output + "&filter=distance gt 0"
+    )
+    assert response.status_code == response_status
+
+    if response_status != status.HTTP_200_OK:
+        return
+
+    # Compare with the paginated list representation
+    sessions = JoggingSession.objects.all()
+    if role == "jogger":
+        sessions = sessions.filter(user__username=JOGGER_NAME)
+    expected = JSONRenderer().render(
+        JoggingSessionListSerializer(
+            sessions.values(*JoggingSessionListSerializer.columns),
+            context={"request": request},
+        ).data
+    )
+
+    content = b"".join(response.streaming_content)
+
+    if output == "ndjson":
+        lines = content.decode().splitlines()
+        assert len(lines) == sessions.count()
+        assert [json.loads(line) for line in lines] == json.loads(expected)
+    else:
+        assert content == expected
+
+
+@pytest.mark.django_db
+def test_export_without_sessions(api_client):
+
+    response = api_client("jogger").get(reverse("session-export") + "?output=json")
+
+    assert b"".join(response.streaming_content) == b"[]"
+
+
+@pytest.mark.django_db
+def test_session_page_size_limit(populate_samples, api_client, settings):
+
+    populate_samples
+    settings.SESSION_MAX_PAGE_SIZE = 3
+
+    response = api_client("superuser").get(reverse("session-list") + "?page_size=50")
+
+    assert len(response.data["results"]) == 3
+
+
+@pytest.mark.django_db
+def test_session_page_with_invalid_cursor(api_client):
+
+    response = api_client("jogger").get(reverse("session-list") + "?cursor=invalid")
+
+    assert response.status_code == status.HTTP_404_NOT_FOUND
 
 
 @pytest.mark.parametrize(
@@ -235,6 +374,564 @@ def test_post_invalid_session(api_client, create_or_get_user):
     assert response.status_code == status.HTTP_400_BAD_REQUEST
 
 
+def import_session(user, day, **fields):
+
+    session = PARTIAL_SESSION.copy()
+    session["user"] = user.id
+    session["start"] = "2020-05-%02dT07:30:00+00:00" % day
+    session.update(fields)
+    return session
+
+
+@pytest.mark.django_db
+def test_import_sessions(api_client, create_or_get_user):
+
+    jogger = create_or_get_user(JOGGER_NAME)
+    other = create_or_get_user(SAMPLE_NAME)
+    client = api_client("jogger")
+    client.post(
+        reverse("session-list"),
+        data=json.dumps(import_session(jogger, 4)),
+        content_type="application/json",
+    )
+
+    items = [
+        import_session(jogger, 5),
+        import_session(jogger, 6, lu_weather_location=""),
+        import_session(jogger, 4),  # stored session on the same day
+        import_session(jogger, 5, distance=2000),  # imported session on the same day
+        import_session(jogger, 7, distance=-1),
+        import_session(jogger, 8, start="yesterday"),
+        import_session(other, 9),
+        "not a session",
+        dict(import_session(jogger, 10), user=True),
+        import_session(jogger, 11, duration=59.5),
+        import_session(jogger, 12, distance=1000.0),
+    ]
+
+    response = client.post(
+        reverse("session-import"),
+        data=json.dumps(items),
+        content_type="application/json",
+    )
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response.data["created"] == 3
+    assert response.data["failed"] == 8
+    assert [result["status"] for result in response.data["results"]] == [
+        201,
+        201,
+        400,
+        400,
+        400,
+        400,
+        401,
+        400,
+        400,
+        400,
+        201,
+    ]
+
+    # Errors are reported by field, and other errors under one key
+    errors = [result.get("errors") for result in response.data["results"]]
+    assert list(errors[2]) == ["non_field_errors"]
+    assert list(errors[3]) == ["non_field_errors"]
+    assert list(errors[4]) == ["non_field_errors"]
+    assert list(errors[5]) == ["start"]
+    assert list(errors[8]) == ["user"]
+    assert list(errors[9]) == ["duration"]
+
+    sessions = JoggingSession.objects.filter(user=jogger).order_by("start")
+    assert [session.dn_date.day for session in sessions] == [4, 5, 6, 12]
+    assert [session.lu_weather_pending for session in sessions] == [
+        True,
+        True,
+        False,
+        True,
+    ]
+    assert response.data["results"][0]["url"].endswith(
+        reverse("session-detail", args=[sessions[1].id])
+    )
+
+    summary = jogger.weekly_summaries.get(dn_week=202019)
+    assert (summary.session_count, summary.total_distance) == (3, 3000)
+
+
+@pytest.mark.django_db
+def test_import_sessions_queries(api_client, create_or_get_user):
+    """The number of queries does not depend on the number of sessions."""
+
+    jogger = create_or_get_user(JOGGER_NAME)
+    client = api_client("jogger")
+    query_counts = []
+
+    for days in [range(4, 6), range(11, 32)]:  # separate weeks
+        items = [import_session(jogger, day) for day in days]
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post(
+                reverse("session-import"),
+                data=json.dumps(items),
+                content_type="application/json",
+            )
+
+        assert response.data["created"] == len(items)
+        query_counts.append(len(queries))
+
+    assert query_counts[0] == query_counts[1]
+
+
+@pytest.mark.django_db
+def test_import_sessions_ndjson(api_client, create_or_get_user, settings):
+
+    jogger = create_or_get_user(JOGGER_NAME)
+    client = api_client("jogger")
+    lines = [json.dumps(import_session(jogger, day)) for day in range(1, 4)]
+
+    response = client.post(
+        reverse("session-import"),
+        data="\n".join(lines) + "\n\n",
+        content_type="application/x-ndjson",
+    )
+
+    assert response.data["created"] == 3
+    assert JoggingSession.objects.filter(user=jogger).count() == 3
+
+    settings.SESSION_IMPORT_MAX_ITEMS = 2
+    response = client.post(
+        reverse("session-import"),
+        data="\n".join(lines),
+        content_type="application/x-ndjson",
+    )
+
+    assert response.status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+
+    response = client.post(
+        reverse("session-import"), data="{", content_type="application/x-ndjson"
+    )
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.parametrize("role", ["staff", "anonymous"])
+@pytest.mark.django_db
+def test_import_sessions_forbidden(api_client, role):
+
+    response = api_client(role).post(
+        reverse("session-import"), data="[]", content_type="application/json"
+    )
+
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.fixture
+def bulk_sessions(create_or_get_user):
+    """Sessions for the jogger on 4-6 May 2020, and for another user on 5 May."""
+
+    jogger = create_or_get_user(JOGGER_NAME)
+    other = create_or_get_user(SAMPLE_NAME)
+
+    for user, day in [(jogger, 4), (jogger, 5), (jogger, 6), (other, 5)]:
+        session = JoggingSession(**PARTIAL_SESSION)
+        session.user = user
+        session.start = datetime.fromisoformat(import_session(user, day)["start"])
+        session.lu_weather = "CLEAR"
+        session.duration = 30 * day
+        session.save()
+
+    return jogger, other
+
+
+@pytest.mark.django_db
+def test_bulk_update_sessions(api_client, bulk_sessions):
+
+    jogger, other = bulk_sessions
+    ids = list(JoggingSession.objects.values_list("id", flat=True))
+
+    with CaptureQueriesContext(connection) as queries:
+        response = api_client("jogger").patch(
+            reverse("session-bulk"),
+            data=json.dumps({"ids": ids, "distance": 6000}),
+            content_type="application/json",
+        )
+
+    assert response.status_code == status.HTTP_200_OK
+    updates = [query for query in queries if query["sql"].startswith("UPDATE")]
+    assert len(updates) == 1  # not one per duration
+    assert response.data == {"updated": 3}
+
+    sessions = JoggingSession.objects.filter(user=jogger).order_by("start")
+    assert [session.dn_speed for session in sessions] == [
+        Decimal("3.0"),
+        Decimal("2.4"),
+        Decimal("2.0"),
+    ]
+    assert jogger.weekly_summaries.get().total_distance == 18000
+    assert other.jogging_sessions.get().distance == 1000
+
+    # Changing the location looks up the weather again
+    response = api_client("superuser").patch(
+        reverse("session-bulk") + "?filter=distance gt 1000",
+        data=json.dumps({"lu_weather_location": "Paris,FR", "duration": 60}),
+        content_type="application/json",
+    )
+
+    assert response.data == {"updated": 3}
+    assert (
+        list(sessions.values_list("dn_speed", "lu_weather", "lu_weather_pending"))
+        == [(Decimal("6.0"), "", True)] * 3
+    )
+    assert jogger.weekly_summaries.get().total_duration == 180
+
+    # Changing the duration alone keeps each distance
+    response = api_client("superuser").patch(
+        reverse("session-bulk") + "?filter=duration gt 0",
+        data=json.dumps({"duration": 120}),
+        content_type="application/json",
+    )
+
+    assert response.data == {"updated": 4}
+    assert list(sessions.values_list("dn_speed", flat=True)) == [Decimal("3.0")] * 3
+    assert other.jogging_sessions.get().dn_speed == Decimal("0.5")
+
+
+@pytest.mark.parametrize(
+    "query,data",
+    [
+        ("", {"distance": 1}),  # no sessions selected
+        ("", {"ids": "all", "distance": 1}),
+        ("", {"ids": [True], "distance": 1}),
+        ("?filter=distance gt 0", {}),
+        ("?filter=distance gt 0", {"start": "2020-05-04T07:30:00+00:00"}),
+        ("?filter=distance gt 0", {"distance": -1}),
+        ("?filter=distance gt 0", {"duration": "30"}),
+        ("?filter=distnce gt 0", {"distance": 1}),
+        ("?filter=distance gt", {"distance": 1}),
+    ],
+)
+@pytest.mark.django_db
+def test_bulk_update_invalid_sessions(api_client, bulk_sessions, query, data):
+
+    response = api_client("superuser").patch(
+        reverse("session-bulk") + query,
+        data=json.dumps(data),
+        content_type="application/json",
+    )
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert not JoggingSession.objects.exclude(distance=1000).exists()
+
+
+@pytest.mark.django_db
+def test_bulk_delete_sessions(api_client, bulk_sessions):
+
+    jogger, other = bulk_sessions
+
+    with CaptureQueriesContext(connection) as queries:
+        response = api_client("jogger").delete(
+            reverse("session-bulk") + "?filter=duration gt 130"
+        )
+
+    assert response.data == {"deleted": 2}
+    assert len(queries) < 15  # summaries are not refreshed per session
+
+    # One DELETE, without loading the sessions first
+    sqls = [query["sql"] for query in queries]
+    deletes = [sql for sql in sqls if sql.startswith('DELETE FROM "jogging_jogg')]
+    assert len(deletes) == 1
+    assert not any('"jogging_joggingsession"."lu_weather"' in sql for sql in sqls)
+    assert jogger.weekly_summaries.get().session_count == 1
+    assert other.weekly_summaries.get().session_count == 1
+
+    response = api_client("superuser").delete(
+        reverse("session-bulk"),
+        data=json.dumps(
+            {"ids": list(JoggingSession.objects.values_list("id", flat=True))}
+        ),
+        content_type="application/json",
+    )
+
+    assert response.data == {"deleted": 2}
+    assert not WeeklySummary.objects.exists()
+
+
+@pytest.mark.django_db
+def test_bulk_delete_invalid_filter(api_client, bulk_sessions):
+
+    response = api_client("jogger").delete(
+        reverse("session-bulk") + "?filter=duraton gt 0"
+    )
+
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert "duraton" in response.data["filter"][0]
+    assert JoggingSession.objects.count() == 4
+
+
+@pytest.mark.parametrize("role", ["staff", "anonymous"])
+@pytest.mark.django_db
+def test_bulk_change_forbidden(api_client, bulk_sessions, role):
+
+    response = api_client(role).delete(
+        reverse("session-bulk") + "?filter=distance gt 0"
+    )
+
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    assert JoggingSession.objects.count() == 4
+
+
+@pytest.mark.django_db
+def test_cached_responses(populate_samples, api_client, create_or_get_user):
+
+    populate_samples
+    jogger = api_client("jogger")
+    superuser = api_client("superuser")
+    urls = [reverse("report-list"), reverse("session-list") + "?page_size=2"]
+
+    for url in urls:
+        first = jogger.get(url).data
+        with CaptureQueriesContext(connection) as queries:
+            assert jogger.get(url).data == first
+
+        assert len(queries) == 0
+        assert superuser.get(url).data != first  # all users, cached separately
+
+    # Saving a session invalidates responses for the user, and for all users
+    user = create_or_get_user(JOGGER_NAME)
+    session = JoggingSession(**PARTIAL_SESSION)
+    session.user = user
+    session.start = datetime.fromisoformat("2020-05-04T07:30:00+00:00")
+    session.save()
+
+    for client in [jogger, superuser]:
+        report = client.get(urls[0]).data
+        assert 202019 in [record["week"] for record in report.values()]
+        assert client.get(urls[1]).data["results"][0]["dn_week"] == 202019
+
+    # Deleting sessions invalidates responses too
+    response = superuser.delete(
+        reverse("session-bulk"),
+        data=json.dumps({"ids": [session.id]}),
+        content_type="application/json",
+    )
+
+    assert response.data == {"deleted": 1}
+    assert jogger.get(urls[1]).data["results"][0]["dn_week"] != 202019
+
+
+@pytest.mark.django_db
+def test_conditional_get(populate_samples, api_client, create_or_get_user):
+
+    populate_samples
+    jogger = api_client("jogger")
+    session_id = JoggingSession.objects.filter(user__username=JOGGER_NAME).first().id
+    urls = [
+        reverse("report-list"),
+        reverse("session-list"),
+        reverse("session-detail", args=[session_id]),
+        reverse("user-list"),
+        reverse("user-detail", args=[create_or_get_user(JOGGER_NAME).id]),
+    ]
+
+    for url in urls:
+        response = jogger.get(url)
+        etag = response["ETag"]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = jogger.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert len(queries) <= 1  # session and user details are checked first
+
+        response = jogger.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    # Changes give new ETags
+    etags = [jogger.get(url)["ETag"] for url in urls]
+    session = JoggingSession.objects.get(id=session_id)
+    session.distance += 1
+    session.save()
+
+    for url, etag in zip(urls, etags):
+        response = jogger.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert response["ETag"] != etag
+
+
+@pytest.mark.django_db
+def test_last_modified_not_in_future(populate_samples, api_client):
+
+    populate_samples
+    jogger = api_client("jogger")
+    session = JoggingSession.objects.filter(user__username=JOGGER_NAME).first()
+    etags = set()
+
+    # Changes in quick succession
+    for distance in range(2000, 2020):
+        session.distance = distance
+        session.save()
+        response = jogger.get(reverse("report-list"))
+        etags.add(response["ETag"])
+
+    assert parse_http_date(response["Last-Modified"]) <= time.time()
+    assert len(etags) == 20
+
+
+def test_data_version_does_not_expire(monkeypatch, settings, tmp_path):
+
+    # The file-based cache has no atomic increment
+    settings.CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": str(tmp_path),
+        }
+    }
+
+    version = get_data_version(ALL_USERS)
+    bump_data_version(ALL_USERS)
+    bumped = get_data_version(ALL_USERS)
+    assert bumped != version
+
+    # Long after the cache's default timeout
+    later = time.time() + 24 * 60 * 60
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert get_data_version(ALL_USERS) == bumped
+
+
+@pytest.mark.django_db
+def test_put_if_match(populate_samples, api_client, get_existing_session):
+
+    populate_samples
+    jogger = api_client("jogger")
+    session = get_existing_session(JOGGER_NAME, SAMPLE_TIMESTAMP)
+    url = reverse("session-detail", args=[session.id])
+    data = {
+        "user": session.user_id,
+        "duration": session.duration,
+        "distance": 2000,
+        "start": SAMPLE_INPUT_TIMESTAMP,
+    }
+
+    def put(data, etag):
+        return jogger.put(
+            url, json.dumps(data), content_type="application/json", HTTP_IF_MATCH=etag
+        )
+
+    etag = jogger.get(url)["ETag"]
+    response = put(data, etag)
+
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert jogger.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code == 304
+
+    # The session has changed since the first ETag
+    data["distance"] = 3000
+    response = put(data, etag)
+
+    assert response.status_code == status.HTTP_412_PRECONDITION_FAILED
+    assert JoggingSession.objects.get(id=session.id).distance == 2000
+
+    response = jogger.delete(url, HTTP_IF_MATCH=etag)
+
+    assert response.status_code == status.HTTP_412_PRECONDITION_FAILED
+    assert JoggingSession.objects.filter(id=session.id).exists()
+
+
+@pytest.mark.django_db
+def test_sparse_fieldsets(populate_samples, api_client):
+
+    populate_samples
+    client = api_client("superuser")
+    session_id = JoggingSession.objects.first().id
+    fields = "?fields=dn_speed,start,distance"
+
+    # Session list (fields are in the usual order)
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse("session-list") + fields)
+
+    results = response.data["results"]
+    assert len(results) > 1
+    assert [list(result) for result in results] == [
+        ["start", "distance", "dn_speed"]
+    ] * len(results)
+    assert "lu_weather_location" not in queries[-1]["sql"]
+
+    # Session detail
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse("session-detail", args=[session_id]) + fields)
+
+    assert list(response.data) == ["start", "distance", "dn_speed"]
+    assert len(queries) == 1
+    assert "lu_weather_location" not in queries[0]["sql"]
+
+    # User list, without reading each user's sessions
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse("user-list") + "?fields=username")
+
+    users = response.data["results"]
+    assert [user["username"] for user in users] == sorted(
+        get_user_model().objects.values_list("username", flat=True)
+    )
+    assert [list(user) for user in users] == [["username"]] * len(users)
+    assert len(queries) == 2  # count and page
+    assert "password" not in queries[-1]["sql"]
+
+    for url in [reverse("session-list"), reverse("user-list")]:
+        response = client.get(url + "?fields=start,unknown")
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    # No fields given is the same as no parameter: all fields
+    for url in [reverse("session-list"), reverse("user-list")]:
+        response = client.get(url + "?fields=")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data["results"] == client.get(url).data["results"]
+
+    response = client.get(reverse("user-list") + "?fields=,&expand=")
+    assert response.data["results"] == client.get(reverse("user-list")).data["results"]
+
+
+@pytest.mark.django_db
+def test_user_session_links(populate_samples, api_client, create_or_get_user):
+
+    populate_samples
+    client = api_client("superuser")
+    jogger = create_or_get_user(JOGGER_NAME)
+
+    def get_users(query=""):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse("user-list") + query)
+
+        users = {user["username"]: user for user in response.data["results"]}
+        return users, len(queries)
+
+    users, query_count = get_users()
+
+    assert users[JOGGER_NAME]["session_count"] == jogger.jogging_sessions.count()
+    assert "jogging_sessions" not in users[JOGGER_NAME]
+    assert query_count == 2  # count and page, however many sessions
+
+    # The link lists the user's sessions
+    response = client.get(users[JOGGER_NAME]["sessions_url"])
+    assert len(response.data["results"]) == jogger.jogging_sessions.count()
+    assert {session["user"] for session in response.data["results"]} == {
+        users[JOGGER_NAME]["url"]
+    }
+
+    # Session links are included on request, with one more query
+    users, query_count = get_users("?expand=jogging_sessions")
+
+    assert (
+        len(users[JOGGER_NAME]["jogging_sessions"])
+        == users[JOGGER_NAME]["session_count"]
+    )
+    assert query_count == 3
+
+    response = client.get(
+        reverse("user-detail", args=[jogger.id]) + "?expand=jogging_sessions"
+    )
+    assert response.data["jogging_sessions"] == users[JOGGER_NAME]["jogging_sessions"]
+
+    response = client.get(reverse("user-list") + "?expand=username")
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
 @pytest.mark.parametrize(
     "role,username,new_distance,response_status",
     [
@@ -579,6 +1276,128 @@ def test_user_report(
     assert result == target
 
 
+@pytest.mark.django_db
+def test_user_report_over_several_weeks(create_session):
+
+    # (username, start, distance, duration), sessions in weeks 202008 and 202009
+    sessions = [
+        (SAMPLE_NAME, "2020-02-17T08:00:00+00:00", 1000, 10),
+        (SAMPLE_NAME, "2020-02-23T08:00:00+00:00", 3000, 20),
+        (SAMPLE_NAME, "2020-02-24T08:00:00+00:00", 2000, 15),
+        (JOGGER_NAME, "2020-02-18T08:00:00+00:00", 1250, 60),
+        (JOGGER_NAME, "2020-03-01T08:00:00+00:00", 500, 0),
+    ]
+
+    for username, start, distance, duration in sessions:
+        create_session(
+            username=username,
+            duration=duration,
+            distance=distance,
+            start_string=start,
+            lu_weather_location="",
+        )
+
+    alice = JoggingSession.objects.filter(user__username=SAMPLE_NAME)[0].user_id
+    bob = JoggingSession.objects.filter(user__username=JOGGER_NAME)[0].user_id
+
+    assert JoggingSession.generate_user_report() == {
+        1: {
+            "record": 1,
+            "user": alice,
+            "week": 202009,
+            "distance": 2000,
+            "duration": 15,
+            "avg_speed": Decimal("8.0"),
+        },
+        2: {
+            "record": 2,
+            "user": bob,
+            "week": 202009,
+            "distance": 500,
+            "duration": 0,
+            "avg_speed": Decimal("0.0"),
+        },
+        3: {
+            "record": 3,
+            "user": alice,
+            "week": 202008,
+            "distance": 4000,
+            "duration": 30,
+            "avg_speed": Decimal("8.0"),
+        },
+        4: {
+            "record": 4,
+            "user": bob,
+            "week": 202008,
+            "distance": 1250,
+            "duration": 60,
+            "avg_speed": Decimal("1.2"),
+        },
+    }
+
+
+@pytest.mark.parametrize("report_filter,queries", [(None, 1), ("user ne 1", 2)])
+@pytest.mark.django_db
+def test_user_report_query_count(
+    populate_samples, django_assert_num_queries, report_filter, queries
+):
+
+    populate_samples
+
+    with django_assert_num_queries(queries):
+        JoggingSession.generate_user_report(None, report_filter)
+
+
+@pytest.mark.parametrize(
+    "report_filter,target",
+    [
+        ("avg_speed eq 1", FULL_RESULT),
+        ("avg_speed gt 0.95 and avg_speed lt 1.05", FULL_RESULT),
+        ("avg_speed ne 1.0", {}),
+        ("week eq 202008 and distance gte 3000", FULL_RESULT),
+        ("distance gt duration and user ne 1", FILTERED_RESULT),
+        ("user eq 2 or avg_speed gt 5", FILTERED_RESULT),
+        ("avg_speed gt distance", {}),  # fields can be compared
+        ("avg_speed lt distance", FULL_RESULT),
+        ("distance eq", {}),  # invalid
+    ],
+)
+@pytest.mark.django_db
+def test_user_report_filter(populate_samples, report_filter, target):
+
+    populate_samples
+
+    assert JoggingSession.generate_user_report(None, report_filter) == target
+
+
+@pytest.mark.parametrize(
+    "distance,duration,report_filter,matches",
+    [
+        (1250, 60, "avg_speed eq 1.2", True),  # 1.25 rounds half to even
+        (1250, 60, "avg_speed lt 1.3", True),
+        (1350, 60, "avg_speed eq 1.4", True),  # 1.35 rounds half to even
+        (1350, 60, "avg_speed lte 1.3", False),
+        (1000, 0, "avg_speed eq 0", True),  # no duration, no speed
+        (1000, 0, "avg_speed gt 0", False),
+    ],
+)
+@pytest.mark.django_db
+def test_user_report_speed_filter(
+    create_session, distance, duration, report_filter, matches
+):
+
+    create_session(
+        username=SAMPLE_NAME,
+        duration=duration,
+        distance=distance,
+        start_string=SAMPLE_TIMESTAMP,
+        lu_weather_location="",
+    )
+
+    result = JoggingSession.generate_user_report(None, report_filter)
+    assert (len(result) == 1) is matches
+
+
 @pytest.mark.parametrize(
     "filter_string,target",
     [
@@ -588,6 +1407,28 @@ def test_user_report(
         ("local_timezone ne 'Asia/Hong_Kong'", True),
         ("lu_weather_location ne 'Sydney,Australia'", True),
         ("lu_weather ne 'other'", True),
+        ("start lt '2020-02-20'", True),
+        ("start gte '2020-02-19T11:00'", True),
+        ("start gt '2020-02-19T11:00'", False),
+        ("start gt '2020-02'", True),  # partial dates sort first
+        ("start lt '2020'", False),
+        ("start lt '2021'", True),
+        ("start eq '2020-02-19'", False),
+        ("start ne '2020-02-19'", True),
+        ("start gte '2020-02-19T11'", True),
+        ("start lt '2020-02-19T11'", False),
+        ("start gt '2020-13'", False),  # invalid
+        ("2000 gt distance", True),
+        ("distance lt 1000.5 and distance gt 999.5", True),
+        ("distance eq 1000.5", False),
+        ("distance ne 'far'", True),
+        ("distance lte duration", False),
+        (
+            "speed gt 5 or (dn_week eq 202008 and lu_weather_location eq 'London,UK')",
+            True,
+        ),
+        ("unknown eq 1", False),
+        ("distance eq", False),
     ],
 )
 @pytest.mark.django_db
@@ -595,8 +1436,9 @@ def test_filter_session(populate_samples, get_existing_session, filter_string, t
 
     populate_samples
     session = get_existing_session(SAMPLE_NAME, SAMPLE_TIMESTAMP)
+    sessions = JoggingSession.objects.filter(id=session.id)
 
-    assert apply_custom_session_filter(session, filter_string) == target
+    assert apply_custom_session_filter(sessions, filter_string).exists() == target
 
 
 @pytest.mark.parametrize(
@@ -619,4 +1461,83 @@ def test_filter_user(
 
     populate_users
     user = create_or_get_user(username)
-    assert UserList.apply_custom_filter(user, filter_string) == target
+    users = get_user_model().objects.filter(
+        compile_custom_filter_q(filter_string, USER_FILTER_FIELDS)
+    )
+    assert users.filter(pk=user.pk).exists() == target
+    assert evaluate_user_filter(user, filter_string) == target
+
+
+def evaluate_user_filter(user, filter_string):
+    """Evaluate a user filter in Python, as a reference for the SQL filter."""
+
+    if user.is_superuser:
+        role = "superuser"
+    elif user.is_staff:
+        role = "staff"
+    else:
+        role = "jogger"
+
+    return evaluate_custom_filter(
+        filter_string, {"username": user.username, "role": role}
+    )
+
+
+@pytest.mark.parametrize(
+    "filter_string",
+    [
+        "role eq 'jogger'",
+        "role ne 'staff'",
+        "role gt 'staff'",
+        "'staff' lte role",
+        "role eq 'admin' or username eq 'test_staff'",
+        "(role ne 'jogger' or username eq 'bob') and username lt 'test_superuser'",
+        "username gte 't' and role ne 'superuser'",
+        "role eq 1",
+        "role ne 1",
+    ],
+)
+def test_filtered_user_list_query(populate_users, api_client, filter_string):
+
+    populate_users
+    client = api_client("superuser")
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(reverse("user-list"), {"filter": filter_string})
+
+    assert response.status_code == status.HTTP_200_OK
+    assert len(queries) <= 2  # count and page, with the filter in SQL
+
+    assert [user["username"] for user in response.data["results"]] == [
+        user.username
+        for user in get_user_model().objects.order_by("username")
+        if evaluate_user_filter(user, filter_string)
+    ]
+
+
+# Weather tests
+
+
+@pytest.mark.parametrize(
+    "role,response_status",
+    [
+        ("superuser", status.HTTP_200_OK),
+        ("staff", status.HTTP_200_OK),
+        ("jogger", status.HTTP_403_FORBIDDEN),
+        ("anonymous", status.HTTP_403_FORBIDDEN),
+    ],
+)
+@pytest.mark.django_db
+def test_weather_status(api_client, role, response_status):
+
+    response = api_client(role).get(reverse("weather-status"))
+    assert response.status_code == response_status
+
+    if response_status == status.HTTP_200_OK:
+        assert response.data["circuit_breaker"]["state"] in [
+            "closed",
+            "open",
+            "half-open",
+        ]
+        assert set(response.data["cache"]) == {"hits", "misses"}
+        assert response.data["pending_sessions"] >= 0
@@ -0,0 +1,150 @@
+# jogging/weather_stub.py
+
+import json
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from .logic import DeterministicWeatherProvider, normalise_location
+
+
+# == Weather stub ==
+
+
+# Condition text reported for each weather summary
+STUB_CONDITIONS = {
+    "CLEAR": "Clear",
+    "CLOUDY": "Partially cloudy",
+    "PRECIPITATION": "Rain, Overcast",
+    "OTHER": "Fog",
+}
+
+
+class WeatherStubServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the weather.visualcrossing.com history API, for load tests
+    and development without a network. Queries are answered in the same JSON
+    format, with weather from `DeterministicWeatherProvider`, after `latency`
+    seconds. A fraction (`error_rate`) of queries fail with HTTP 503, and the
+    `unknown_locations` cannot be found.
+
+    Point `WEATHER_API_URL` at `url` to use the server.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        latency=0,
+        error_rate=0,
+        unknown_locations=(),
+        seed=None,
+    ):
+        super().__init__(address, _WeatherStubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unknown_locations = set(map(normalise_location, unknown_locations))
+        self.provider = DeterministicWeatherProvider()
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.query_count = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d/history" % (host, port)
+
+    def start(self):
+        """Serve in a background thread. Returns the thread."""
+
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+
+        self.shutdown()
+        self.server_close()
+
+    def should_fail(self):
+
+        with self.random_lock:
+            self.query_count += 1
+            return self.random.random() < self.error_rate
+
+    def history(self, locations, start, end):
+        """The response status and body for a history query."""
+
+        for location in locations:
+            if normalise_location(location) in self.unknown_locations:
+                return (
+                    400,
+                    {
+                        "errorCode": 999,
+                        "message": "Invalid location found. %s could not be found"
+                        % location,
+                    },
+                )
+
+        days = [start + timedelta(days=days) for days in range((end - start).days + 1)]
+        return (
+            200,
+            {
+                "errorCode": None,
+                "message": None,
+                "locations": {
+                    location: {
+                        "address": location,
+                        "values": [self._value(location, day) for day in days],
+                    }
+                    for location in locations
+                },
+            },
+        )
+
+    def _value(self, location, day):
+
+        weather = self.provider.weather_for(normalise_location(location), day)
+        midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+        return {
+            "datetime": int(midnight.timestamp() * 1000),
+            "datetimeStr": midnight.isoformat(),
+            "conditions": STUB_CONDITIONS[weather],
+        }
+
+
+class _WeatherStubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+
+        time.sleep(self.server.latency)
+
+        if self.server.should_fail():
+            return self._respond(503, {"message": "Service unavailable"})
+
+        try:
+            query = parse_qs(urlsplit(self.path).query)
+            locations = query["locations"][0].split("|")
+            start = date.fromisoformat(query["startDateTime"][0][:10])
+            end = date.fromisoformat(query["endDateTime"][0][:10])
+        except (KeyError, ValueError) as e:
+            return self._respond(400, {"errorCode": 100, "message": str(e)})
+
+        self._respond(*self.server.history(locations, start, end))
+
+    def _respond(self, status, result):
+
+        content = json.dumps(result).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # queries are not logged
@@ -13,11 +13,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 import os
 from datetime import timedelta
 
-import requests_cache
 from dotenv import load_dotenv
 
-requests_cache.install_cache(expires_after=timedelta(hours=1))
-
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -36,6 +33,50 @@ load_dotenv(BASE_DIR + "/.env")
 SECRET_KEY = os.getenv("SECRET")
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 
+# Weather provider (see jogging/logic.py), and the URL of the weather history API
+# (which may be a local stand-in, see jogging/weather_stub.py)
+WEATHER_PROVIDER = os.getenv(
+    "WEATHER_PROVIDER", "jogging.logic.VisualCrossingWeatherProvider"
+)
+WEATHER_API_URL = os.getenv(
+    "WEATHER_API_URL",
+    "http://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/weatherdata/history",
+)
+
+# Weather lookups run in background threads after sessions are saved
+WEATHER_LOOKUP_WORKERS = 4
+WEATHER_LOOKUP_BATCH_SIZE = 100  # sessions per background task
+WEATHER_LOOKUP_ATTEMPTS = 3
+WEATHER_LOOKUP_RETRY_DELAY = 2  # seconds, doubled after each failed attempt
+
+# Weather API connections are pooled and time-limited, and a circuit breaker
+# stops queries to a failing provider for a while
+WEATHER_HTTP_POOL_SIZE = 8
+WEATHER_CONNECT_TIMEOUT = 3.05  # seconds
+WEATHER_READ_TIMEOUT = 10  # seconds
+WEATHER_LOOKUP_BUDGET = 15  # seconds, for each query in total
+WEATHER_BREAKER_THRESHOLD = 5  # consecutive failures
+WEATHER_BREAKER_RESET = 30  # seconds before a failing provider is tried again
+
+# Weather is cached by location and date; weather for past days never expires
+WEATHER_CACHE_RECENT_TTL = timedelta(hours=1)
+WEATHER_CACHE_NOT_FOUND_TTL = timedelta(days=7)
+
+# Responses are cached until the data they show changes (see jogging/caching.py).
+# Changes are recorded in the cache, so it must be shared by every process that
+# serves or changes data, including management commands: the default is a
+# file-based cache, and CACHE_DIR may point it elsewhere. Responses are cached per
+# URL (including cursors and fields), so the cache holds many more entries than
+# Django's default of 300 before it culls.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("CACHE_DIR", os.path.join(BASE_DIR, "response_cache")),
+        "OPTIONS": {"MAX_ENTRIES": 20000},
+    }
+}
+RESPONSE_CACHE_TIMEOUT = 600  # seconds
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
@@ -74,6 +115,13 @@ REST_FRAMEWORK = {
     "TEST_REQUEST_DEFAULT_FORMAT": "json",
 }
 
+# Upper limit for the ?page_size= parameter of the session list
+SESSION_MAX_PAGE_SIZE = 100
+
+# Upper limit for the number of sessions in one import request (or ids in one
+# bulk change request)
+SESSION_IMPORT_MAX_ITEMS = 10000
+
 ROOT_URLCONF = "joglog.urls"
 
 TEMPLATES = [